@@ -0,0 +1,185 @@
+from collections import deque
+from gevent.event import Event
+from time import time
+
+import config
+from metrics import ADMISSION_REJECTIONS, ADMISSION_WAIT_DURATION
+
+
+ADMISSION_QUEUE_TIMEOUT = getattr(config, 'ADMISSION_QUEUE_TIMEOUT', 30)
+
+REJECTED_RATE_LIMITED = 'rate-limited'
+REJECTED_QUEUE_FULL = 'queue-full'
+REJECTED_TIMEOUT = 'timeout'
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, operation, reason, retry_after):
+        super(AdmissionRejected, self).__init__('Too many concurrent %s requests (%s), retry after %d seconds' % (operation, reason, retry_after))
+        self.operation = operation
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionLimits(object):
+    def __init__(self, concurrency, per_manager, queue, rate, burst):
+        self.concurrency = concurrency
+        self.per_manager = per_manager
+        self.queue = queue
+        self.rate = rate
+        self.burst = burst
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time()
+
+    def take(self, now=None):
+        if now is None:
+            now = time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self):
+        return max(1, int((1 - self.tokens) / self.rate + 0.999))
+
+
+class FairScheduler(object):
+    # Work slots of one operation are handed out round robin over the managers
+    # waiting for one, so a manager with a long queue can not starve the others
+    def __init__(self, operation, limits):
+        self.operation = operation
+        self.limits = limits
+        self.running = 0
+        self.active = {}
+        self.waiting = {}
+        self.rotation = deque()
+        self.buckets = {}
+
+    def _eligible(self, manager_id):
+        return self.running < self.limits.concurrency and self.active.get(manager_id, 0) < self.limits.per_manager
+
+    def _grant(self, manager_id):
+        self.running += 1
+        self.active[manager_id] = self.active.get(manager_id, 0) + 1
+
+    def _dispatch(self):
+        skipped = 0
+        while self.running < self.limits.concurrency and skipped < len(self.rotation):
+            manager_id = self.rotation.popleft()
+            waiters = self.waiting[manager_id]
+
+            if self.active.get(manager_id, 0) >= self.limits.per_manager:
+                self.rotation.append(manager_id)
+                skipped += 1
+                continue
+
+            self._grant(manager_id)
+            waiters.popleft().set()
+            skipped = 0
+
+            if len(waiters) > 0:
+                self.rotation.append(manager_id)
+            else:
+                del self.waiting[manager_id]
+
+    def _withdraw(self, manager_id, waiter):
+        waiters = self.waiting.get(manager_id)
+        if waiters is None or waiter not in waiters:
+            return False
+
+        waiters.remove(waiter)
+        if len(waiters) == 0:
+            del self.waiting[manager_id]
+            self.rotation.remove(manager_id)
+        return True
+
+    def acquire(self, manager_id, timeout=ADMISSION_QUEUE_TIMEOUT):
+        # A request rejected for a full queue does not use up a token, or a
+        # manager retrying against it would drain its own rate limit
+        waiters = self.waiting.get(manager_id)
+        if waiters is not None and len(waiters) >= self.limits.queue:
+            raise AdmissionRejected(self.operation, REJECTED_QUEUE_FULL, 1)
+
+        bucket = self.buckets.get(manager_id)
+        if bucket is None:
+            bucket = self.buckets[manager_id] = TokenBucket(self.limits.rate, self.limits.burst)
+        if not bucket.take():
+            raise AdmissionRejected(self.operation, REJECTED_RATE_LIMITED, bucket.retry_after())
+
+        if waiters is None and self._eligible(manager_id):
+            self._grant(manager_id)
+            return
+
+        if waiters is None:
+            waiters = self.waiting[manager_id] = deque()
+            self.rotation.append(manager_id)
+
+        waiter = Event()
+        waiters.append(waiter)
+        self._dispatch()
+
+        if not waiter.wait(timeout) and self._withdraw(manager_id, waiter):
+            raise AdmissionRejected(self.operation, REJECTED_TIMEOUT, 1)
+
+    def release(self, manager_id):
+        self.running -= 1
+        self.active[manager_id] -= 1
+        if self.active[manager_id] == 0:
+            del self.active[manager_id]
+        self._dispatch()
+
+
+class AdmissionController(object):
+    def __init__(self, limits):
+        self.schedulers = { operation: FairScheduler(operation, operation_limits) for operation, operation_limits in limits.items() }
+
+    def admit(self, operation, manager_id):
+        scheduler = self.schedulers[operation]
+        start_time = time()
+        try:
+            scheduler.acquire(manager_id)
+        except AdmissionRejected as e:
+            ADMISSION_REJECTIONS.inc(operation=operation, reason=e.reason)
+            raise
+        ADMISSION_WAIT_DURATION.observe(time() - start_time, operation=operation)
+        return AdmissionTicket(scheduler, manager_id)
+
+
+class AdmissionTicket(object):
+    def __init__(self, scheduler, manager_id):
+        self.scheduler = scheduler
+        self.manager_id = manager_id
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.scheduler.release(self.manager_id)
+
+
+def _limits(operation, concurrency, per_manager, queue, rate, burst):
+    overrides = getattr(config, 'ADMISSION_LIMITS', {}).get(operation, {})
+    return AdmissionLimits(
+        concurrency=overrides.get('concurrency', concurrency),
+        per_manager=overrides.get('per_manager', per_manager),
+        queue=overrides.get('queue', queue),
+        rate=overrides.get('rate', rate),
+        burst=overrides.get('burst', burst)
+    )
+
+
+# Limits are per API worker process
+admission = AdmissionController({
+    'send':             _limits('send', concurrency=4, per_manager=2, queue=32, rate=5, burst=20),
+    'quote':            _limits('quote', concurrency=8, per_manager=4, queue=32, rate=10, burst=40),
+    'create_account':   _limits('create_account', concurrency=2, per_manager=1, queue=32, rate=2, burst=10)
+})
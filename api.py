@@ -2,26 +2,65 @@ from gevent import monkey; monkey.patch_all()
 
 import functools
 import json
+import os
 
 from base64 import b64decode
-from binascii import unhexlify
-from flask import Flask, abort, request, Response
+from binascii import hexlify, unhexlify
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from flask import Flask, abort, g, request, stream_with_context, Response
 from hashlib import sha256
-from httplib import NO_CONTENT, BAD_REQUEST, UNAUTHORIZED, NOT_FOUND, INTERNAL_SERVER_ERROR
+from httplib import ACCEPTED, NO_CONTENT, BAD_REQUEST, UNAUTHORIZED, NOT_FOUND, CONFLICT, UNPROCESSABLE_ENTITY, INTERNAL_SERVER_ERROR
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, selectinload, sessionmaker
 from time import time, sleep
+from werkzeug.exceptions import HTTPException
 
+import config
+from admission import AdmissionRejected, admission
 from apiobjs import SendRequest, SetAutoPayInfoRequest, get_value
 from coininfo import Coin, CoinNotDefinedException
 from connections import connectionmanager
-from models import AUTH_TOKEN_SIZE, WalletManager, Account, make_tx_ref
-from wallet import Wallet
-
-from indexer.models import Transaction
+from eventstream import decode_cursor, eventhub
+from metrics import API_REQUEST_DURATION, API_REQUEST_ERRORS
+from sqlprofiler import profiler
+from models import AUTH_TOKEN_SIZE, IDEMPOTENCY_KEY_LEN, WalletManager, Account, IdempotencyKey, SendJob, Webhook, WebhookEvent, make_tx_ref, prefetch_address_info
+from sendjobs import enqueue_send_job
+from wallet import Wallet, decode_history_cursor
+from webhooks import valid_webhook_url
+
+from indexer.models import Transaction, TXOUT_TYPES
 from indexer.postprocessor import QueryDataPostProcessor
 
 
+IDEMPOTENCY_WAIT_TIMEOUT = 30
+IDEMPOTENCY_POLL_INTERVAL = 0.1
+IDEMPOTENCY_PENDING_LEASE = timedelta(minutes=10)
+
+TRANSACTION_HISTORY_PAGE_SIZE = 50
+TRANSACTION_HISTORY_MAX_PAGE_SIZE = 500
+
+UTXO_LIST_PAGE_SIZE = 1000
+UTXO_LIST_MAX_PAGE_SIZE = 100000
+
+TOO_MANY_REQUESTS = 429
+
+WEBHOOK_URL_MAX_LEN = 255
+
+EVENT_LONGPOLL_TIMEOUT = 30
+EVENT_LONGPOLL_MAX_TIMEOUT = 60
+EVENT_STREAM_KEEPALIVE_INTERVAL = 15
+
+WARM_UP_ENVIRON_KEY = 'wallet.warm_up'
+
+UTXO_CONFIRMATION_FILTERS = {
+    'confirmed':    { 'include_unconfirmed': False },
+    'unconfirmed':  { 'include_unconfirmed': True, 'unconfirmed_only': True },
+    'all':          { 'include_unconfirmed': True }
+}
+
+
 webapp = Flask('wallet-api')
 
 
@@ -29,17 +68,50 @@ def _json(obj, code=200):
     return Response(json.dumps(obj), code, mimetype='application/json')
 
 
-def exception_handler(error, code):
+class RequestInterruptedException(Exception):
+    pass
+
+
+def exception_handler(error, code, **extra):
     try:
         error = error.original_exception
     except AttributeError: pass
-    return _json({
+    body = {
         'code': code,
         'error': {
             'type': error.__class__.__name__,
             'message': str(error)
         }
-    }, code)
+    }
+    body.update(extra)
+    return _json(body, code)
+
+
+def _broadcast_error_response(error, code, txid):
+    # The payment did go out, so the stored response has to say which
+    # transaction it was or a client would send it again
+    return exception_handler(error, code, transaction={ 'txid': hexlify(txid).decode('ascii') })
+
+@webapp.before_request
+def start_request_timer():
+    g.request_start_time = time()
+    profiler.start('%s %s' % (request.method, request.path))
+
+
+@webapp.after_request
+def record_request_metrics(response):
+    if not request.environ.get(WARM_UP_ENVIRON_KEY):
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        API_REQUEST_DURATION.observe(time() - g.request_start_time, endpoint=endpoint, method=request.method)
+        if response.status_code >= 400:
+            API_REQUEST_ERRORS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+
+    profile = profiler.stop()
+    if profile is not None and request.headers.get('X-Query-Profile'):
+        response.headers['X-DB-Query-Count'] = str(profile.queries)
+        response.headers['X-DB-Time'] = '%.6f' % profile.db_time
+    return response
+
 
 @webapp.errorhandler(BAD_REQUEST)
 def bad_request_handler(e):
@@ -49,6 +121,14 @@ def bad_request_handler(e):
 def unauthorized_handler(e):
     return exception_handler(e, UNAUTHORIZED)
 
+@webapp.errorhandler(CONFLICT)
+def conflict_handler(e):
+    return exception_handler(e, CONFLICT)
+
+@webapp.errorhandler(UNPROCESSABLE_ENTITY)
+def unprocessable_entity_handler(e):
+    return exception_handler(e, UNPROCESSABLE_ENTITY)
+
 @webapp.errorhandler(INTERNAL_SERVER_ERROR)
 def internal_server_error_handler(e):
     return exception_handler(e, INTERNAL_SERVER_ERROR)
@@ -77,7 +157,8 @@ def authenticate_manager(api_func):
 
         tokenhash = sha256(sha256(token).digest()).digest()
 
-        dbsession = connectionmanager.database_session()
+        # GET requests never write, so they are served from a replica if one is available
+        dbsession = connectionmanager.database_session(readonly=request.method == 'GET')
         manager = dbsession.query(WalletManager).filter(WalletManager.tokenhash == tokenhash).first()
 
         if manager == None:
@@ -88,6 +169,145 @@ def authenticate_manager(api_func):
     return wrapper
 
 
+def _wait_for_idempotent_response(db, manager, key, requesthash):
+    deadline = time() + IDEMPOTENCY_WAIT_TIMEOUT
+
+    while True:
+        db.rollback()
+        entry = db.query(IdempotencyKey).filter(
+            IdempotencyKey.manager_id == manager.id,
+            IdempotencyKey.key == key
+        ).first()
+
+        if entry == None:
+            return None
+        if entry.requesthash != requesthash:
+            abort(UNPROCESSABLE_ENTITY, 'Idempotency key "%s" was already used for a different request' % key)
+        if entry.status == IdempotencyKey.STATUS_COMPLETED:
+            return Response(entry.response, entry.response_code, mimetype='application/json')
+
+        # The request that holds the key outlived any sane processing time, its
+        # worker died. Without a txid it never broadcast and the key is taken
+        # over, otherwise it is completed with the txid it broadcast
+        if entry.created < datetime.now() - IDEMPOTENCY_PENDING_LEASE:
+            if entry.txid is None:
+                db.query(IdempotencyKey).filter(
+                    IdempotencyKey.id == entry.id,
+                    IdempotencyKey.status == IdempotencyKey.STATUS_PENDING,
+                    IdempotencyKey.txid == None
+                ).delete(synchronize_session=False)
+                db.commit()
+                return None
+
+            response = _broadcast_error_response(RequestInterruptedException('Request was interrupted after broadcasting its transaction'), INTERNAL_SERVER_ERROR, entry.txid)
+            entry.status = IdempotencyKey.STATUS_COMPLETED
+            entry.response_code = response.status_code
+            entry.response = response.get_data(as_text=True)
+            db.commit()
+            return response
+
+        if time() > deadline:
+            abort(CONFLICT, 'Request with idempotency key "%s" is still being processed' % key)
+
+        sleep(IDEMPOTENCY_POLL_INTERVAL)
+
+
+def record_idempotent_txid(txid):
+    # Kept on the request as well, so a failing commit can not make the
+    # broadcast look like it never happened
+    g.broadcast_txid = txid
+    entry_info = g.get('idempotency_entry')
+    if entry_info is not None:
+        db, entry = entry_info
+        entry.txid = unhexlify(txid)
+        entry.status = IdempotencyKey.STATUS_BROADCAST
+        try:
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print('Could not record broadcast of %s for idempotency key: %s' % (txid, e))
+
+
+def admitted(operation):
+    # Expensive operations queue fairly per manager, so one manager's burst
+    # can not occupy every worker or the wallet locks
+    def decorator(api_func):
+        @functools.wraps(api_func)
+        def wrapper(*args, **kwargs):
+            try:
+                ticket = admission.admit(operation, kwargs['manager'].id)
+            except AdmissionRejected as e:
+                response = exception_handler(e, TOO_MANY_REQUESTS)
+                response.headers['Retry-After'] = str(e.retry_after)
+                return response
+
+            with ticket:
+                return api_func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def idempotent(api_func):
+    @functools.wraps(api_func)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return api_func(*args, **kwargs)
+        if len(key) == 0 or len(key.encode('utf-8')) > IDEMPOTENCY_KEY_LEN:
+            abort(BAD_REQUEST, 'Invalid idempotency key')
+
+        manager = kwargs['manager']
+        requesthash = sha256((request.method + ' ' + request.path + ' ').encode('utf-8') + request.get_data()).digest()
+        db = connectionmanager.database_session()
+
+        while True:
+            entry = IdempotencyKey()
+            entry.manager_id = manager.id
+            entry.key = key
+            entry.requesthash = requesthash
+            entry.status = IdempotencyKey.STATUS_PENDING
+            entry.created = datetime.now()
+            db.add(entry)
+
+            try:
+                db.commit()
+                break
+            except IntegrityError:
+                db.rollback()
+
+            # A previous attempt that failed before doing anything irreversible
+            # removes its key, in which case this request simply takes over
+            response = _wait_for_idempotent_response(db, manager, key, requesthash)
+            if response is not None:
+                return response
+
+        g.idempotency_entry = (db, entry)
+        try:
+            response = webapp.make_response(api_func(*args, **kwargs))
+        except Exception as e:
+            db.rollback()
+            if g.get('broadcast_txid') is None:
+                db.delete(entry)
+                db.commit()
+                raise
+            entry.txid = unhexlify(g.broadcast_txid)
+            response = _broadcast_error_response(e, e.code if isinstance(e, HTTPException) else INTERNAL_SERVER_ERROR, entry.txid)
+
+        # A request turned away by admission control did nothing, a retry with
+        # the same key has to be able to run instead of replaying the rejection
+        if response.status_code == TOO_MANY_REQUESTS and g.get('broadcast_txid') is None:
+            db.delete(entry)
+            db.commit()
+            return response
+
+        entry.status = IdempotencyKey.STATUS_COMPLETED
+        entry.response_code = response.status_code
+        entry.response = response.get_data(as_text=True)
+        db.commit()
+        return response
+    return wrapper
+
+
 def walletapi(api_func):
     @functools.wraps(api_func)
     def wrapper(*args, **kwargs):
@@ -107,18 +327,144 @@ def walletapi(api_func):
 @webapp.route('/accounts/', methods=['GET'])
 @authenticate_manager
 def list_accounts(manager):
+    accounts = Session.object_session(manager).query(Account).filter(
+        Account.manager_id == manager.id
+    ).options(
+        selectinload(Account.addresses),
+        selectinload(Account.raw_autopayments)
+    ).order_by(Account.id).all()
+
+    prefetch_address_info([ binding for account in accounts for binding in account.addresses ], readonly=True)
     with QueryDataPostProcessor() as pp:
-        return pp.process(manager.accounts).json()
+        return pp.process(accounts).json()
 
 
 @webapp.route('/accounts/<user>/', methods=['GET'])
 @authenticate_manager
 @walletapi
 def get_account(manager, wallet, account, user):
+    prefetch_address_info(account.model.addresses, readonly=True)
     with QueryDataPostProcessor() as pp:
         return pp.process(account.model).json()
 
 
+@webapp.route('/accounts/<user>/transactions/', methods=['GET'])
+@authenticate_manager
+@walletapi
+def get_account_transactions(manager, wallet, account, user):
+    try:
+        limit = int(request.args.get('limit', TRANSACTION_HISTORY_PAGE_SIZE))
+        before = decode_history_cursor(request.args['cursor']) if 'cursor' in request.args else None
+    except ValueError:
+        abort(BAD_REQUEST, 'Invalid limit or cursor')
+    if limit < 1 or limit > TRANSACTION_HISTORY_MAX_PAGE_SIZE:
+        abort(BAD_REQUEST, 'Limit must be between 1 and %d' % TRANSACTION_HISTORY_MAX_PAGE_SIZE)
+
+    transactions, cursor = account.transactions(limit, before=before)
+    with QueryDataPostProcessor() as pp:
+        return pp.process_raw({
+            'transactions': [ dict(entry) for entry in transactions ],
+            'next': cursor
+        }).json()
+
+
+@webapp.route('/accounts/<user>/utxos/<coin>/', methods=['GET'])
+@authenticate_manager
+@walletapi
+def get_account_utxos(manager, wallet, account, user, coin):
+    try:
+        coin = Coin.by_ticker(coin)
+    except CoinNotDefinedException:
+        abort(404)
+
+    try:
+        limit = int(request.args.get('limit', UTXO_LIST_PAGE_SIZE))
+        after_id = int(request.args['after']) if 'after' in request.args else None
+        filters = dict(UTXO_CONFIRMATION_FILTERS[request.args.get('confirmations', 'confirmed')])
+        if 'minAmount' in request.args:
+            filters['min_amount'] = Decimal(request.args['minAmount'])
+        if 'maxAmount' in request.args:
+            filters['max_amount'] = Decimal(request.args['maxAmount'])
+        if 'type' in request.args:
+            filters['txout_types'] = request.args['type'].split(',')
+    except (KeyError, ValueError, InvalidOperation):
+        abort(BAD_REQUEST, 'Invalid filter or cursor')
+    if limit < 1 or limit > UTXO_LIST_MAX_PAGE_SIZE:
+        abort(BAD_REQUEST, 'Limit must be between 1 and %d' % UTXO_LIST_MAX_PAGE_SIZE)
+    if any([ txout_type not in [ TXOUT_TYPES.P2PKH, TXOUT_TYPES.P2SH, TXOUT_TYPES.P2WPKH, TXOUT_TYPES.P2WSH ] for txout_type in filters.get('txout_types', []) ]):
+        abort(BAD_REQUEST, 'Invalid output type')
+
+    utxos = account.addresses[coin.ticker].stream_utxos(limit, after_id=after_id, **filters)
+
+    def generate():
+        yield '{"utxos": ['
+        count, last_id = 0, None
+        for last_id, utxo in utxos:
+            utxo = dict(utxo)
+            utxo['amount'] = float(utxo['amount'])
+            yield (', ' if count > 0 else '') + json.dumps(utxo)
+            count += 1
+        yield '], "next": %s}' % json.dumps(str(last_id) if count == limit else None)
+
+    return Response(stream_with_context(generate()), 200, mimetype='application/json')
+
+
+@webapp.route('/accounts/<user>/events/', methods=['GET'])
+@authenticate_manager
+@walletapi
+def get_account_events(manager, wallet, account, user):
+    try:
+        timeout = float(request.args.get('timeout', EVENT_LONGPOLL_TIMEOUT))
+    except ValueError:
+        abort(BAD_REQUEST, 'Invalid timeout')
+    if timeout < 0 or timeout > EVENT_LONGPOLL_MAX_TIMEOUT:
+        abort(BAD_REQUEST, 'Timeout must be between 0 and %d' % EVENT_LONGPOLL_MAX_TIMEOUT)
+
+    address_ids = { ticker: list(address.address_ids) for ticker, address in account.addresses.items() }
+
+    # Clients resume from the cursor of the last event they got, passed back
+    # as ?since= or, for event streams, as the Last-Event-ID header
+    since = request.args.get('since', request.headers.get('Last-Event-ID'))
+    try:
+        positions = { ticker: position for ticker, position in decode_cursor(since).items() if ticker in address_ids } if since else None
+    except ValueError:
+        abort(BAD_REQUEST, 'Invalid cursor')
+
+    # Waiting subscribers only cost a greenlet, they hold no database connections
+    account.close()
+    wallet._dbsession.close()
+
+    subscription = eventhub.subscribe(address_ids, positions)
+
+    if 'text/event-stream' not in request.headers.get('Accept', ''):
+        try:
+            item = subscription.get(timeout)
+            events = [ event for event, _ in [ item ] + subscription.pending() ] if item is not None else []
+        finally:
+            subscription.close()
+        # After an overflow the cursor is the one of the last complete scan,
+        # polling again from it replays what was dropped
+        return _json({ 'events': events, 'cursor': subscription.cursor, 'overflowed': subscription.overflowed })
+
+    def stream():
+        try:
+            while True:
+                item = subscription.get(EVENT_STREAM_KEEPALIVE_INTERVAL)
+                if subscription.overflowed:
+                    yield 'event: overflow\ndata: {}\n\n'
+                    return
+                if item is None:
+                    # An id without data moves the client's Last-Event-ID along
+                    yield ': keepalive\n%s\n' % ('id: %s\n' % subscription.cursor if subscription.cursor else '')
+                    continue
+                event, cursor = item
+                yield '%sevent: %s\ndata: %s\n\n' % ('id: %s\n' % cursor if cursor is not None else '', event['type'], json.dumps(event))
+        finally:
+            subscription.close()
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream', headers={ 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no' })
+
+
 @webapp.route('/accounts/<user>/autopayments/', methods=['GET'])
 @authenticate_manager
 @walletapi
@@ -161,6 +507,7 @@ def delete_account_coin_autopayments(manager, wallet, account, user, coin):
 
 @webapp.route('/accounts/<user>/autopayments/<coin>/', methods=['POST'])
 @authenticate_manager
+@idempotent
 @walletapi
 def add_account_coin_autopayment(manager, wallet, account, user, coin):
     try:
@@ -211,14 +558,27 @@ def set_account_coin_autopayments(manager, wallet, account, user, coin):
 
 @webapp.route('/accounts/<user>/send/', methods=['POST'])
 @authenticate_manager
+@idempotent
+@admitted('send')
 @walletapi
 def send(manager, wallet, account, user):
     requestobj = SendRequest(request.get_json())
     sender = account.addresses[requestobj.coin]
+
+    if request.args.get('async', '0').lower() in ('1', 'true'):
+        # Validated here so a bad request fails now instead of as a job; the
+        # destination account is only created once the job runs
+        requestobj.destination.set_context_info(wallet=wallet, coin=sender.coin, dry_run=True)
+
+        job = enqueue_send_job(wallet._dbsession, account.model, request.get_json())
+        response = _json(job._as_dict(), ACCEPTED)
+        response.headers['Location'] = '%s/jobs/%d/' % (config.API_ENDPOINT, job.id)
+        return response
+
     requestobj.destination.set_context_info(wallet=wallet, coin=sender.coin)
 
-    tx = sender.transaction(requestobj.destination.address, requestobj.amount, spend_unconfirmed=True, subsidized=requestobj.low_priority)
-    txid = tx.broadcast(wait_until_seen_on_network=True)
+    tx = sender.transaction(requestobj.destination.address, requestobj.amount, spend_unconfirmed=True, priority=requestobj.priority, subsidized=requestobj.low_priority)
+    txid = tx.broadcast(on_broadcast=record_idempotent_txid)
 
     with QueryDataPostProcessor() as pp:
         return pp.process_raw({
@@ -231,8 +591,83 @@ def send(manager, wallet, account, user):
         }).json()
 
 
+@webapp.route('/jobs/<int:job_id>/', methods=['GET'])
+@authenticate_manager
+def get_job(manager, job_id):
+    # Job status is polled right after submission, so it is read from the primary
+    job = connectionmanager.database_session().query(SendJob).filter(
+        SendJob.id == job_id,
+        SendJob.manager_id == manager.id
+    ).first()
+
+    if job == None:
+        abort(404)
+    return _json(job._as_dict())
+
+
+@webapp.route('/webhook/', methods=['GET'])
+@authenticate_manager
+def get_webhook(manager):
+    webhook = connectionmanager.database_session().query(Webhook).filter(Webhook.manager_id == manager.id).first()
+
+    if webhook == None:
+        abort(404)
+    return _json(webhook._as_dict())
+
+
+@webapp.route('/webhook/', methods=['PUT'])
+@authenticate_manager
+def set_webhook(manager):
+    url = get_value(request.get_json(), 'url')
+    if len(url) > WEBHOOK_URL_MAX_LEN or not valid_webhook_url(url):
+        abort(BAD_REQUEST, 'Invalid webhook url')
+
+    db = connectionmanager.database_session()
+    webhook = db.query(Webhook).filter(Webhook.manager_id == manager.id).first()
+    if webhook == None:
+        webhook = Webhook()
+        webhook.manager_id = manager.id
+        db.add(webhook)
+
+    # A new secret is issued on every change, events are signed with it
+    webhook.url = url
+    webhook.secret = hexlify(os.urandom(32)).decode('ascii')
+    webhook.created = datetime.now()
+    db.commit()
+
+    result = webhook._as_dict()
+    result['secret'] = webhook.secret
+    return _json(result)
+
+
+@webapp.route('/webhook/', methods=['DELETE'])
+@authenticate_manager
+def delete_webhook(manager):
+    db = connectionmanager.database_session()
+    db.query(Webhook).filter(Webhook.manager_id == manager.id).delete(synchronize_session=False)
+    db.query(WebhookEvent).filter(WebhookEvent.manager_id == manager.id).delete(synchronize_session=False)
+    db.commit()
+    return '', NO_CONTENT
+
+
+@webapp.route('/accounts/<user>/quote/', methods=['POST'])
+@authenticate_manager
+@admitted('quote')
+@walletapi
+def quote(manager, wallet, account, user):
+    requestobj = SendRequest(request.get_json())
+    sender = account.addresses[requestobj.coin]
+    requestobj.destination.set_context_info(wallet=wallet, coin=sender.coin, dry_run=True)
+
+    quote = sender.quote(requestobj.destination.address, requestobj.amount, spend_unconfirmed=True, priority=requestobj.priority, subsidized=requestobj.low_priority)
+
+    with QueryDataPostProcessor() as pp:
+        return pp.process_raw(dict(quote)).json()
+
+
 @webapp.route('/accounts/', methods=['POST'])
 @authenticate_manager
+@admitted('create_account')
 @walletapi
 def create_account(manager, wallet):
     user = get_value(request.get_json(), 'user')
@@ -249,6 +684,7 @@ def create_account(manager, wallet):
     else:
         new_account = wallet.import_account(user, private_key, db_session=db_session)
 
+    prefetch_address_info(new_account.model.addresses)
     with QueryDataPostProcessor() as pp:
         return pp.process(new_account.model).json()
 
@@ -2,9 +2,13 @@ from datetime import datetime, timedelta
 from decimal import Decimal
 
 from coininfo import COINS
+from feeestimator import PRIORITIES, PRIORITY_LOW, PRIORITY_NORMAL
 from models import AutomaticPayment
 
 
+PLACEHOLDER_PUBKEYHASH = b'\x00' * 20
+
+
 class _NoDefault(object): pass
 NoDefault = _NoDefault()
 
@@ -23,6 +27,7 @@ class Destination(object):
     def __init__(self):
         self.wallet = None
         self.coin = None
+        self.dry_run = False
 
     @classmethod
     def register(cls, dest_type):
@@ -36,9 +41,10 @@ class Destination(object):
                 return destination_cls(json)
         raise ValueError('Invalid destination type "%s"' % destination_type)
 
-    def set_context_info(self, wallet, coin):
+    def set_context_info(self, wallet, coin, dry_run=False):
         self.wallet = wallet
         self.coin = coin
+        self.dry_run = dry_run
 
         if not self.coin.valid_address(self.address):
             raise ValueError('Invalid destination address: %s' % self.address)
@@ -62,11 +68,15 @@ class AccountDestination(Destination):
 
             account = self.wallet.account(self.user)
             if account == None:
-                if self.allow_creation:
-                    account = self.wallet.create_account(self.user)
-                    self.created = True
-                else:
+                if not self.allow_creation:
                     raise ValueError('Unknown account/user: %s' % self.user)
+                if self.dry_run:
+                    # New accounts receive on the default address type, so any
+                    # pubkeyhash yields an output of the right size for a quote
+                    self._address = self.coin.get_default_receive_address(PLACEHOLDER_PUBKEYHASH)
+                    return self._address
+                account = self.wallet.create_account(self.user)
+                self.created = True
 
             self._address = account.addresses[self.coin.ticker].preferred_address
         return self._address
@@ -99,18 +109,18 @@ class SendRequest(object):
         self.destination = Destination.parse(get_value(json, 'destination'))
         self.coin = str(get_value(json, 'coin')).lower()
         self.amount = Decimal(get_value(json, 'amount'))
-        self.priority = str(get_value(json, 'priority', 'normal')).lower()
+        self.priority = str(get_value(json, 'priority', PRIORITY_NORMAL)).lower()
 
         if self.coin not in [ coin.ticker.lower() for coin in COINS ]:
             raise ValueError('Invalid coin "%s"' % self.coin)
         self.coin = { coin.ticker.lower(): coin for coin in COINS }[self.coin].ticker
 
-        if self.priority not in ['normal', 'low', 'high']:
+        if self.priority not in PRIORITIES:
             raise ValueError('Invalid priority "%s"' % self.priority)
 
     @property
     def low_priority(self):
-        self.priority == 'low'
+        return self.priority == PRIORITY_LOW
 
 
 class SetAutoPayInfoRequest(object):
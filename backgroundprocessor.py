@@ -1,16 +1,24 @@
+import argparse
+import json
+
 from binascii import hexlify
 from datetime import datetime, timedelta
-from sqlalchemy import func as sqlfunc, or_
+from multiprocessing.pool import ThreadPool
 from time import sleep
 
+import config
 from coininfo import COINS
 from connections import connectionmanager
-from models import Account, AccountAddress, AutomaticPayment
+from metrics import AUTOPAYMENTS, BACKGROUND_CYCLE_DURATION, CONSOLIDATIONS, serve as serve_metrics
+from models import Account, AccountAddress, AutomaticPayment, IdempotencyKey
+from spendledger import purge_pending_spends
+from sqlprofiler import profiler
 from transaction import FEERATE_NETWORK, FEERATE_POOLSUBSIDY, UnsignedTransactionBuilder, TransactionInput as UnsignedTransactionInput, NotEnoughCoinsException
+from utxoindex import UtxoCountIndex
 from wallet import WalletAccount, MIN_CONSOLIDATION_UTXOS, MAX_CONSOLIDATION_UTXOS
 
 from indexer.logger import log_event
-from indexer.models import Address, Block, CoinbaseInfo, Transaction, TransactionInput, TransactionOutput
+from indexer.models import Address, Block
 from indexer.postprocessor import convert_date
 from indexer.pidfile import make_pidfile
 
@@ -18,74 +26,113 @@ import wallet as __main__
 
 
 MAX_QUEUED_TXS = 8
+MAX_CONCURRENT_CONSOLIDATIONS = 4
+
+CHECK_INTERVAL = timedelta(seconds=60)
+
+IDEMPOTENCY_KEY_TTL = timedelta(days=1)
+IDEMPOTENCY_PURGE_INTERVAL = timedelta(hours=1)
+
+CYCLE_TOO_SOON = 'too-soon'
+CYCLE_MEMPOOL_FULL = 'mempool-full'
+CYCLE_RAN = 'ran'
 
 
 class CoinState(object):
-    def __init__(self):
+    def __init__(self, coin, interval=CHECK_INTERVAL):
         self.lastcheck = datetime.utcfromtimestamp(0)
         self.lastblockhash = b''
+        self.interval = interval
+        self.utxo_index = UtxoCountIndex(coin)
 
-    def update(self, blockhash):
+    def update(self, blockhash, now=None):
         self.lastblockhash = blockhash
-        now = datetime.now()
+        if now is None:
+            now = datetime.now()
 
-        if now - self.lastcheck < timedelta(seconds=60):
+        if now - self.lastcheck < self.interval:
             return False
 
         self.lastcheck = now
         return True
 
 
-def perform_consolidation_for_coin(coin, dbsession, max_work=MAX_QUEUED_TXS):
-    for account_address_id, account, address, utxos in dbsession.query(
-        AccountAddress.id,
+def consolidate_address(coin, utxo_index, address_id, account, address, min_utxos=MIN_CONSOLIDATION_UTXOS, max_utxos=MAX_CONSOLIDATION_UTXOS):
+    with profiler.profile('consolidate:%s:%s' % (coin.ticker, address)):
+        return _consolidate_address(coin, utxo_index, address_id, account, address, min_utxos, max_utxos)
+
+
+def _consolidate_address(coin, utxo_index, address_id, account, address, min_utxos, max_utxos):
+    try:
+        transaction_manager = WalletAccount(None, account).addresses[coin.ticker]
+        utxos = transaction_manager.walletinfo(include_unconfirmed=True, readonly=False).get(address, {}).get('utxos', 0)
+        utxo_index.correct(address_id, utxos)
+        if utxos < min_utxos:
+            return None
+
+        log_event('Consol.', 'Addr', address, '%d utxos' % utxos)
+        txid = transaction_manager.consolidate(subsidized=True, max_utxos=max_utxos)
+        log_event('Broadc.', 'Tx', txid)
+        CONSOLIDATIONS.inc(coin=coin.ticker)
+        return txid
+    except Exception as e:
+        print('Error consolidating address %s: %s' % (address, e))
+
+
+def perform_consolidation_for_coin(coin, max_work=MAX_QUEUED_TXS, utxo_index=None, min_utxos=MIN_CONSOLIDATION_UTXOS, max_utxos=MAX_CONSOLIDATION_UTXOS):
+    # Finding candidates only reads, each consolidation re-checks its address on the primary
+    dbsession = connectionmanager.database_session(coin=coin, readonly=True)
+    try:
+        return _perform_consolidation_for_coin(coin, dbsession, max_work, utxo_index, min_utxos, max_utxos)
+    finally:
+        dbsession.close()
+
+
+def _perform_consolidation_for_coin(coin, dbsession, max_work, utxo_index, min_utxos, max_utxos):
+    if utxo_index is None:
+        utxo_index = UtxoCountIndex(coin)
+    utxo_index.update(dbsession)
+
+    candidates = [ address_id for address_id, _ in utxo_index.candidates(min_utxos) ][:max_work]
+    if len(candidates) == 0:
+        return max_work
+
+    work = dbsession.query(
+        AccountAddress.address_id,
         Account,
-        Address.address,
-        sqlfunc.count(TransactionOutput.id)
+        Address.address
     ).join(
         AccountAddress.account
     ).join(
         Address,
         AccountAddress.address_id == Address.id
-    ).join(
-        TransactionOutput,
-        Address.id == TransactionOutput.address_id,
-        isouter=True
-    ).join(
-        TransactionOutput.transaction
-    ).join(
-        TransactionOutput.spenders,
-        isouter=True
-    ).join(
-        Transaction.coinbaseinfo,
-        isouter=True
-    ).join(
-        CoinbaseInfo.block,
-        isouter=True
     ).filter(
         AccountAddress.coin == coin.ticker,
-        TransactionOutput.spentby_id == None,
-        TransactionInput.id == None,
-        or_(
-            CoinbaseInfo.block_id == None,
-            Block.height <= coin.current_coinbase_confirmation_height()
-        )
-    ).group_by(Address.id).having(
-        sqlfunc.count(TransactionOutput.id) >= MIN_CONSOLIDATION_UTXOS
-    ).all():
-        log_event('Consol.', 'Addr', address, '%d utxos' % utxos)
-        transaction_manager = WalletAccount(None, account).addresses[coin.ticker]
-        txid = transaction_manager.consolidate(subsidized=True)
-        log_event('Broadc.', 'Tx', txid)
+        AccountAddress.address_id.in_(candidates)
+    ).all()
 
-        max_work -= 1
-        if max_work <= 0:
-            break
-    return max_work
+    # Consolidation spends the utxos of all of an account's addresses, so only
+    # one consolidation per account can be in flight at a time
+    accounts_seen = set()
+    work = [ (address_id, account, address) for address_id, account, address in work if not (account.id in accounts_seen or accounts_seen.add(account.id)) ]
+
+    # Index entries may be stale or ahead of a lagging replica, leaving nothing to do
+    if len(work) == 0:
+        return max_work
+
+    pool = ThreadPool(min(len(work), MAX_CONCURRENT_CONSOLIDATIONS))
+    try:
+        results = pool.map(lambda args: consolidate_address(coin, utxo_index, *args, min_utxos=min_utxos, max_utxos=max_utxos), work)
+    finally:
+        pool.close()
+        pool.join()
+
+    return max_work - len([ txid for txid in results if txid is not None ])
 
 
-def run_automatic_payment_for_coin(coin, dbsession, max_work=MAX_QUEUED_TXS):
+def run_automatic_payment_for_coin(coin, dbsession, max_work=MAX_QUEUED_TXS, now=None, wait_until_seen_on_network=False):
     while True:
+        current_time = now if now is not None else datetime.now()
         dbsession.rollback()
         result = dbsession.query(
             AutomaticPayment,
@@ -94,7 +141,7 @@ def run_automatic_payment_for_coin(coin, dbsession, max_work=MAX_QUEUED_TXS):
             AutomaticPayment.account
         ).filter(
             AutomaticPayment.coin == coin.ticker,
-            AutomaticPayment.nextpayment <= datetime.now()
+            AutomaticPayment.nextpayment <= current_time
         ).first()
 
         if result is None:
@@ -112,11 +159,15 @@ def run_automatic_payment_for_coin(coin, dbsession, max_work=MAX_QUEUED_TXS):
             tx = wallet.addresses[coin.ticker].process_automatic_payment(autopayment.address, amount, zero_balance_payment=zero_balance_payment)
 
             if tx is not None:
-                txid = tx.broadcast(wait_until_seen_on_network=True)
+                txid = tx.broadcast(wait_until_seen_on_network=wait_until_seen_on_network)
                 log_event('Broadc.', 'Tx', txid)
+                AUTOPAYMENTS.inc(coin=coin.ticker, result='broadcast')
                 max_work -= 1
+            else:
+                AUTOPAYMENTS.inc(coin=coin.ticker, result='skipped')
         except Exception as e:
             print('Error processing automatic payment with id %d: %s' % (autopayment.id, e))
+            AUTOPAYMENTS.inc(coin=coin.ticker, result='failed')
 
         if autopayment.interval == 0 or autopayment.interval > 315360000:
             autopayment.interval = 315360000
@@ -124,7 +175,7 @@ def run_automatic_payment_for_coin(coin, dbsession, max_work=MAX_QUEUED_TXS):
             autopayment.interval = 60
 
         delta = timedelta(seconds=autopayment.interval)
-        while autopayment.nextpayment < datetime.now():
+        while autopayment.nextpayment < current_time:
             autopayment.nextpayment += delta
 
         dbsession.add(autopayment)
@@ -136,15 +187,67 @@ def run_automatic_payment_for_coin(coin, dbsession, max_work=MAX_QUEUED_TXS):
     return max_work
 
 
-def run_background_tasks_for_coin(coin, dbsession, max_work=MAX_QUEUED_TXS):
-    remaining_work = perform_consolidation_for_coin(coin, dbsession, max_work=max_work)
+def run_background_tasks_for_coin(coin, dbsession, max_work=MAX_QUEUED_TXS, utxo_index=None, min_utxos=MIN_CONSOLIDATION_UTXOS, max_utxos=MAX_CONSOLIDATION_UTXOS, now=None, wait_until_seen_on_network=False):
+    remaining_work = perform_consolidation_for_coin(coin, max_work=max_work, utxo_index=utxo_index, min_utxos=min_utxos, max_utxos=max_utxos)
+    consolidations = max_work - remaining_work
     if remaining_work > 0:
-        run_automatic_payment_for_coin(coin, dbsession, max_work=remaining_work)
+        remaining_work = run_automatic_payment_for_coin(coin, dbsession, max_work=remaining_work, now=now, wait_until_seen_on_network=wait_until_seen_on_network)
+    return consolidations, max_work - consolidations - remaining_work
+
+
+def process_new_block(coin, state, dbsession, blockhash, now=None, max_queued_txs=MAX_QUEUED_TXS, **task_options):
+    log_event('New', 'Blk', hexlify(blockhash), 'chain = ' + coin.ticker)
+
+    if not state.update(blockhash, now=now):
+        log_event('Ign', 'Blk', hexlify(blockhash), 'too soon')
+        return CYCLE_TOO_SOON, None
+
+    coindaemon = connectionmanager.coindaemon(coin)
+    txs_queued = len(coindaemon.getrawmempool())
+    max_work = max_queued_txs - txs_queued
+
+    purged = purge_pending_spends(coin, dbsession, coindaemon=coindaemon)
+    if purged > 0:
+        log_event('Purge', 'Spnd', coin.ticker, '%d pending spends' % purged)
+
+    if max_work <= 0:
+        log_event('Ign', 'Blk', hexlify(blockhash), 'mempool full')
+        return CYCLE_MEMPOOL_FULL, None
 
+    log_event('Check', 'Chn', coin.ticker, '%d entries in mempool, max = %d' % (txs_queued, max_queued_txs))
+    with BACKGROUND_CYCLE_DURATION.time(coin=coin.ticker), profiler.profile('background:%s' % coin.ticker) as profile:
+        work = run_background_tasks_for_coin(coin, dbsession, max_work=max_work, utxo_index=state.utxo_index, now=now, **task_options)
+    log_event('Finish', 'Chn', coin.ticker, '%d queries, %.3fs db time' % (profile.queries, profile.db_time))
+    return CYCLE_RAN, work
 
-def main():
-    STATE = { coin.ticker: CoinState() for coin in COINS }
+
+def purge_expired_idempotency_keys(dbsession, now=None):
+    if now is None:
+        now = datetime.now()
+    purged = dbsession.query(IdempotencyKey).filter(
+        IdempotencyKey.created < now - IDEMPOTENCY_KEY_TTL
+    ).delete(synchronize_session=False)
+    dbsession.commit()
+    return purged
+
+
+def record_block(recording, coin, blockhash):
+    recording.write(json.dumps({
+        'coin': coin.ticker,
+        'time': (datetime.utcnow() - datetime.utcfromtimestamp(0)).total_seconds(),
+        'blockhash': hexlify(blockhash).decode('ascii'),
+        'mempool': len(connectionmanager.coindaemon(coin).getrawmempool())
+    }) + '\n')
+    recording.flush()
+
+
+def main(recording=None):
+    STATE = { coin.ticker: CoinState(coin) for coin in COINS }
     wrote_pidfile = False
+    lastpurge = datetime.utcfromtimestamp(0)
+
+    if getattr(config, 'BACKGROUNDPROCESSOR_METRICS_PORT', None) is not None:
+        serve_metrics(config.BACKGROUNDPROCESSOR_METRICS_PORT)
 
     while True:
         sleep(10)
@@ -157,23 +260,16 @@ def main():
                 if lastblock.hash == state.lastblockhash:
                     continue
 
-                log_event('New', 'Blk', hexlify(lastblock.hash), 'chain = ' + coin.ticker)
-                should_run = state.update(lastblock.hash)
-
-                if not should_run:
-                    log_event('Ign', 'Blk', hexlify(lastblock.hash), 'too soon')
-                    continue
-
-                txs_queued = len(connectionmanager.coindaemon(coin).getrawmempool())
-                max_work = MAX_QUEUED_TXS - txs_queued
+                if recording is not None:
+                    record_block(recording, coin, lastblock.hash)
 
-                if max_work <= 0:
-                    log_event('Ign', 'Blk', hexlify(lastblock.hash), 'mempool full')
-                    continue
+                process_new_block(coin, state, session, lastblock.hash)
 
-                log_event('Check', 'Chn', coin.ticker, '%d entries in mempool, max = %d' % (txs_queued, MAX_QUEUED_TXS))
-                run_background_tasks_for_coin(coin, session, max_work=max_work)
-                log_event('Finish', 'Chn', coin.ticker)
+            if datetime.now() - lastpurge >= IDEMPOTENCY_PURGE_INTERVAL:
+                lastpurge = datetime.now()
+                purged = purge_expired_idempotency_keys(connectionmanager.database_session())
+                if purged > 0:
+                    log_event('Purge', 'Idem', '%d expired idempotency keys' % purged)
 
             if not wrote_pidfile:
                 make_pidfile(__main__)
@@ -184,4 +280,8 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Run consolidations and automatic payments for all coins')
+    parser.add_argument('--record', default=None, help='Append every new block and the mempool size at that time to this file, for replay with benchmarks/replay.py')
+    args = parser.parse_args()
+
+    main(recording=open(args.record, 'a') if args.record is not None else None)
@@ -0,0 +1,88 @@
+import gc
+import json
+import os
+import platform
+import sys
+
+from datetime import datetime
+from time import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+REGRESSION_THRESHOLD = 0.1
+
+
+def percentile(samples, fraction):
+    if len(samples) == 0:
+        return None
+    ordered = sorted(samples)
+    index = min(int(round(fraction * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+def measure(func, repeat=1):
+    timings = []
+    peak_allocated = None
+    result = None
+
+    for run in range(repeat):
+        gc.collect()
+        if tracemalloc is not None and run == 0:
+            tracemalloc.start()
+        start_time = time()
+        result = func()
+        timings.append(time() - start_time)
+        if tracemalloc is not None and run == 0:
+            _, peak_allocated = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+    return result, {
+        'best': min(timings),
+        'mean': sum(timings) / len(timings),
+        'runs': len(timings),
+        'peak_allocated': peak_allocated
+    }
+
+
+def environment_info():
+    return {
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'time': datetime.utcnow().isoformat()
+    }
+
+
+def save_results(name, results, path=None):
+    if path is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        path = os.path.join(RESULTS_DIR, '%s-%s.json' % (name, datetime.utcnow().strftime('%Y%m%d-%H%M%S')))
+
+    with open(path, 'w') as f:
+        json.dump({ 'benchmark': name, 'environment': environment_info(), 'results': results }, f, indent=2, sort_keys=True, default=str)
+    return path
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def compare_results(baseline, current, metric='best', threshold=REGRESSION_THRESHOLD):
+    regressions = []
+    for case, values in sorted(current.items()):
+        if case not in baseline or baseline[case].get(metric) in (None, 0):
+            continue
+        change = (values[metric] - baseline[case][metric]) / baseline[case][metric]
+        marker = ''
+        if change > threshold:
+            marker = '  <-- regression'
+            regressions.append(case)
+        print('%-40s %12.6f -> %12.6f  (%+.1f%%)%s' % (case, baseline[case][metric], values[metric], change * 100, marker))
+    return regressions
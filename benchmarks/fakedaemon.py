@@ -0,0 +1,115 @@
+import json
+import os
+
+from hashlib import sha256
+from binascii import hexlify, unhexlify
+
+from coinsupport.addresscodecs import encode_base58_address, encode_privkey
+
+
+def txid_for(rawtx_hex):
+    return hexlify(sha256(sha256(unhexlify(rawtx_hex)).digest()).digest()[::-1]).decode('ascii')
+
+
+class FakeDaemon(object):
+    def __init__(self, coin, feerate=0.001, relayfee=0.0001):
+        self.coin = coin
+        self.feerate = feerate
+        self.relayfee = relayfee
+        self.mempool = []
+        self.spent = set()
+        self.external_mempool = 0
+        self.keys = {}
+        self.imported = set()
+        self.calls = {}
+
+    def mine(self, max_txs=None):
+        # Returns (txid, raw hex) of the mined transactions, for the fake indexer
+        mined = self.mempool if max_txs is None else self.mempool[:max_txs]
+        self.mempool = self.mempool[len(mined):]
+        return mined
+
+    def rpc_getnewaddress(self, *args):
+        from wallet import PrivateKey
+
+        raw_privkey = os.urandom(32)
+        address = encode_base58_address(self.coin.address_version, PrivateKey(raw_privkey).hash160())
+        self.keys[address] = encode_privkey(self.coin.privkey_version, raw_privkey)
+        return address
+
+    def rpc_dumpprivkey(self, address):
+        return self.keys[address]
+
+    def rpc_importaddress(self, address, *args):
+        self.imported.add(address)
+
+    def rpc_signrawtransaction(self, rawtx_hex, *args):
+        return { 'hex': rawtx_hex, 'complete': True }
+
+    rpc_signrawtransactionwithkey = rpc_signrawtransaction
+
+    def rpc_sendrawtransaction(self, rawtx_hex, *args):
+        from benchmarks.fakeindexer import parse_transaction
+
+        txid = txid_for(rawtx_hex)
+        inputs, _ = parse_transaction(rawtx_hex)
+        if any([ outpoint in self.spent for outpoint in inputs ]):
+            raise ValueError('bad-txns-inputs-missingorspent')
+        self.spent.update(inputs)
+        self.mempool.append((txid, rawtx_hex))
+        return txid
+
+    def rpc_gettxout(self, txid, vout, *args):
+        # Outputs spent in the mempool or by a mined transaction are gone, all
+        # others are assumed to exist in the dataset
+        if (txid, vout) in self.spent:
+            return None
+        return { 'confirmations': 1 }
+
+    def rpc_getrawmempool(self, *args):
+        return [ txid for txid, _ in self.mempool ] + [ 'external-%d' % i for i in range(self.external_mempool) ]
+
+    def rpc_estimatesmartfee(self, target, *args):
+        return { 'feerate': self.feerate, 'blocks': target }
+
+    def rpc_getnetworkinfo(self, *args):
+        return { 'relayfee': self.relayfee }
+
+    def call(self, method, params):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        handler = getattr(self, 'rpc_' + method, None)
+        if handler is None:
+            raise KeyError('Method not found: %s' % method)
+        return handler(*params)
+
+    def wsgi_app(self, environ, start_response):
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        request = json.loads(environ['wsgi.input'].read(length).decode('utf-8'))
+
+        try:
+            response = { 'result': self.call(request['method'], request.get('params', [])), 'error': None, 'id': request.get('id') }
+        except KeyError as e:
+            response = { 'result': None, 'error': { 'code': -32601, 'message': str(e) }, 'id': request.get('id') }
+        except Exception as e:
+            response = { 'result': None, 'error': { 'code': -1, 'message': str(e) }, 'id': request.get('id') }
+
+        start_response('200 OK', [ ('Content-Type', 'application/json') ])
+        return [ json.dumps(response).encode('utf-8') ]
+
+
+def serve(daemon, host='127.0.0.1', port=0):
+    from gevent.pywsgi import WSGIServer
+
+    server = WSGIServer((host, port), daemon.wsgi_app, log=None)
+    server.start()
+    return server
+
+
+def serve_for_coins(coins):
+    daemons = {}
+    for coin in coins:
+        daemon = FakeDaemon(coin)
+        server = serve(daemon)
+        coin.rpc_host, coin.rpc_port = '127.0.0.1', server.server_port
+        daemons[coin.name] = daemon
+    return daemons
@@ -0,0 +1,160 @@
+import os
+import sys
+
+from binascii import hexlify, unhexlify
+from datetime import datetime
+from decimal import Decimal
+from struct import unpack_from
+
+from sqlalchemy import func as sqlfunc
+from sqlalchemy.orm import ColumnProperty, RelationshipProperty
+from sqlalchemy.orm.interfaces import MANYTOONE
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.generate_dataset import TableWriter, link, primary_key
+from connections import connectionmanager
+from indexer.models import Address, Block, Transaction, TransactionInput, TransactionOutput, TXOUT_TYPES
+
+
+SATOSHIS = Decimal(100000000)
+
+
+def read_varint(raw, offset):
+    prefix = raw[offset] if isinstance(raw[offset], int) else ord(raw[offset])
+    if prefix < 0xfd:
+        return prefix, offset + 1
+    if prefix == 0xfd:
+        return unpack_from('<H', raw, offset + 1)[0], offset + 3
+    if prefix == 0xfe:
+        return unpack_from('<I', raw, offset + 1)[0], offset + 5
+    return unpack_from('<Q', raw, offset + 1)[0], offset + 9
+
+
+def parse_transaction(rawtx_hex):
+    raw = unhexlify(rawtx_hex)
+    offset = 4
+    if raw[4:6] == b'\x00\x01':
+        offset += 2
+
+    inputs = []
+    count, offset = read_varint(raw, offset)
+    for _ in range(count):
+        prev_txid = hexlify(raw[offset:offset + 32][::-1]).decode('ascii')
+        vout = unpack_from('<I', raw, offset + 32)[0]
+        script_length, offset = read_varint(raw, offset + 36)
+        offset += script_length + 4
+        inputs.append((prev_txid, vout))
+
+    outputs = []
+    count, offset = read_varint(raw, offset)
+    for _ in range(count):
+        satoshis = unpack_from('<Q', raw, offset)[0]
+        script_length, offset = read_varint(raw, offset + 8)
+        outputs.append((Decimal(satoshis) / SATOSHIS, raw[offset:offset + script_length]))
+        offset += script_length
+
+    return inputs, outputs
+
+
+def decode_output_script(script):
+    if len(script) == 25 and script[:3] == b'\x76\xa9\x14' and script[23:] == b'\x88\xac':
+        return script[3:23], TXOUT_TYPES.P2PKH
+    if len(script) == 23 and script[:2] == b'\xa9\x14' and script[22:] == b'\x87':
+        return script[2:22], TXOUT_TYPES.P2SH
+    if len(script) == 22 and script[:2] == b'\x00\x14':
+        return script[2:], TXOUT_TYPES.P2WPKH
+    if len(script) == 34 and script[:2] == b'\x00\x20':
+        return script[2:], TXOUT_TYPES.P2WSH
+    return None, None
+
+
+class FakeIndexer(object):
+    # Writes what the real indexer would for a block of our own transactions:
+    # the block, the confirmed transactions, their outputs and the spends of
+    # the outputs they consume, so the next cycle sees the chain as it is
+    def __init__(self, coin):
+        self.coin = coin
+
+    def _find_address(self, session, writers, addresses, address_string):
+        if address_string not in addresses:
+            address_id = session.query(Address.id).filter(Address.address == address_string).scalar()
+            if address_id is None:
+                address_id = primary_key(Address, writers[Address].add(writers[Address].make(address=address_string)))
+            addresses[address_string] = address_id
+        return addresses[address_string]
+
+    def index_block(self, blockhash, mined):
+        session = connectionmanager.database_session(coin=self.coin)
+        connection = session.connection()
+        connection.execute('SET FOREIGN_KEY_CHECKS=0')
+
+        writers = { model: TableWriter(connection, model) for model in (Block, Address, Transaction, TransactionOutput, TransactionInput) }
+        confirmation = Transaction.__mapper__.attrs.get('confirmation')
+        confirmation_writer = TableWriter(connection, confirmation.mapper.class_) if isinstance(confirmation, RelationshipProperty) else None
+
+        height = (session.query(sqlfunc.max(Block.height)).scalar() or 0) + 1
+        block = writers[Block].add(writers[Block].make(height=height, hash=blockhash))
+        addresses = {}
+        spends = []
+
+        for txid, rawtx_hex in mined:
+            tx = writers[Transaction].make(txid=unhexlify(txid), doublespends_id=None)
+            if confirmation_writer is not None:
+                confirmation_row = confirmation_writer.make()
+                link(Transaction.confirmation, tx, confirmation_row)
+                for column in confirmation_writer.table.columns:
+                    for foreign_key in column.foreign_keys:
+                        if foreign_key.column.table is Block.__table__:
+                            confirmation_row[column.key] = primary_key(Block, block)
+                confirmation_writer.add(confirmation_row)
+            elif isinstance(confirmation, ColumnProperty):
+                tx[confirmation.columns[0].key] = datetime.now()
+            writers[Transaction].add(tx)
+
+            inputs, outputs = parse_transaction(rawtx_hex)
+
+            for prev_txid, vout in inputs:
+                txout_id = session.query(TransactionOutput.id).join(
+                    TransactionOutput.transaction
+                ).filter(
+                    Transaction.txid == unhexlify(prev_txid),
+                    TransactionOutput.index == vout
+                ).scalar()
+                if txout_id is None:
+                    continue
+
+                spender = writers[TransactionInput].make()
+                link(TransactionOutput.spenders, { TransactionOutput.__mapper__.c['id'].key: txout_id }, spender)
+                for local, remote in TransactionInput.__mapper__.relationships.items():
+                    if remote.mapper.class_ is Transaction and remote.direction is MANYTOONE:
+                        link(getattr(TransactionInput, local), spender, tx)
+                        break
+                writers[TransactionInput].add(spender)
+                spends.append((txout_id, primary_key(TransactionInput, spender)))
+
+            for index, (amount, script) in enumerate(outputs):
+                destination_hash, txout_type = decode_output_script(script)
+                if destination_hash is None:
+                    continue
+                output = writers[TransactionOutput].make(
+                    address_id=self._find_address(session, writers, addresses, self.coin.encode_address(destination_hash, txout_type)),
+                    index=index,
+                    type_id=TXOUT_TYPES.internal_id(txout_type),
+                    amount=amount,
+                    spentby_id=None
+                )
+                link(TransactionOutput.transaction, output, tx)
+                writers[TransactionOutput].add(output)
+
+        for writer in list(writers.values()) + [ confirmation_writer ]:
+            if writer is not None:
+                writer.flush()
+
+        for txout_id, txin_id in spends:
+            session.query(TransactionOutput).filter(TransactionOutput.id == txout_id).update({ TransactionOutput.spentby_id: txin_id }, synchronize_session=False)
+
+        connection.execute('SET FOREIGN_KEY_CHECKS=1')
+        session.commit()
+        session.close()
+        return len(spends)
@@ -0,0 +1,288 @@
+import argparse
+import os
+import random
+import sys
+
+from binascii import unhexlify
+from datetime import datetime, timedelta
+from decimal import Decimal
+from hashlib import sha256
+from time import time
+
+from sqlalchemy import func as sqlfunc
+from sqlalchemy.orm import ColumnProperty, RelationshipProperty
+from sqlalchemy.orm.interfaces import MANYTOONE
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from coininfo import COINS, Coin
+from connections import connectionmanager
+from models import Account, AccountAddress, AutomaticPayment, WalletManager
+from indexer.models import Address, Block, CoinbaseInfo, Transaction, TransactionInput, TransactionOutput, TXOUT_TYPES
+
+
+BATCH_SIZE = 5000
+OUTPUTS_PER_TRANSACTION = 50
+EPOCH = datetime(2019, 1, 1)
+
+
+def synthetic_value(column):
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return None
+    if python_type is bytes:
+        return b'\x00' * (getattr(column.type, 'length', None) or 1)
+    if python_type is datetime:
+        return EPOCH
+    if python_type is Decimal:
+        return Decimal(0)
+    if python_type in (int, float, bool):
+        return python_type(0)
+    if python_type is str:
+        return ''
+    return None
+
+
+class TableWriter(object):
+    def __init__(self, connection, model, batch_size=BATCH_SIZE):
+        self.connection = connection
+        self.model = model
+        self.table = model.__table__
+        self.batch_size = batch_size
+        self.rows = []
+        self.written = 0
+
+        primary_key = list(self.table.primary_key.columns)[0]
+        self.next_id = (connection.execute(sqlfunc.max(primary_key).select()).scalar() or 0) + 1
+
+    def column(self, attribute):
+        return self.model.__mapper__.c[attribute]
+
+    def new_id(self):
+        self.next_id += 1
+        return self.next_id - 1
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+        return row
+
+    def make(self, **attributes):
+        row = { self.column(attribute).key: value for attribute, value in attributes.items() }
+        for column in self.table.columns:
+            if column.key in row:
+                continue
+            if column.primary_key:
+                row[column.key] = self.new_id()
+            elif not column.nullable and column.default is None and column.server_default is None:
+                row[column.key] = synthetic_value(column)
+        return row
+
+    def flush(self):
+        if len(self.rows) > 0:
+            self.connection.execute(self.table.insert(), self.rows)
+            self.written += len(self.rows)
+            self.rows = []
+
+
+def link(relationship_attribute, local_row, remote_row):
+    prop = relationship_attribute.property
+    for local, remote in prop.local_remote_pairs:
+        if prop.direction is MANYTOONE:
+            local_row[local.key] = remote_row[remote.key]
+        else:
+            remote_row[remote.key] = local_row[local.key]
+
+
+def primary_key(model, row):
+    return row[list(model.__table__.primary_key.columns)[0].key]
+
+
+class DatasetGenerator(object):
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.coins = [ Coin.by_ticker(ticker) for ticker in args.coins ]
+
+    def random_bytes(self, length):
+        return unhexlify('%0*x' % (2 * length, self.rng.getrandbits(8 * length)))
+
+    def encrypt_private_key(self):
+        # Account.private_key draws its IV from os.urandom, the dataset has to
+        # come out the same for the same seed
+        from Crypto.Cipher import AES
+        iv = self.random_bytes(AES.block_size)
+        return iv, AES.new(unhexlify(config.ENCRYPTION_KEY), AES.MODE_CBC, iv).encrypt(self.random_bytes(32))
+
+    def random_amount(self):
+        return Decimal(str(round(self.rng.lognormvariate(-0.7, 1.2), 8))) + Decimal('0.001')
+
+    def generate_wallet(self, connection):
+        managers = TableWriter(connection, WalletManager)
+        accounts = TableWriter(connection, Account)
+        generated = []
+
+        for manager_index in range(self.args.managers):
+            manager = managers.add(managers.make(
+                name='synthetic-%d-%d' % (self.args.seed, manager_index),
+                tokenhash=sha256(self.random_bytes(32)).digest()
+            ))
+
+            for account_index in range(self.args.accounts):
+                iv, encrypted_key = self.encrypt_private_key()
+                account = accounts.add(accounts.make(
+                    manager_id=primary_key(WalletManager, manager),
+                    user='user-%d' % account_index,
+                    iv=iv,
+                    encrypted_key=encrypted_key,
+                    pubkeyhash=self.random_bytes(20)
+                ))
+                generated.append(account)
+
+        managers.flush()
+        accounts.flush()
+        return generated
+
+    def generate_coin(self, coin, wallet_connection, coin_connection, accounts):
+        writers = { model: TableWriter(coin_connection, model) for model in (Block, Address, Transaction, TransactionOutput, TransactionInput, CoinbaseInfo) }
+        bindings = TableWriter(wallet_connection, AccountAddress)
+        autopays = TableWriter(wallet_connection, AutomaticPayment)
+
+        confirmation = Transaction.__mapper__.attrs.get('confirmation')
+        confirmation_writer = TableWriter(coin_connection, confirmation.mapper.class_) if isinstance(confirmation, RelationshipProperty) else None
+
+        blocks = []
+        for height in range(self.args.blocks):
+            blocks.append(writers[Block].add(writers[Block].make(height=height, hash=self.random_bytes(32))))
+        writers[Block].flush()
+
+        def new_transaction(confirmed=True, coinbase=False):
+            block = self.rng.choice(blocks)
+            tx = writers[Transaction].make(txid=self.random_bytes(32), doublespends_id=None)
+            if isinstance(confirmation, ColumnProperty) and not confirmed:
+                tx[confirmation.columns[0].key] = None
+
+            if confirmation_writer is not None and confirmed:
+                confirmation_row = confirmation_writer.make()
+                link(Transaction.confirmation, tx, confirmation_row)
+                for column in confirmation_writer.table.columns:
+                    for foreign_key in column.foreign_keys:
+                        if foreign_key.column.table is Block.__table__:
+                            confirmation_row[column.key] = primary_key(Block, block)
+                confirmation_writer.add(confirmation_row)
+
+            if coinbase:
+                coinbaseinfo = writers[CoinbaseInfo].make(block_id=primary_key(Block, block))
+                link(Transaction.coinbaseinfo, tx, coinbaseinfo)
+                writers[CoinbaseInfo].add(coinbaseinfo)
+            return writers[Transaction].add(tx)
+
+        def add_outputs(address, txouttype, count):
+            tx = None
+            for index in range(count):
+                if index % OUTPUTS_PER_TRANSACTION == 0:
+                    tx = new_transaction(
+                        confirmed=self.rng.random() >= self.args.unconfirmed_fraction,
+                        coinbase=self.rng.random() < self.args.coinbase_fraction
+                    )
+                output = writers[TransactionOutput].make(
+                    address_id=primary_key(Address, address),
+                    index=index % OUTPUTS_PER_TRANSACTION,
+                    type_id=TXOUT_TYPES.internal_id(txouttype),
+                    amount=self.random_amount(),
+                    spentby_id=None
+                )
+                link(TransactionOutput.transaction, output, tx)
+
+                if self.rng.random() < self.args.spent_fraction:
+                    spender = writers[TransactionInput].make()
+                    link(TransactionOutput.spenders, output, spender)
+                    spending_tx = new_transaction()
+                    for local, remote in TransactionInput.__mapper__.relationships.items():
+                        if remote.mapper.class_ is Transaction and remote.direction is MANYTOONE:
+                            link(getattr(TransactionInput, local), spender, spending_tx)
+                            break
+                    output[writers[TransactionOutput].column('spentby_id').key] = primary_key(TransactionInput, spender)
+                    writers[TransactionInput].add(spender)
+
+                writers[TransactionOutput].add(output)
+
+        payout_accounts = set(range(min(self.args.payout_addresses, len(accounts))))
+
+        for account_index, account in enumerate(accounts):
+            for address_string in coin.get_addresses_for_pubkeyhash(account[Account.__mapper__.c['pubkeyhash'].key]):
+                _, txouttype = coin.decode_address_and_type(address_string)
+                address = writers[Address].add(writers[Address].make(address=address_string))
+                bindings.add(bindings.make(
+                    account_id=primary_key(Account, account),
+                    coin=coin.ticker,
+                    address_id=primary_key(Address, address)
+                ))
+
+                utxos = self.args.payout_utxos if account_index in payout_accounts else self.rng.randint(0, 2 * self.args.utxos_per_account)
+                add_outputs(address, txouttype, utxos)
+
+            if account_index < self.args.autopays:
+                autopays.add(autopays.make(
+                    account_id=primary_key(Account, account),
+                    coin=coin.ticker,
+                    pubkeyhash=self.random_bytes(20),
+                    txout_type_id=TXOUT_TYPES.internal_id(TXOUT_TYPES.P2PKH),
+                    amount=-Decimal(self.rng.randint(0, 10)),
+                    interval=self.rng.choice([ 3600, 86400, 604800 ]),
+                    nextpayment=self.args.now + timedelta(seconds=self.rng.randint(-86400, 86400))
+                ))
+
+        for writer in list(writers.values()) + [ confirmation_writer, bindings, autopays ]:
+            if writer is not None:
+                writer.flush()
+
+        return dict([ (writer.table.name, writer.written) for writer in list(writers.values()) + [ confirmation_writer, bindings, autopays ] if writer is not None ])
+
+    def run(self):
+        wallet_connection = connectionmanager.database_session().get_bind().connect()
+        wallet_connection.execute('SET FOREIGN_KEY_CHECKS=0')
+
+        with wallet_connection.begin():
+            start_time = time()
+            accounts = self.generate_wallet(wallet_connection)
+            print('wallet: %d accounts in %.1fs' % (len(accounts), time() - start_time))
+
+        for coin in self.coins:
+            coin_connection = connectionmanager.database_session(coin=coin).get_bind().connect()
+            coin_connection.execute('SET FOREIGN_KEY_CHECKS=0')
+
+            start_time = time()
+            with wallet_connection.begin(), coin_connection.begin():
+                counts = self.generate_coin(coin, wallet_connection, coin_connection, accounts)
+            print('%s: %s in %.1fs' % (coin.ticker, ', '.join([ '%d %s' % (count, table) for table, count in sorted(counts.items()) ]), time() - start_time))
+            coin_connection.close()
+
+        wallet_connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk load deterministic synthetic data into the wallet and indexer databases')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--coins', nargs='+', default=[ coin.ticker for coin in COINS ])
+    parser.add_argument('--managers', type=int, default=1)
+    parser.add_argument('--accounts', type=int, default=100000, help='Accounts per manager')
+    parser.add_argument('--blocks', type=int, default=10000)
+    parser.add_argument('--utxos-per-account', type=int, default=5, help='Average unspent outputs per regular address')
+    parser.add_argument('--payout-addresses', type=int, default=3, help='Accounts that get --payout-utxos outputs per address')
+    parser.add_argument('--payout-utxos', type=int, default=50000)
+    parser.add_argument('--autopays', type=int, default=5000, help='Accounts with an autopay row per coin')
+    parser.add_argument('--spent-fraction', type=float, default=0.3)
+    parser.add_argument('--coinbase-fraction', type=float, default=0.05)
+    parser.add_argument('--unconfirmed-fraction', type=float, default=0.01)
+    parser.add_argument('--now', type=lambda value: datetime.strptime(value, '%Y-%m-%d %H:%M:%S'), default=EPOCH, help='Time autopayments are scheduled around, "YYYY-MM-DD HH:MM:SS" (default: %s)' % EPOCH)
+    args = parser.parse_args()
+
+    DatasetGenerator(args).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from time import time
+
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import save_results
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_TARGETS = [ 'coininfo', 'keyseeder', 'wallet', 'backgroundprocessor', 'sendjobs', 'api' ]
+
+
+def repo_modules():
+    modules = set([ filename[:-3] for filename in os.listdir(REPO_DIR) if filename.endswith('.py') ])
+    return modules | set([ 'benchmarks' ])
+
+
+def group_for(module, local_modules):
+    # Modules of this repo are reported one by one, everything else (including
+    # the indexer and coinsupport submodules) per top-level package
+    if module in local_modules:
+        return module
+    return '[%s]' % module.split('.')[0]
+
+
+def profile_imports(target):
+    original_import = builtins.__import__
+    timings = {}
+    stack = []
+
+    def timed_import(name, *args, **kwargs):
+        if name in sys.modules:
+            return original_import(name, *args, **kwargs)
+
+        start_time = time()
+        stack.append(0.0)
+        try:
+            return original_import(name, *args, **kwargs)
+        finally:
+            elapsed = time() - start_time
+            children = stack.pop()
+            if len(stack) > 0:
+                stack[-1] += elapsed
+            entry = timings.setdefault(name, [ 0.0, 0.0 ])
+            entry[0] += elapsed
+            entry[1] += elapsed - children
+
+    builtins.__import__ = timed_import
+    start_time = time()
+    try:
+        __import__(target)
+    finally:
+        builtins.__import__ = original_import
+
+    return time() - start_time, timings
+
+
+def aggregate(timings, local_modules):
+    groups = {}
+    for module, (cumulative, self_time) in timings.items():
+        group = groups.setdefault(group_for(module, local_modules), { 'self': 0.0, 'cumulative': 0.0 })
+        group['self'] += self_time
+        if group_for(module, local_modules) == module:
+            group['cumulative'] += cumulative
+    return groups
+
+
+def run_target(target):
+    start_time = time()
+    output = subprocess.check_output([ sys.executable, os.path.abspath(__file__), '--child', target ], cwd=REPO_DIR)
+    process_time = time() - start_time
+    result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+    result['process'] = process_time
+    return result
+
+
+def print_report(target, result, top):
+    print('%s: import %.3fs, process %.3fs' % (target, result['import'], result['process']))
+    print('    %-32s %10s %10s' % ('module', 'self', 'cumulative'))
+    for module, values in sorted(result['modules'].items(), key=lambda item: item[1]['self'], reverse=True)[:top]:
+        cumulative = '%10.4f' % values['cumulative'] if not module.startswith('[') else '%10s' % '-'
+        print('    %-32s %10.4f %s' % (module, values['self'], cumulative))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report the import time of entry point modules, aggregated per module of this repo and per third party package')
+    parser.add_argument('targets', nargs='*', default=DEFAULT_TARGETS, help='Modules to import, each in a fresh interpreter')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per module, the fastest run is reported')
+    parser.add_argument('--top', type=int, default=15, help='Number of modules listed per target')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--output', default=None, help='Where to save the results (default: benchmarks/results/)')
+    args = parser.parse_args()
+
+    if args.child is not None:
+        import_time, timings = profile_imports(args.child)
+        print(json.dumps({ 'import': import_time, 'modules': aggregate(timings, repo_modules()) }))
+        return
+
+    results = {}
+    for target in args.targets:
+        results[target] = min([ run_target(target) for _ in range(args.repeat) ], key=lambda result: result['process'])
+        print_report(target, results[target], args.top)
+
+    print('Results saved to %s' % save_results('importtime', results, args.output))
+
+
+if __name__ == '__main__':
+    main()
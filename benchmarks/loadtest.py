@@ -0,0 +1,327 @@
+from gevent import monkey; monkey.patch_all()
+
+import argparse
+import json
+import os
+import random
+import sys
+
+from base64 import b64encode
+from binascii import hexlify
+from hashlib import sha256
+from time import time
+
+try:
+    from httplib import HTTPConnection
+except ImportError:
+    from http.client import HTTPConnection
+
+from gevent import sleep, spawn
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from benchmarks import fakedaemon
+from benchmarks.common import percentile, save_results
+from benchmarks.fakeindexer import FakeIndexer
+from coininfo import COINS, KEYSEEDER_INFO
+from connections import connectionmanager
+from models import AUTH_TOKEN_SIZE, WalletManager
+from transaction import TransactionInput, UnsignedTransactionBuilder, Utxo
+from indexer.models import Address, TXOUT_TYPES
+
+
+DEFAULT_MIX = 'auth=2,list=1,balance=8,send=2,create=1,autopay=1'
+FUNDING_UTXOS = 200
+FUNDING_AMOUNT = 1
+BLOCK_INTERVAL = 10
+DB_SQL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'db.sql')
+
+
+class LoadTestState(object):
+    def __init__(self, host, port, token, accounts, coin):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.accounts = accounts
+        self.senders = []
+        self.coin = coin
+        self.addresses = {}
+        self.created = 0
+
+
+def load_schema():
+    # db.sql is a mysqldump of the wallet schema; the indexer tables of each coin
+    # database are created from the indexer models
+    engine = connectionmanager.database_session().get_bind()
+    with open(DB_SQL) as f:
+        for statement in f.read().split(';\n'):
+            if statement.strip() and not all([ line.startswith('--') for line in statement.strip().splitlines() ]):
+                engine.execute(statement)
+
+    for coin in COINS:
+        Address.metadata.create_all(connectionmanager.database_session(coin=coin).get_bind())
+
+
+def create_manager(name):
+    token = os.urandom(AUTH_TOKEN_SIZE)
+    db = connectionmanager.database_session()
+    manager = WalletManager()
+    manager.name = name
+    manager.tokenhash = sha256(sha256(token).digest()).digest()
+    db.add(manager)
+    db.commit()
+    return b64encode(token).decode('ascii')
+
+
+def fund_accounts(state, connection, utxos_per_account, amount):
+    # Sends need spendable outputs: every account gets a confirmed transaction
+    # paying it utxos_per_account outputs. Accounts sign with the key stored in
+    # the wallet database, so those of earlier runs can send as well
+    mined = []
+    funded = []
+    for user in state.accounts:
+        address = account_address(state, connection, user)
+        if address is None:
+            continue
+        pubkeyhash, _ = state.coin.decode_address_and_type(address)
+        address = state.coin.get_legacy_address(pubkeyhash)
+
+        tx = UnsignedTransactionBuilder(state.coin)
+        tx.add(TransactionInput(Utxo(address, os.urandom(32), 0, TXOUT_TYPES.P2PKH, amount * utxos_per_account)))
+        for _ in range(utxos_per_account):
+            tx.add_output(address, amount)
+        rawtx_hex = hexlify(bytes(tx.raw())).decode('ascii')
+        mined.append((fakedaemon.txid_for(rawtx_hex), rawtx_hex))
+        funded.append(user)
+
+    if len(mined) > 0:
+        FakeIndexer(state.coin).index_block(os.urandom(32), mined)
+    return funded
+
+
+def mine_blocks(daemon, indexer, interval):
+    # Confirms the change of earlier sends, so it can be spent again
+    while True:
+        sleep(interval)
+        mined = daemon.mine()
+        if len(mined) > 0:
+            indexer.index_block(os.urandom(32), mined)
+
+
+def request(state, connection, method, path, body=None):
+    headers = { 'Authorization': 'Bearer %s' % state.token }
+    if body is not None:
+        body = json.dumps(body)
+        headers['Content-Type'] = 'application/json'
+    connection.request(method, path, body, headers)
+    response = connection.getresponse()
+    return response.status, response.read()
+
+
+def account_address(state, connection, user):
+    if user not in state.addresses:
+        status, body = request(state, connection, 'GET', '/accounts/%s/' % user)
+        if status != 200:
+            return None
+        addresses = [ binding for binding in json.loads(body)['addresses'] if binding['coin'] == state.coin.ticker ]
+        state.addresses[user] = addresses[0]['address'] if len(addresses) > 0 else None
+    return state.addresses[user]
+
+
+def workload_auth(state, connection, rng):
+    return request(state, connection, 'GET', '/accounts/__loadtest_nonexistent__/')
+
+def workload_list(state, connection, rng):
+    return request(state, connection, 'GET', '/accounts/')
+
+def workload_balance(state, connection, rng):
+    return request(state, connection, 'GET', '/accounts/%s/' % rng.choice(state.accounts))
+
+def workload_send(state, connection, rng):
+    sender = rng.choice(state.senders)
+    receiver = rng.choice([ user for user in state.accounts if user != sender ])
+    return request(state, connection, 'POST', '/accounts/%s/send/' % sender, {
+        'destination': { 'type': 'account', 'user': receiver },
+        'coin': state.coin.ticker,
+        'amount': '0.01',
+        'priority': 'low'
+    })
+
+def workload_create(state, connection, rng):
+    state.created += 1
+    return request(state, connection, 'POST', '/accounts/', { 'user': 'loadtest-%d-%d' % (os.getpid(), state.created) })
+
+def workload_autopay(state, connection, rng):
+    user = rng.choice(state.accounts)
+    address = account_address(state, connection, rng.choice(state.accounts))
+    return request(state, connection, 'PUT', '/accounts/%s/autopayments/%s/' % (user, state.coin.ticker), [{
+        'address': address,
+        'transaction': { 'type': 'zero-balance', 'amountToKeep': 1.0 },
+        'interval': 86400
+    }])
+
+
+# Requests answering anything else count as errors and fail the run; the
+# auth workload looks up an account that does not exist on purpose
+EXPECTED_STATUS = {
+    'auth':     404
+}
+
+WORKLOADS = {
+    'auth':     workload_auth,
+    'list':     workload_list,
+    'balance':  workload_balance,
+    'send':     workload_send,
+    'create':   workload_create,
+    'autopay':  workload_autopay
+}
+
+
+def expected_response(name, status):
+    if name in EXPECTED_STATUS:
+        return status == EXPECTED_STATUS[name]
+    return status is not None and 200 <= status < 300
+
+
+def parse_mix(mix):
+    weights = {}
+    for entry in mix.split(','):
+        name, weight = entry.split('=')
+        if name not in WORKLOADS:
+            raise ValueError('Unknown workload "%s"' % name)
+        weights[name] = int(weight)
+    return weights
+
+
+def run_load(state, concurrency, duration, weights, seed):
+    samples = { name: [] for name in weights }
+    errors = { name: 0 for name in weights }
+    failures = {}
+    choices = [ name for name, weight in weights.items() for _ in range(weight) ]
+    deadline = time() + duration
+
+    def client(client_id):
+        rng = random.Random(seed + client_id)
+        connection = HTTPConnection(state.host, state.port, timeout=60)
+        while time() < deadline:
+            name = rng.choice(choices)
+            start_time = time()
+            try:
+                status, body = WORKLOADS[name](state, connection, rng)
+            except Exception as e:
+                connection.close()
+                connection = HTTPConnection(state.host, state.port, timeout=60)
+                status, body = None, str(e)
+            samples[name].append(time() - start_time)
+            if not expected_response(name, status):
+                errors[name] += 1
+                failures.setdefault(name, (status, body))
+        connection.close()
+
+    start_time = time()
+    pool = Pool(concurrency)
+    for client_id in range(concurrency):
+        pool.spawn(client, client_id)
+    pool.join()
+    elapsed = time() - start_time
+
+    for name, (status, body) in sorted(failures.items()):
+        print('First failed %s request: HTTP %s %s' % (name, status, body))
+
+    results = {}
+    for name in sorted(weights):
+        latencies = samples[name]
+        results['%s/c%d' % (name, concurrency)] = {
+            'requests': len(latencies),
+            'errors': errors[name],
+            'throughput': len(latencies) / elapsed,
+            'p50': percentile(latencies, 0.5),
+            'p95': percentile(latencies, 0.95),
+            'p99': percentile(latencies, 0.99)
+        }
+    return results
+
+
+def print_results(results):
+    print('%-16s %8s %7s %10s %10s %10s %10s' % ('route', 'requests', 'errors', 'req/s', 'p50', 'p95', 'p99'))
+    for case, values in sorted(results.items()):
+        latencies = tuple([ '%.4f' % values[key] if values[key] is not None else '-' for key in ('p50', 'p95', 'p99') ])
+        print('%-16s %8d %7d %10.1f %10s %10s %10s' % ((case, values['requests'], values['errors'], values['throughput']) + latencies))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the wallet API against local database and fake coin daemons')
+    parser.add_argument('--database-host', default=config.DATABASE_HOST, help='Database server holding the wallet and coin databases')
+    parser.add_argument('--setup', action='store_true', help='Create the wallet and indexer schemas and a load test manager first')
+    parser.add_argument('--token', default=None, help='Base64 API token of an existing manager (instead of --setup)')
+    parser.add_argument('--accounts', type=int, default=20, help='Number of accounts to create or use')
+    parser.add_argument('--coin', default=COINS[0].ticker, help='Coin used for send and autopay workloads')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[ 1, 8, 32 ], help='Concurrent clients per run')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds per concurrency level')
+    parser.add_argument('--funding-utxos', type=int, default=FUNDING_UTXOS, help='Confirmed outputs paid to every account before the send workload')
+    parser.add_argument('--block-interval', type=float, default=BLOCK_INTERVAL, help='Seconds between blocks confirming the sends of the run')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Workload weights, e.g. "%s"' % DEFAULT_MIX)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help='Where to save the results (default: benchmarks/results/)')
+    args = parser.parse_args()
+
+    config.DATABASE_HOST = args.database_host
+    daemons = fakedaemon.serve_for_coins(COINS + [ KEYSEEDER_INFO ])
+
+    from api import webapp
+    from coininfo import Coin
+
+    server = WSGIServer(('127.0.0.1', 0), webapp, log=None)
+    server.start()
+
+    if args.setup:
+        load_schema()
+        token = create_manager('loadtest-%d' % os.getpid())
+    elif args.token is not None:
+        token = args.token
+    else:
+        parser.error('Either --setup or --token is required')
+
+    state = LoadTestState('127.0.0.1', server.server_port, token, [], Coin.by_ticker(args.coin))
+
+    connection = HTTPConnection(state.host, state.port)
+    status, body = request(state, connection, 'GET', '/accounts/')
+    existing = [ account['user'] for account in json.loads(body) ] if status == 200 else []
+    state.accounts = existing[:args.accounts]
+    while len(state.accounts) < args.accounts:
+        user = 'loadtest-account-%d' % len(state.accounts)
+        status, _ = request(state, connection, 'POST', '/accounts/', { 'user': user })
+        if status != 200:
+            raise Exception('Unable to create load test account %s (HTTP %d)' % (user, status))
+        state.accounts.append(user)
+
+    weights = parse_mix(args.mix)
+    daemon = daemons[state.coin.name]
+    if 'send' in weights:
+        state.senders = fund_accounts(state, connection, args.funding_utxos, FUNDING_AMOUNT)
+        if len(state.senders) < 2:
+            parser.error('The send workload needs at least two accounts with an address for %s' % state.coin.ticker)
+    connection.close()
+
+    miner = spawn(mine_blocks, daemon, FakeIndexer(state.coin), args.block_interval)
+
+    results = {}
+    for concurrency in args.concurrency:
+        run_results = run_load(state, concurrency, args.duration, weights, args.seed)
+        print_results(run_results)
+        results.update(run_results)
+
+    miner.kill()
+    print('Results saved to %s' % save_results('loadtest', results, args.output))
+    server.stop()
+
+    errors = sum([ values['errors'] for values in results.values() ])
+    if errors > 0:
+        sys.exit('%d requests did not get the expected response' % errors)
+
+
+if __name__ == '__main__':
+    main()
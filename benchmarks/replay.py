@@ -0,0 +1,222 @@
+from gevent import monkey; monkey.patch_all()
+
+import argparse
+import json
+import os
+import random
+import sys
+
+from binascii import unhexlify
+from datetime import datetime, timedelta
+from time import time
+
+from sqlalchemy import func as sqlfunc
+from sqlalchemy.orm import RelationshipProperty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+import backgroundprocessor
+from benchmarks import fakedaemon
+from benchmarks.common import percentile, save_results
+from benchmarks.fakeindexer import FakeIndexer
+from coininfo import COINS, Coin
+from connections import connectionmanager
+from models import AutomaticPayment, PendingSpend
+from wallet import MIN_CONSOLIDATION_UTXOS, MAX_CONSOLIDATION_UTXOS
+
+from indexer.models import Address, Block, Transaction, TransactionInput, TransactionOutput
+
+
+class ReplayStats(object):
+    def __init__(self):
+        self.blocks = 0
+        self.outcomes = {}
+        self.cycle_times = []
+        self.consolidations = 0
+        self.autopayments = 0
+        self.first_time = None
+        self.last_time = None
+
+    def add(self, event_time, outcome, work, cycle_time):
+        self.blocks += 1
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        if self.first_time is None:
+            self.first_time = event_time
+        self.last_time = event_time
+
+        if work is not None:
+            consolidations, autopayments = work
+            self.consolidations += consolidations
+            self.autopayments += autopayments
+            self.cycle_times.append(cycle_time)
+
+    def __iter__(self):
+        hours = max((self.last_time - self.first_time) / 3600.0, 1.0 / 3600) if self.first_time is not None else None
+        yield 'blocks', self.blocks
+        yield 'cycles', self.outcomes.get(backgroundprocessor.CYCLE_RAN, 0)
+        yield 'skipped_too_soon', self.outcomes.get(backgroundprocessor.CYCLE_TOO_SOON, 0)
+        yield 'throttled_mempool_full', self.outcomes.get(backgroundprocessor.CYCLE_MEMPOOL_FULL, 0)
+        yield 'consolidations', self.consolidations
+        yield 'autopayments', self.autopayments
+        yield 'consolidations_per_hour', self.consolidations / hours if hours is not None else None
+        yield 'autopayments_per_hour', self.autopayments / hours if hours is not None else None
+        yield 'cycle_time_mean', sum(self.cycle_times) / len(self.cycle_times) if len(self.cycle_times) > 0 else None
+        yield 'cycle_time_p95', percentile(self.cycle_times, 0.95)
+        yield 'cycle_time_max', max(self.cycle_times) if len(self.cycle_times) > 0 else None
+
+
+def indexer_models():
+    models = [ Block, Address, Transaction, TransactionOutput, TransactionInput ]
+    confirmation = Transaction.__mapper__.attrs.get('confirmation')
+    if isinstance(confirmation, RelationshipProperty):
+        models.append(confirmation.mapper.class_)
+    return models
+
+
+def max_id(session, model):
+    primary_key = list(model.__table__.primary_key.columns)[0]
+    return session.query(sqlfunc.max(primary_key)).scalar() or 0
+
+
+class DatasetSnapshot(object):
+    # The background processor commits through sessions of its own, so a replay
+    # can not run in a single transaction that is rolled back afterwards. What
+    # it adds or changes is recorded up front instead and undone by restore()
+    def __init__(self, coins):
+        self.coins = coins
+        self.indexer_ids = {}
+
+        for coin in coins:
+            session = connectionmanager.database_session(coin=coin)
+            self.indexer_ids[coin.ticker] = { model: max_id(session, model) for model in indexer_models() }
+            session.close()
+
+        session = connectionmanager.database_session()
+        self.pendingspend_id = max_id(session, PendingSpend)
+        self.autopayments = session.query(AutomaticPayment.id, AutomaticPayment.interval, AutomaticPayment.nextpayment).all()
+        session.close()
+
+    def restore(self):
+        for coin in self.coins:
+            ids = self.indexer_ids[coin.ticker]
+            session = connectionmanager.database_session(coin=coin)
+            session.execute('SET FOREIGN_KEY_CHECKS=0')
+            session.query(TransactionOutput).filter(
+                TransactionOutput.spentby_id > ids[TransactionInput]
+            ).update({ TransactionOutput.spentby_id: None }, synchronize_session=False)
+            for model, last_id in ids.items():
+                primary_key = list(model.__table__.primary_key.columns)[0]
+                session.execute(model.__table__.delete().where(primary_key > last_id))
+            session.execute('SET FOREIGN_KEY_CHECKS=1')
+            session.commit()
+            session.close()
+
+        session = connectionmanager.database_session()
+        session.query(PendingSpend).filter(PendingSpend.id > self.pendingspend_id).delete(synchronize_session=False)
+        for autopayment_id, interval, nextpayment in self.autopayments:
+            session.query(AutomaticPayment).filter(AutomaticPayment.id == autopayment_id).update({
+                AutomaticPayment.interval: interval,
+                AutomaticPayment.nextpayment: nextpayment
+            }, synchronize_session=False)
+        session.commit()
+        session.close()
+
+
+def load_recording(path):
+    with open(path) as f:
+        return [ json.loads(line) for line in f if line.strip() ]
+
+
+def synthesize(coins, blocks, block_interval, mempool_mean, seed):
+    rng = random.Random(seed)
+    start_time = (datetime.utcnow() - datetime.utcfromtimestamp(0)).total_seconds()
+    events = []
+
+    for coin in coins:
+        event_time = start_time
+        for _ in range(blocks):
+            event_time += rng.expovariate(1.0 / block_interval)
+            events.append({
+                'coin': coin.ticker,
+                'time': event_time,
+                'blockhash': '%064x' % rng.getrandbits(256),
+                'mempool': int(rng.expovariate(1.0 / mempool_mean)) if mempool_mean > 0 else 0
+            })
+
+    return sorted(events, key=lambda event: event['time'])
+
+
+def replay(events, args):
+    daemons = fakedaemon.serve_for_coins(COINS)
+    indexers = { coin.ticker: FakeIndexer(coin) for coin in COINS }
+    states = { coin.ticker: backgroundprocessor.CoinState(coin, interval=timedelta(seconds=args.interval)) for coin in COINS }
+    stats = { coin.ticker: ReplayStats() for coin in COINS }
+
+    for event in events:
+        coin = Coin.by_ticker(event['coin'])
+        daemon = daemons[coin.name]
+        blockhash = unhexlify(event['blockhash'])
+
+        # Our mined transactions have to show up in the indexer as well, or
+        # the next cycle would select their spent inputs again
+        indexers[coin.ticker].index_block(blockhash, daemon.mine(args.block_capacity))
+        daemon.external_mempool = event['mempool']
+
+        session = connectionmanager.database_session(coin=coin)
+        start_time = time()
+        outcome, work = backgroundprocessor.process_new_block(
+            coin, states[coin.ticker], session, blockhash,
+            now=datetime.utcfromtimestamp(event['time']),
+            max_queued_txs=args.max_queued_txs,
+            min_utxos=args.min_consolidation_utxos,
+            max_utxos=args.max_consolidation_utxos,
+            wait_until_seen_on_network=False
+        )
+        stats[coin.ticker].add(event['time'], outcome, work, time() - start_time)
+        session.close()
+
+    return { ticker: dict(coin_stats) for ticker, coin_stats in stats.items() if coin_stats.blocks > 0 }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay recorded or synthetic blocks through the background processor against a fake coin daemon')
+    parser.add_argument('--database-host', default=config.DATABASE_HOST, help='Database server holding a wallet and indexer dataset (see generate_dataset.py)')
+    parser.add_argument('--recording', default=None, help='Block sequence recorded with backgroundprocessor.py --record')
+    parser.add_argument('--coins', nargs='+', default=[ coin.ticker for coin in COINS ], help='Coins to synthesize blocks for')
+    parser.add_argument('--blocks', type=int, default=500, help='Synthetic blocks per coin')
+    parser.add_argument('--block-interval', type=float, default=40.0, help='Mean seconds between synthetic blocks')
+    parser.add_argument('--mempool-mean', type=float, default=2.0, help='Mean number of foreign transactions in the mempool')
+    parser.add_argument('--block-capacity', type=int, default=None, help='Own transactions mined per block (default: all)')
+    parser.add_argument('--interval', type=float, default=backgroundprocessor.CHECK_INTERVAL.total_seconds(), help='Minimum seconds between background cycles per coin')
+    parser.add_argument('--max-queued-txs', type=int, default=backgroundprocessor.MAX_QUEUED_TXS)
+    parser.add_argument('--min-consolidation-utxos', type=int, default=MIN_CONSOLIDATION_UTXOS)
+    parser.add_argument('--max-consolidation-utxos', type=int, default=MAX_CONSOLIDATION_UTXOS)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help='Where to save the results (default: benchmarks/results/)')
+    args = parser.parse_args()
+
+    config.DATABASE_HOST = args.database_host
+
+    if args.recording is not None:
+        events = load_recording(args.recording)
+    else:
+        events = synthesize([ Coin.by_ticker(ticker) for ticker in args.coins ], args.blocks, args.block_interval, args.mempool_mean, args.seed)
+
+    # Replaying broadcasts autopayments and consolidations into the dataset,
+    # it is put back as it was so runs stay comparable
+    snapshot = DatasetSnapshot(COINS)
+    try:
+        results = replay(events, args)
+    finally:
+        snapshot.restore()
+    for ticker, coin_stats in sorted(results.items()):
+        print('%s:' % ticker)
+        for key, value in coin_stats.items():
+            print('    %-26s %s' % (key, value))
+
+    print('Results saved to %s' % save_results('replay', results, args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import argparse
+import os
+import random
+import sys
+
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.common import compare_results, load_results, measure, save_results
+from coininfo import COINS, Coin
+from transaction import DUST_LIMIT, FEERATE_NETWORK, NotEnoughCoinsException, UnsignedTransactionBuilder, TransactionInput, Utxo
+from indexer.models import TXOUT_TYPES
+
+
+DEFAULT_SIZES = [ 10, 100, 650, 5000, 50000 ]
+DEFAULT_TARGET = Decimal('5')
+SEGWIT_FRACTION = 0.5
+
+
+def random_hash(rng, length=20):
+    return bytes(bytearray([ rng.randint(0, 255) for _ in range(length) ]))
+
+
+def random_amount(rng):
+    # Pool payouts: mostly small amounts with a long tail of larger ones
+    amount = Decimal(str(round(rng.lognormvariate(-0.7, 1.2), 8)))
+    return max(amount, DUST_LIMIT * 2)
+
+
+def make_utxos(coin, count, seed, segwit_fraction=SEGWIT_FRACTION):
+    rng = random.Random(seed)
+    pubkeyhash = random_hash(rng)
+    addresses = {
+        TXOUT_TYPES.P2PKH: coin.get_legacy_address(pubkeyhash),
+        TXOUT_TYPES.P2WPKH: coin.get_segwit_address(pubkeyhash)
+    }
+
+    utxos = []
+    for _ in range(count):
+        txouttype = TXOUT_TYPES.P2WPKH if addresses[TXOUT_TYPES.P2WPKH] is not None and rng.random() < segwit_fraction else TXOUT_TYPES.P2PKH
+        utxos.append(Utxo(addresses[txouttype], random_hash(rng, 32), rng.randint(0, 3), txouttype, random_amount(rng)))
+    return utxos, addresses[TXOUT_TYPES.P2PKH]
+
+
+def builder_with_inputs(coin, utxos):
+    tx = UnsignedTransactionBuilder(coin, feerate=FEERATE_NETWORK)
+    for utxo in utxos:
+        tx.add(TransactionInput(utxo))
+    return tx
+
+
+def summarize(tx):
+    return {
+        'inputs': len(tx.inputs),
+        'outputs': len(tx.outputs),
+        'fee': str(tx.current_fee())
+    }
+
+
+def bench_fund_transaction(coin, utxos, address, target):
+    def run():
+        tx = UnsignedTransactionBuilder(coin, feerate=FEERATE_NETWORK)
+        tx.add_output(address, target)
+        try:
+            tx.fund_transaction(list(utxos), address)
+        except NotEnoughCoinsException:
+            return { 'inputs': len(tx.inputs), 'outputs': len(tx.outputs), 'fee': None }
+        return summarize(tx)
+    return run
+
+
+def bench_add_return_output(coin, utxos, address):
+    def run():
+        tx = builder_with_inputs(coin, utxos)
+        tx.add_return_output(address)
+        return summarize(tx)
+    return run
+
+
+def bench_estimated_size(coin, utxos):
+    tx = builder_with_inputs(coin, utxos)
+
+    def run():
+        return { 'vsize': tx.estimated_size(), 'inputs': len(tx.inputs) }
+    return run
+
+
+def bench_raw(coin, utxos):
+    tx = builder_with_inputs(coin, utxos)
+
+    def run():
+        return { 'size': len(tx.raw()), 'inputs': len(tx.inputs) }
+    return run
+
+
+def run_benchmarks(coin, sizes, target, repeat, seed):
+    results = {}
+
+    for size in sizes:
+        utxos, address = make_utxos(coin, size, seed)
+        cases = [
+            ('fund_transaction', bench_fund_transaction(coin, utxos, address, target)),
+            ('add_return_output', bench_add_return_output(coin, utxos, address)),
+            ('estimated_size', bench_estimated_size(coin, utxos)),
+            ('raw', bench_raw(coin, utxos))
+        ]
+
+        for name, func in cases:
+            case = '%s/%d' % (name, size)
+            outcome, timing = measure(func, repeat=repeat)
+            timing.update(outcome)
+            results[case] = timing
+            print('%-28s best %10.6fs  mean %10.6fs  peak %10s B  %s' % (case, timing['best'], timing['mean'], timing['peak_allocated'], outcome))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark transaction building and coin selection on synthetic UTXO sets')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='UTXO set sizes to benchmark')
+    parser.add_argument('--target', type=Decimal, default=DEFAULT_TARGET, help='Payment amount used for coin selection')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per case')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the synthetic UTXO sets')
+    parser.add_argument('--coin', default=COINS[0].ticker, help='Coin whose address formats are used')
+    parser.add_argument('--output', default=None, help='Where to save the results (default: benchmarks/results/)')
+    parser.add_argument('--compare', default=None, help='Earlier results file to compare against')
+    args = parser.parse_args()
+
+    results = run_benchmarks(Coin.by_ticker(args.coin), args.sizes, args.target, args.repeat, args.seed)
+    print('Results saved to %s' % save_results('txbuilder', results, args.output))
+
+    if args.compare is not None:
+        regressions = compare_results(load_results(args.compare), results)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
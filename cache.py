@@ -0,0 +1,64 @@
+from collections import OrderedDict
+from time import time
+
+
+class _Missing(object): pass
+Missing = _Missing()
+
+
+class LRUCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            return default
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get_or_compute(self, key, compute_func):
+        value = self.get(key, Missing)
+        if value is Missing:
+            value = compute_func()
+            self.put(key, value)
+        return value
+
+    def invalidate(self, key=Missing):
+        if key is Missing:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+
+
+class TimedCache(LRUCache):
+    def __init__(self, max_size, ttl):
+        super(TimedCache, self).__init__(max_size)
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        entry = super(TimedCache, self).get(key, Missing)
+        if entry is Missing:
+            return default
+        expires, value = entry
+        if expires < time():
+            self.invalidate(key)
+            return default
+        return value
+
+    def put(self, key, value):
+        super(TimedCache, self).put(key, (time() + self.ttl, value))
@@ -1,12 +1,18 @@
 from binascii import hexlify
 
-from coinsupport.segwit import get_converter_factory_for_address_type
 from coinsupport.addresscodecs import decode_base58_address, encode_base58_address, decode_bech32_address, encode_bech32_address, encode_privkey
 
 import config
+from cache import LRUCache
 from indexer.models import Block, TXOUT_TYPES
 
 
+ADDRESS_CACHE_SIZE = 65536
+
+PROBE_HASH_LOW = b'\x00' * 20
+PROBE_HASH_HIGH = b'\xff' * 20
+
+
 class CoinNotDefinedException(Exception):
     pass
 
@@ -15,10 +21,84 @@ class InvalidTransactionOutputType(Exception):
     pass
 
 
+def _common_prefix(a, b):
+    length = 0
+    while length < min(len(a), len(b)) and a[length] == b[length]:
+        length += 1
+    return a[:length]
+
+
+class AddressCodec(object):
+    def __init__(self, coin, cache_size=ADDRESS_CACHE_SIZE):
+        self.coin = coin
+        self.decode_cache = LRUCache(cache_size)
+        self.encode_cache = LRUCache(cache_size)
+        self._decoders = None
+
+    def _base58_decoder(self, version):
+        def decode(address):
+            _, hash = decode_base58_address(address, verify_version=version)
+            return hash
+        return decode
+
+    def _segwit_decoder(self, address):
+        _, pubkeyhash = self.coin.segwit_converter.decode_address(address)
+        return pubkeyhash
+
+    @property
+    def decoders(self):
+        # Every valid address of a given type starts with the common prefix of the
+        # addresses encoded from the lowest and highest possible hash, which lets
+        # us select the decoder up front instead of trying them all in turn.
+        if self._decoders is None:
+            decoders = [
+                (TXOUT_TYPES.P2PKH, self._base58_decoder(self.coin.address_version)),
+                (TXOUT_TYPES.P2SH, self._base58_decoder(self.coin.p2sh_address_version))
+            ]
+            if self.coin.segwit_converter is not None:
+                decoders.append((TXOUT_TYPES.P2WPKH, self._segwit_decoder))
+
+            self._decoders = [
+                (_common_prefix(self._encode(PROBE_HASH_LOW, txout_type), self._encode(PROBE_HASH_HIGH, txout_type)).lower(), txout_type, decoder)
+                for txout_type, decoder in decoders
+            ]
+        return self._decoders
+
+    def _encode(self, hash, txout_type):
+        if txout_type == TXOUT_TYPES.P2PKH:
+            return encode_base58_address(self.coin.address_version, hash)
+        if txout_type == TXOUT_TYPES.P2WPKH:
+            if self.coin.segwit_converter is not None:
+                return self.coin.segwit_converter.encode_segwit_address(hash)
+            raise InvalidTransactionOutputType('Cannot encode hash "%s" to p2wpkh address: Segwit not enabled on network for %s' % (hexlify(hash), self.coin.ticker))
+        if txout_type == TXOUT_TYPES.P2SH:
+            return encode_base58_address(self.coin.p2sh_address_version, hash)
+        raise NotImplementedError('Output type %s not supported' % txout_type)
+
+    def _decode(self, address):
+        lowercase_address = address.lower()
+        for prefix, txout_type, decoder in self.decoders:
+            if not lowercase_address.startswith(prefix):
+                continue
+            try:
+                return decoder(address), txout_type
+            except ValueError:
+                pass
+        return None, None
+
+    def encode(self, hash, txout_type):
+        return self.encode_cache.get_or_compute((hash, txout_type), lambda: self._encode(hash, txout_type))
+
+    def decode(self, address):
+        return self.decode_cache.get_or_compute(address, lambda: self._decode(address))
+
+
 class Coin(object):
     coins = []
+    coins_by_name = {}
+    coins_by_ticker = {}
 
-    def __init__(self, name, ticker, database_name, rpc_host, rpc_port, address_version, p2sh_address_version, privkey_version, segwit_converter, allow_tx_subsidy, register=True):
+    def __init__(self, name, ticker, database_name, rpc_host, rpc_port, address_version, p2sh_address_version, privkey_version, segwit_converter, allow_tx_subsidy, register=True, segwit_info=None):
         self.name = name
         self.ticker = ticker
         self.db_table = database_name
@@ -27,27 +107,41 @@ class Coin(object):
         self.address_version = address_version
         self.p2sh_address_version = p2sh_address_version
         self.privkey_version = privkey_version
-        self.segwit_converter = segwit_converter
         self.allow_tx_subsidy = allow_tx_subsidy
 
-        if self.segwit_converter is not None:
-            self.segwit_converter.parent = self
+        # The segwit converter is only built from segwit_info when first used
+        self._segwit_info = segwit_info
+        self._segwit_converter = segwit_converter
+        if self._segwit_converter is not None:
+            self._segwit_converter.parent = self
+
+        self.address_codec = AddressCodec(self)
 
         if register:
             self.coins.append(self)
+            self.coins_by_name[self.name] = self
+            if self.ticker is not None:
+                self.coins_by_ticker[self.ticker.lower()] = self
+
+    @property
+    def segwit_converter(self):
+        if self._segwit_converter is None and self._segwit_info is not None:
+            self._segwit_converter = parse_coin_segwit_info(self._segwit_info)
+            self._segwit_converter.parent = self
+        return self._segwit_converter
 
     @property
     def has_separate_segwit_address(self):
         return self.segwit_converter is not None and not self.segwit_converter.receive_only
 
     def get_legacy_address(self, pubkeyhash):
-        return encode_base58_address(self.address_version, pubkeyhash)
+        return self.address_codec.encode(pubkeyhash, TXOUT_TYPES.P2PKH)
 
     def get_segwit_address(self, pubkeyhash):
-        return self.segwit_converter.encode_segwit_address(pubkeyhash) if self.segwit_converter is not None else None
+        return self.address_codec.encode(pubkeyhash, TXOUT_TYPES.P2WPKH) if self.segwit_converter is not None else None
 
     def get_p2sh_address(self, scripthash):
-        return encode_base58_address(self.p2sh_address_version, scripthash)
+        return self.address_codec.encode(scripthash, TXOUT_TYPES.P2SH)
 
     def get_addresses_for_pubkeyhash(self, pubkeyhash):
         addresses = [ self.get_legacy_address(pubkeyhash) ]
@@ -58,7 +152,7 @@ class Coin(object):
     def current_coinbase_confirmation_height(self, dbsession=None):
         if dbsession is None:
             from connections import connectionmanager
-            dbsession = connectionmanager.database_session(coin=self)
+            dbsession = connectionmanager.database_session(coin=self, readonly=True)
         return dbsession.query(Block.height).order_by(Block.height.desc()).first()[0] - 100
 
     def get_default_receive_address(self, pubkeyhash):
@@ -70,37 +164,10 @@ class Coin(object):
         return pubkeyhash is not None
 
     def decode_address_and_type(self, address):
-        try:
-            _, pubkeyhash = decode_base58_address(address, verify_version=self.address_version)
-            return pubkeyhash, TXOUT_TYPES.P2PKH
-        except ValueError:
-            pass
-
-        try:
-            _, scripthash = decode_base58_address(address, verify_version=self.p2sh_address_version)
-            return scripthash, TXOUT_TYPES.P2SH
-        except ValueError:
-            pass
-
-        try:
-            if self.segwit_converter is not None:
-                _, pubkeyhash = self.segwit_converter.decode_address(address)
-                return pubkeyhash, TXOUT_TYPES.P2WPKH
-        except ValueError:
-            pass
-
-        return None, None
+        return self.address_codec.decode(address)
 
     def encode_address(self, hash, txout_type):
-        if txout_type == TXOUT_TYPES.P2PKH:
-            return self.get_legacy_address(hash)
-        if txout_type == TXOUT_TYPES.P2WPKH:
-            if self.segwit_converter is not None:
-                return self.get_segwit_address(hash)
-            raise InvalidTransactionOutputType('Cannot encode hash "%s" to p2wpkh address: Segwit not enabled on network for %s' % (hexlify(hash), self.ticker))
-        if txout_type == TXOUT_TYPES.P2SH:
-            return self.get_p2sh_address(hash)
-        raise NotImplementedError('Output type %s not supported' % txout_type)
+        return self.address_codec.encode(hash, txout_type)
 
     def encode_private_key(self, raw_privkey):
         return encode_privkey(self.privkey_version, raw_privkey)
@@ -114,14 +181,22 @@ class Coin(object):
 
     @classmethod
     def by_name(cls, name):
-        return cls.get_by_filter(name, lambda coin: coin.name == name)
+        try:
+            return cls.coins_by_name[name]
+        except KeyError:
+            raise CoinNotDefinedException(name)
 
     @classmethod
     def by_ticker(cls, ticker):
-        return cls.get_by_filter(ticker, lambda coin: coin.ticker.lower() == ticker.lower())
+        try:
+            return cls.coins_by_ticker[ticker.lower()]
+        except (KeyError, AttributeError):
+            raise CoinNotDefinedException(ticker)
 
 
 def parse_coin_segwit_info(segwit_info):
+    from coinsupport.segwit import get_converter_factory_for_address_type
+
     if segwit_info is None:
         return None
     if 'addresstype' not in segwit_info:
@@ -139,9 +214,10 @@ def make_coin(info, register=True):
         address_version=info['address_version'],
         p2sh_address_version=info['p2sh_address_version'],
         privkey_version=info['privkey_version'],
-        segwit_converter=parse_coin_segwit_info(info['segwit_info']),
+        segwit_converter=None,
         allow_tx_subsidy=info['allow_tx_subsidy'],
-        register=register
+        register=register,
+        segwit_info=info['segwit_info']
     )
 
 COINS = [ make_coin(info) for info in config.COINS ]
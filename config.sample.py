@@ -40,6 +40,11 @@ DATABASE_CREDENTIALS    = ('wallet', 'databasepassword')
 COINDAEMON_CREDENTIALS  = ('rpc', 'rpcpassword')
 KEYSEEDER_CREDENTIALS   = ('rpc', 'rpcpassword')
 
+# Read-only queries go to these hosts (per database name) when they lag at most
+# DATABASE_REPLICA_MAX_LAG seconds behind the primary, e.g. { 'wallets': [ 'mariadb-replica' ] }
+DATABASE_REPLICAS = {}
+DATABASE_REPLICA_MAX_LAG = 5
+
 
 COINS = [ GRLC, TUX, TGRLC ]
 
@@ -48,3 +53,29 @@ API_ENDPOINT = ''
 INDEXER_API_ENDPOINT = ''
 INDEXER_ADDRESS_API_PATH = '/address'
 INDEXER_TRANSACTION_API_PATH = '/transactions'
+
+
+API_HOST = '0.0.0.0'
+API_PORT = 8080
+API_WORKERS = 4
+# API worker n serves its metrics on API_METRICS_PORT + n, None disables them
+API_METRICS_PORT = 9102
+
+BACKGROUNDPROCESSOR_METRICS_PORT = 9101
+SEND_JOB_WORKERS = 4
+PENDING_SPEND_TTL = 3600
+WEBHOOK_WORKERS = 8
+WEBHOOK_TIMEOUT = 10
+# Allow webhooks to loopback and private network hosts, for development only
+WEBHOOK_ALLOW_PRIVATE_HOSTS = False
+
+ADMISSION_QUEUE_TIMEOUT = 30
+ADMISSION_LIMITS = {
+    'send':             { 'concurrency': 4, 'per_manager': 2, 'queue': 32, 'rate': 5, 'burst': 20 },
+    'quote':            { 'concurrency': 8, 'per_manager': 4, 'queue': 32, 'rate': 10, 'burst': 40 },
+    'create_account':   { 'concurrency': 2, 'per_manager': 1, 'queue': 32, 'rate': 2, 'burst': 10 }
+}
+
+SQL_SLOW_QUERY_THRESHOLD = 0.5
+SQL_SLOW_QUERY_LOG = None
+SQL_REPEATED_QUERY_THRESHOLD = 10
@@ -1,38 +1,143 @@
-from sqlalchemy import create_engine
+import random
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import NullPool
 
+from time import time
+
 from coinsupport import Daemon
 
 import config
 from coininfo import KEYSEEDER_INFO
+from metrics import DB_CONNECTIONS, DB_CONNECTIONS_IN_USE, DB_QUERY_DURATION, DB_SESSIONS, RPC_CALL_DURATION, RPC_CALL_FAILURES
+from sqlprofiler import profiler
+
+
+DATABASE_REPLICAS = getattr(config, 'DATABASE_REPLICAS', {})
+DATABASE_REPLICA_MAX_LAG = getattr(config, 'DATABASE_REPLICA_MAX_LAG', 5)
+REPLICA_CHECK_INTERVAL = 5
+
+
+class InstrumentedDaemon(object):
+    def __init__(self, daemon, name):
+        self._daemon = daemon
+        self._name = name
+
+    def __getattr__(self, method):
+        call = getattr(self._daemon, method)
+        if not callable(call):
+            return call
+
+        def instrumented_call(*args, **kwargs):
+            start_time = time()
+            try:
+                return call(*args, **kwargs)
+            except Exception:
+                RPC_CALL_FAILURES.inc(coin=self._name, method=method)
+                raise
+            finally:
+                RPC_CALL_DURATION.observe(time() - start_time, coin=self._name, method=method)
+        return instrumented_call
+
+
+def instrument_engine(engine, database_name):
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        DB_CONNECTIONS.inc(database=database_name)
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        DB_CONNECTIONS_IN_USE.inc(database=database_name)
+
+    @event.listens_for(engine, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        DB_CONNECTIONS_IN_USE.dec(database=database_name)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        context._query_start_time = time()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        duration = time() - context._query_start_time
+        DB_QUERY_DURATION.observe(duration, database=database_name)
+        profiler.record(database_name, statement, parameters, duration)
+
+    return engine
+
+
+class Replica(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.lag = None
+        self.lastcheck = 0
+
+    def current_lag(self):
+        if time() - self.lastcheck > REPLICA_CHECK_INTERVAL:
+            self.lastcheck = time()
+            try:
+                result = self.engine.execute('SHOW SLAVE STATUS')
+                columns = result.keys()
+                status = result.first()
+                self.lag = dict(zip(columns, status))['Seconds_Behind_Master'] if status is not None else None
+            except Exception as e:
+                print('Replication status check failed: %s' % e)
+                self.lag = None
+        return self.lag
 
 
 class ConnectionManager(object):
     db_engines = {}
+    db_replicas = {}
 
     def __init__(self):
         self.sql_debug = False
 
     @staticmethod
-    def database_url(database_name):
-        return '%s://%s@%s/%s' % (config.DATABASE_PROTOCOL, ':'.join(config.DATABASE_CREDENTIALS), config.DATABASE_HOST, database_name)
+    def database_url(database_name, host=None):
+        return '%s://%s@%s/%s' % (config.DATABASE_PROTOCOL, ':'.join(config.DATABASE_CREDENTIALS), host if host is not None else config.DATABASE_HOST, database_name)
 
-    def database_session(self, coin=None):
+    def _create_engine(self, database_name, host=None, label=None):
+        return instrument_engine(create_engine(self.database_url(database_name, host), connect_args={'connect_timeout': 30}, poolclass=NullPool, encoding='utf8', echo=self.sql_debug), label if label is not None else database_name)
+
+    def replica_engine(self, database_name, max_lag=DATABASE_REPLICA_MAX_LAG):
+        if not database_name in self.db_replicas:
+            self.db_replicas[database_name] = [
+                Replica(self._create_engine(database_name, host, label='%s@%s' % (database_name, host)))
+                for host in DATABASE_REPLICAS.get(database_name, [])
+            ]
+
+        # Replicas that are unreachable, not replicating or too far behind are skipped
+        replicas = [ replica for replica in self.db_replicas[database_name] if replica.current_lag() is not None and replica.current_lag() <= max_lag ]
+        return random.choice(replicas).engine if len(replicas) > 0 else None
+
+    def database_session(self, coin=None, readonly=False, max_lag=DATABASE_REPLICA_MAX_LAG):
+        # Read-only sessions are served by a replica when one is within max_lag
+        # seconds of the primary; everything that writes, or has to see earlier
+        # writes, must use the primary
         database_name = config.DATABASE_WALLET_DB if coin is None else coin.db_table
-        if not database_name in self.db_engines:
-            self.db_engines[database_name] = create_engine(self.database_url(database_name), connect_args={'connect_timeout': 30}, poolclass=NullPool, encoding='utf8', echo=self.sql_debug)
-        return sessionmaker(self.db_engines[database_name])()
+        engine = self.replica_engine(database_name, max_lag) if readonly else None
+
+        if engine is None:
+            if not database_name in self.db_engines:
+                self.db_engines[database_name] = self._create_engine(database_name)
+            engine = self.db_engines[database_name]
+
+        DB_SESSIONS.inc(database=database_name)
+        session = sessionmaker(engine)()
+        session.info['readonly'] = readonly
+        return session
 
     @staticmethod
     def coindaemon_url(coin, credentials=config.COINDAEMON_CREDENTIALS):
         return 'http://%s@%s:%d' % (':'.join(credentials), coin.rpc_host, coin.rpc_port)
 
     def coindaemon(self, coin):
-        return Daemon(self.coindaemon_url(coin))
+        return InstrumentedDaemon(Daemon(self.coindaemon_url(coin)), coin.ticker)
 
     def keyseeder(self):
-        return Daemon(self.coindaemon_url(KEYSEEDER_INFO, credentials=config.KEYSEEDER_CREDENTIALS))
+        return InstrumentedDaemon(Daemon(self.coindaemon_url(KEYSEEDER_INFO, credentials=config.KEYSEEDER_CREDENTIALS)), KEYSEEDER_INFO.name)
 
 
 connectionmanager = ConnectionManager()
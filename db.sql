@@ -77,6 +77,30 @@ CREATE TABLE `autopay` (
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `idempotencykey`
+--
+
+DROP TABLE IF EXISTS `idempotencykey`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `idempotencykey` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `manager` int(11) NOT NULL,
+  `key` varchar(64) NOT NULL,
+  `requesthash` binary(32) NOT NULL,
+  `status` varchar(16) NOT NULL,
+  `txid` binary(32) DEFAULT NULL,
+  `responsecode` int(11) DEFAULT NULL,
+  `response` mediumtext,
+  `created` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `idempotencykey` (`manager`,`key`),
+  KEY `created` (`created`),
+  CONSTRAINT `fk_idempotencykey_manager` FOREIGN KEY (`manager`) REFERENCES `manager` (`id`) ON DELETE CASCADE ON UPDATE NO ACTION
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 --
 -- Table structure for table `manager`
 --
@@ -93,6 +117,129 @@ CREATE TABLE `manager` (
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8;
 /*!40101 SET character_set_client = @saved_cs_client */;
 
+--
+-- Table structure for table `sendjob`
+--
+
+DROP TABLE IF EXISTS `sendjob`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `sendjob` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `manager` int(11) NOT NULL,
+  `account` int(11) NOT NULL,
+  `request` text NOT NULL,
+  `status` varchar(16) NOT NULL,
+  `txid` binary(32) DEFAULT NULL,
+  `signedtx` text,
+  `result` text,
+  `error` text,
+  `created` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `updated` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  KEY `queue` (`status`,`id`),
+  KEY `accountjobs` (`account`,`status`),
+  CONSTRAINT `fk_sendjob_manager` FOREIGN KEY (`manager`) REFERENCES `manager` (`id`) ON DELETE CASCADE ON UPDATE NO ACTION,
+  CONSTRAINT `fk_sendjob_account` FOREIGN KEY (`account`) REFERENCES `account` (`id`) ON DELETE CASCADE ON UPDATE NO ACTION
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `pendingspend`
+--
+
+DROP TABLE IF EXISTS `pendingspend`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `pendingspend` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `coin` varchar(5) NOT NULL,
+  `txout` int(11) NOT NULL,
+  `txid` binary(32) DEFAULT NULL,
+  `created` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  `expires` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `outpoint` (`coin`,`txout`),
+  KEY `expiry` (`coin`,`expires`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `webhook`
+--
+
+DROP TABLE IF EXISTS `webhook`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `webhook` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `manager` int(11) NOT NULL,
+  `url` varchar(255) NOT NULL,
+  `secret` char(64) NOT NULL,
+  `created` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `manager` (`manager`),
+  CONSTRAINT `fk_webhook_manager` FOREIGN KEY (`manager`) REFERENCES `manager` (`id`) ON DELETE CASCADE ON UPDATE NO ACTION
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `pendingdeposit`
+--
+
+DROP TABLE IF EXISTS `pendingdeposit`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `pendingdeposit` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `coin` varchar(5) NOT NULL,
+  `txout` int(11) NOT NULL,
+  `tx` int(11) NOT NULL,
+  `txid` binary(32) NOT NULL,
+  `vout` int(11) NOT NULL,
+  `amount` decimal(16,8) NOT NULL,
+  `address` varchar(64) NOT NULL,
+  `manager` int(11) NOT NULL,
+  `user` varchar(64) NOT NULL,
+  `seen` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `output` (`coin`,`txout`),
+  CONSTRAINT `fk_pendingdeposit_manager` FOREIGN KEY (`manager`) REFERENCES `manager` (`id`) ON DELETE CASCADE ON UPDATE NO ACTION
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `webhookevent`
+--
+
+DROP TABLE IF EXISTS `webhookevent`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `webhookevent` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `manager` int(11) NOT NULL,
+  `event` text NOT NULL,
+  `created` timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (`id`),
+  KEY `outbox` (`manager`,`id`),
+  CONSTRAINT `fk_webhookevent_manager` FOREIGN KEY (`manager`) REFERENCES `manager` (`id`) ON DELETE CASCADE ON UPDATE NO ACTION
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
+--
+-- Table structure for table `depositcursor`
+--
+
+DROP TABLE IF EXISTS `depositcursor`;
+/*!40101 SET @saved_cs_client     = @@character_set_client */;
+/*!40101 SET character_set_client = utf8 */;
+CREATE TABLE `depositcursor` (
+  `coin` varchar(5) NOT NULL,
+  `txout` int(11) NOT NULL,
+  PRIMARY KEY (`coin`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8;
+/*!40101 SET character_set_client = @saved_cs_client */;
+
 /*!40101 SET SQL_MODE=@OLD_SQL_MODE */;
 /*!40014 SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS */;
 /*!40014 SET UNIQUE_CHECKS=@OLD_UNIQUE_CHECKS */;
@@ -0,0 +1,363 @@
+from binascii import hexlify
+from datetime import datetime, timedelta
+from gevent import sleep, spawn
+from gevent.queue import Queue, Empty, Full
+from sqlalchemy import func as sqlfunc
+
+from coininfo import COINS
+from connections import connectionmanager
+from models import make_tx_ref
+
+from indexer.models import Address, Transaction, TransactionInput, TransactionOutput
+
+
+STREAM_POLL_INTERVAL = 1
+SUBSCRIPTION_QUEUE_SIZE = 1000
+SCAN_BATCH_SIZE = 10000
+TRACKED_TX_TTL = timedelta(days=1)
+
+EVENT_TRANSACTION_SEEN = 'transaction.seen'
+EVENT_TRANSACTION_CONFIRMED = 'transaction.confirmed'
+EVENT_BALANCE_CHANGED = 'balance.changed'
+
+
+def encode_cursor(positions):
+    return ','.join([ '%s:%d:%d' % (ticker, txout_id, txin_id) for ticker, (txout_id, txin_id) in sorted(positions.items()) ])
+
+
+def decode_cursor(cursor):
+    positions = {}
+    for entry in cursor.split(','):
+        ticker, txout_id, txin_id = entry.split(':')
+        positions[ticker] = (int(txout_id), int(txin_id))
+    return positions
+
+
+class Subscription(object):
+    # A cursor holds the last scanned output and input id of every coin, and
+    # every event that completes a scan carries one. Resuming from it replays
+    # whatever came after, so events are delivered at least once
+    def __init__(self, hub, address_ids, positions=None):
+        self.hub = hub
+        self.address_ids = address_ids
+        self.queue = Queue(SUBSCRIPTION_QUEUE_SIZE)
+        self.outbox = []
+        self.positions = dict(positions or {})
+        self.resume = dict(positions or {})
+        self.overflowed = False
+
+    @property
+    def cursor(self):
+        return encode_cursor(self.positions)
+
+    def push(self, event):
+        self.outbox.append(event)
+
+    def advance(self, ticker, position):
+        if self.overflowed:
+            return
+
+        positions = dict(self.positions)
+        positions[ticker] = position
+        events, self.outbox = self.outbox, []
+
+        # Subscribers that stop reading are dropped instead of buffering without bound
+        try:
+            for event in events[:-1]:
+                self.queue.put_nowait((event, None))
+            if len(events) > 0:
+                self.queue.put_nowait((events[-1], encode_cursor(positions)))
+        except Full:
+            self.overflowed = True
+            self.hub.unsubscribe(self)
+            return
+        self.positions = positions
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def pending(self):
+        events = []
+        while not self.queue.empty():
+            events.append(self.queue.get_nowait())
+        return events
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class CoinWatcher(object):
+    def __init__(self, coin):
+        self.coin = coin
+        self.subscribers = {}
+        self.subscriptions = set()
+        self.catchups = []
+        self.last_txout_id = None
+        self.last_txin_id = None
+        self.unconfirmed = {}
+
+    @property
+    def active(self):
+        return len(self.subscriptions) > 0
+
+    @property
+    def position(self):
+        return (self.last_txout_id, self.last_txin_id)
+
+    def subscribe(self, subscription, address_ids):
+        self.subscriptions.add(subscription)
+        for address_id in address_ids:
+            self.subscribers.setdefault(address_id, set()).add(subscription)
+
+        if self.coin.ticker in subscription.resume:
+            self.catchups.append(subscription)
+        elif self.last_txout_id is not None:
+            subscription.positions[self.coin.ticker] = self.position
+
+    def unsubscribe(self, subscription, address_ids):
+        self.subscriptions.discard(subscription)
+        if subscription in self.catchups:
+            self.catchups.remove(subscription)
+        for address_id in address_ids:
+            subscriptions = self.subscribers.get(address_id)
+            if subscriptions is None:
+                continue
+            subscriptions.discard(subscription)
+            if len(subscriptions) == 0:
+                del self.subscribers[address_id]
+
+    def reset(self):
+        # Subscriptions resume from their own cursor, not from where this
+        # watcher was, so nothing is lost by restarting at the chain tip
+        self.last_txout_id = None
+        self.last_txin_id = None
+        self.unconfirmed = {}
+
+    def _publish(self, address_ids, event):
+        subscriptions = set()
+        for address_id in address_ids:
+            subscriptions.update(self.subscribers.get(address_id, ()))
+        for subscription in subscriptions:
+            subscription.push(event)
+
+    def _transaction_event(self, event_type, txid):
+        txid = hexlify(txid)
+        return {
+            'type': event_type,
+            'coin': self.coin.ticker,
+            'txid': txid,
+            'href': make_tx_ref(self.coin, txid)
+        }
+
+    def _scan(self, db, position, address_ids, until=None):
+        # Every new output and input is scanned once per process, whatever the
+        # number of subscribers; only the matches are looked up any further.
+        # A catch-up up to a given position only reads the addresses it is for
+        touched = {}
+        last_txout_id, last_txin_id = position
+
+        outputs = db.query(
+            TransactionOutput.id,
+            TransactionOutput.address_id,
+            Transaction.id,
+            Transaction.txid,
+            Transaction.confirmation != None
+        ).join(
+            TransactionOutput.transaction
+        ).filter(
+            TransactionOutput.id > last_txout_id
+        )
+
+        inputs = db.query(
+            TransactionInput.id,
+            TransactionOutput.address_id,
+            Transaction.id,
+            Transaction.txid,
+            Transaction.confirmation != None
+        ).select_from(
+            TransactionOutput
+        ).join(
+            TransactionOutput.spenders
+        ).join(
+            TransactionInput.transaction
+        ).filter(
+            TransactionInput.id > last_txin_id
+        )
+
+        if until is not None:
+            outputs = outputs.filter(TransactionOutput.id <= until[0], TransactionOutput.address_id.in_(list(address_ids)))
+            inputs = inputs.filter(TransactionInput.id <= until[1], TransactionOutput.address_id.in_(list(address_ids)))
+
+        outputs = outputs.order_by(TransactionOutput.id).limit(SCAN_BATCH_SIZE).all()
+        inputs = inputs.order_by(TransactionInput.id).limit(SCAN_BATCH_SIZE).all()
+
+        for rows in (outputs, inputs):
+            for _, address_id, tx_id, txid, confirmed in rows:
+                if address_id in address_ids:
+                    entry = touched.setdefault(tx_id, (txid, bool(confirmed), set()))
+                    entry[2].add(address_id)
+
+        if len(outputs) > 0:
+            last_txout_id = outputs[-1][0]
+        if len(inputs) > 0:
+            last_txin_id = inputs[-1][0]
+        complete = len(outputs) < SCAN_BATCH_SIZE and len(inputs) < SCAN_BATCH_SIZE
+        return touched, (last_txout_id, last_txin_id), complete
+
+    def _confirmed(self, db):
+        if len(self.unconfirmed) == 0:
+            return []
+        return [ tx_id for tx_id, in db.query(Transaction.id).filter(
+            Transaction.id.in_(list(self.unconfirmed.keys())),
+            Transaction.confirmation != None
+        ).all() ]
+
+    def _balance_events(self, db, address_ids):
+        for address_id, address, balance, pending in db.query(
+            Address.id,
+            Address.address,
+            Address.balance,
+            Address.pending
+        ).filter(
+            Address.id.in_(list(address_ids))
+        ).all():
+            yield address_id, {
+                'type': EVENT_BALANCE_CHANGED,
+                'coin': self.coin.ticker,
+                'address': address,
+                'balance': float(balance or 0),
+                'pending': float(pending or 0)
+            }
+
+    def _track(self, tx_id, txid, address_ids, now):
+        if tx_id in self.unconfirmed:
+            self.unconfirmed[tx_id][1].update(address_ids)
+        else:
+            self.unconfirmed[tx_id] = (txid, set(address_ids), now)
+
+    def _catch_up(self, db, subscription, now):
+        # Replays what a resumed subscription missed, up to where the shared
+        # scan is, to that subscription alone
+        address_ids = set(subscription.address_ids.get(self.coin.ticker, ()))
+        position = subscription.resume[self.coin.ticker]
+        until = self.position
+        touched = {}
+
+        complete = len(address_ids) == 0
+        while not complete:
+            batch, position, complete = self._scan(db, position, address_ids, until=until)
+            for tx_id, (txid, confirmed, tx_address_ids) in batch.items():
+                touched.setdefault(tx_id, (txid, confirmed, set()))[2].update(tx_address_ids)
+
+        changed = set()
+        for tx_id, (txid, confirmed, tx_address_ids) in touched.items():
+            changed.update(tx_address_ids)
+            event = self._transaction_event(EVENT_TRANSACTION_SEEN, txid)
+            event['confirmed'] = confirmed
+            subscription.push(event)
+            if not confirmed:
+                self._track(tx_id, txid, tx_address_ids, now)
+
+        if len(changed) > 0:
+            for _, event in self._balance_events(db, changed):
+                subscription.push(event)
+
+        del subscription.resume[self.coin.ticker]
+
+    def poll(self, db, now=None):
+        if now is None:
+            now = datetime.now()
+
+        if self.last_txout_id is None:
+            self.last_txout_id = db.query(sqlfunc.max(TransactionOutput.id)).scalar() or 0
+            self.last_txin_id = db.query(sqlfunc.max(TransactionInput.id)).scalar() or 0
+
+        # A subscription stays queued until its catch-up succeeded, it is not
+        # advanced past what it missed before that
+        while len(self.catchups) > 0:
+            subscription = self.catchups[0]
+            self._catch_up(db, subscription, now)
+            if subscription in self.catchups:
+                self.catchups.remove(subscription)
+
+        changed = set()
+
+        touched, position, _ = self._scan(db, self.position, self.subscribers)
+        self.last_txout_id, self.last_txin_id = position
+        for tx_id, (txid, confirmed, address_ids) in touched.items():
+            changed.update(address_ids)
+            if tx_id in self.unconfirmed:
+                self.unconfirmed[tx_id][1].update(address_ids)
+                continue
+
+            event = self._transaction_event(EVENT_TRANSACTION_SEEN, txid)
+            event['confirmed'] = confirmed
+            self._publish(address_ids, event)
+            if not confirmed:
+                self._track(tx_id, txid, address_ids, now)
+
+        for tx_id in self._confirmed(db):
+            txid, address_ids, _ = self.unconfirmed.pop(tx_id)
+            changed.update(address_ids)
+            self._publish(address_ids, self._transaction_event(EVENT_TRANSACTION_CONFIRMED, txid))
+
+        for tx_id, (_, _, seen) in list(self.unconfirmed.items()):
+            if now - seen > TRACKED_TX_TTL:
+                del self.unconfirmed[tx_id]
+
+        changed &= set(self.subscribers.keys())
+        if len(changed) > 0:
+            for address_id, event in self._balance_events(db, changed):
+                self._publish([ address_id ], event)
+
+        for subscription in list(self.subscriptions):
+            if subscription not in self.catchups:
+                subscription.advance(self.coin.ticker, self.position)
+
+
+class EventHub(object):
+    def __init__(self, coins=COINS, interval=STREAM_POLL_INTERVAL):
+        self.watchers = { coin.ticker: CoinWatcher(coin) for coin in coins }
+        self.interval = interval
+        self.runner = None
+
+    def subscribe(self, address_ids, positions=None):
+        subscription = Subscription(self, address_ids, positions)
+        for ticker, coin_address_ids in address_ids.items():
+            self.watchers[ticker].subscribe(subscription, coin_address_ids)
+
+        # Started on first use, so every forked API worker runs its own
+        if self.runner is None or self.runner.dead:
+            self.runner = spawn(self.run)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        for ticker, coin_address_ids in subscription.address_ids.items():
+            self.watchers[ticker].unsubscribe(subscription, coin_address_ids)
+
+    def poll(self):
+        for watcher in self.watchers.values():
+            # Without subscribers nothing is queried, and once someone subscribes
+            # again the scan restarts at the current chain tip
+            if not watcher.active:
+                watcher.reset()
+                continue
+
+            db = connectionmanager.database_session(coin=watcher.coin, readonly=True)
+            try:
+                watcher.poll(db)
+            except Exception as e:
+                print('Event watcher for %s failed: %s' % (watcher.coin.ticker, e))
+            finally:
+                db.close()
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            self.poll()
+
+
+eventhub = EventHub()
@@ -0,0 +1,91 @@
+from decimal import Decimal
+from time import time
+
+from coinsupport.daemon import JSONRPCException
+
+from connections import connectionmanager
+from transaction import FEERATE_NETWORK, FEERATE_POOLSUBSIDY
+from indexer.models import Block
+
+
+PRIORITY_LOW = 'low'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_HIGH = 'high'
+
+PRIORITIES = [ PRIORITY_NORMAL, PRIORITY_LOW, PRIORITY_HIGH ]
+
+CONFIRMATION_TARGETS = {
+    PRIORITY_HIGH:      2,
+    PRIORITY_NORMAL:    6,
+    PRIORITY_LOW:       24
+}
+
+FEERATE_MAX = FEERATE_NETWORK * 10
+
+BLOCK_CHECK_INTERVAL = 10
+
+
+class CoinFeeRates(object):
+    def __init__(self):
+        self.height = None
+        self.lastcheck = 0
+        self.rates = {}
+
+
+class FeeEstimator(object):
+    def __init__(self, block_check_interval=BLOCK_CHECK_INTERVAL):
+        self.block_check_interval = block_check_interval
+        self.coins = {}
+
+    def _current_height(self, coin):
+        dbsession = connectionmanager.database_session(coin=coin, readonly=True)
+        try:
+            return dbsession.query(Block.height).order_by(Block.height.desc()).first()[0]
+        finally:
+            dbsession.close()
+
+    def _estimate(self, daemon, priority, min_feerate):
+        try:
+            estimate = daemon.estimatesmartfee(CONFIRMATION_TARGETS[priority])
+        except JSONRPCException as e:
+            print('Fee estimation for priority "%s" failed: %s' % (priority, e))
+            return FEERATE_NETWORK
+
+        if 'feerate' not in estimate or estimate['feerate'] <= 0:
+            return FEERATE_NETWORK
+
+        feerate = Decimal(str(estimate['feerate']))
+        return min(max(feerate, min_feerate), FEERATE_MAX)
+
+    def _refresh(self, coin, state):
+        daemon = connectionmanager.coindaemon(coin)
+
+        try:
+            min_feerate = Decimal(str(daemon.getnetworkinfo()['relayfee']))
+        except (JSONRPCException, KeyError):
+            min_feerate = Decimal(0)
+
+        state.rates = { priority: self._estimate(daemon, priority, min_feerate) for priority in PRIORITIES }
+
+    def _rates(self, coin):
+        state = self.coins.setdefault(coin.ticker, CoinFeeRates())
+
+        if time() - state.lastcheck >= self.block_check_interval:
+            state.lastcheck = time()
+            try:
+                height = self._current_height(coin)
+                if height != state.height:
+                    self._refresh(coin, state)
+                    state.height = height
+            except Exception as e:
+                print('Unable to update %s fee rates: %s' % (coin.ticker, e))
+
+        return state.rates
+
+    def feerate(self, coin, priority=PRIORITY_NORMAL, subsidized=False):
+        if subsidized and coin.allow_tx_subsidy:
+            return FEERATE_POOLSUBSIDY
+        return self._rates(coin).get(priority, FEERATE_NETWORK)
+
+
+feeestimator = FeeEstimator()
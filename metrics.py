@@ -0,0 +1,189 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from threading import Lock, Thread
+from time import time
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{%s}' % ','.join([ '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs ])
+
+
+class Metric(object):
+    TYPE = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self.lock = Lock()
+        self.values = {}
+
+    def _key(self, labels):
+        if set(labels.keys()) != set(self.label_names):
+            raise ValueError('Metric %s expects labels %s, got %s' % (self.name, self.label_names, tuple(labels.keys())))
+        return tuple([ labels[name] for name in self.label_names ])
+
+    def samples(self):
+        raise NotImplementedError()
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.description),
+            '# TYPE %s %s' % (self.name, self.TYPE)
+        ]
+        with self.lock:
+            samples = list(self.samples())
+        for suffix, label_values, extra, value in samples:
+            lines.append('%s%s%s %s' % (self.name, suffix, _format_labels(self.label_names, label_values, extra), _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield '_total', key, (), value
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield '', key, (), value
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [ [0] * len(self.buckets), 0.0 ]
+            counts = self.values[key]
+            counts[0][bisect_left(self.buckets, value)] += 1
+            counts[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start_time = time()
+        try:
+            yield
+        finally:
+            self.observe(time() - start_time, **labels)
+
+    def samples(self):
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '_bucket', key, (('le', _format_value(bucket)),), cumulative
+            yield '_sum', key, (), total
+            yield '_count', key, (), cumulative
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=()):
+        return self.register(Gauge(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def render(self):
+        return '\n'.join([ metric.render() for metric in self.metrics ]) + '\n'
+
+
+registry = Registry()
+
+
+API_REQUEST_DURATION = registry.histogram('wallet_api_request_duration_seconds', 'Time spent handling API requests', ('endpoint', 'method'))
+API_REQUEST_ERRORS = registry.counter('wallet_api_request_errors', 'API requests that resulted in an error response', ('endpoint', 'method', 'status'))
+
+RPC_CALL_DURATION = registry.histogram('wallet_rpc_call_duration_seconds', 'Latency of coin daemon RPC calls', ('coin', 'method'))
+RPC_CALL_FAILURES = registry.counter('wallet_rpc_call_failures', 'Coin daemon RPC calls that raised an error', ('coin', 'method'))
+
+DB_SESSIONS = registry.counter('wallet_db_sessions', 'Database sessions created', ('database',))
+DB_CONNECTIONS = registry.counter('wallet_db_connections', 'Database connections opened', ('database',))
+DB_CONNECTIONS_IN_USE = registry.gauge('wallet_db_connections_in_use', 'Database connections currently checked out', ('database',))
+DB_QUERY_DURATION = registry.histogram('wallet_db_query_duration_seconds', 'Latency of individual database queries', ('database',))
+
+LOCK_WAIT_DURATION = registry.histogram('wallet_lock_wait_seconds', 'Time spent waiting to acquire wallet locks', ('lock',))
+ADMISSION_WAIT_DURATION = registry.histogram('wallet_admission_wait_seconds', 'Time requests spent queued for admission', ('operation',))
+ADMISSION_REJECTIONS = registry.counter('wallet_admission_rejections', 'Requests rejected by admission control', ('operation', 'reason'))
+
+BACKGROUND_CYCLE_DURATION = registry.histogram('wallet_background_cycle_duration_seconds', 'Duration of background processing cycles', ('coin',), buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0))
+CONSOLIDATIONS = registry.counter('wallet_consolidations', 'Consolidation transactions broadcast', ('coin',))
+AUTOPAYMENTS = registry.counter('wallet_autopayments', 'Automatic payments processed', ('coin', 'result'))
+
+SERVER_STARTUP_DURATION = registry.gauge('wallet_server_startup_seconds', 'Time spent before an API worker started accepting requests', ('phase',))
+
+
+@contextmanager
+def timed_lock(lock, name):
+    start_time = time()
+    with lock:
+        LOCK_WAIT_DURATION.observe(time() - start_time, lock=name)
+        yield
+
+
+def wsgi_app(environ, start_response):
+    start_response('200 OK', [ ('Content-Type', CONTENT_TYPE) ])
+    return [ registry.render().encode('utf-8') ]
+
+
+def serve(port, host='0.0.0.0'):
+    from wsgiref.simple_server import make_server
+
+    server = make_server(host, port, wsgi_app)
+    thread = Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -1,8 +1,10 @@
+import json
 import os
 
-from binascii import unhexlify
-from Crypto.Cipher import AES
-from sqlalchemy import BINARY as Binary, Column, Float, ForeignKey, Integer, MetaData, String, DateTime
+from binascii import hexlify, unhexlify
+from datetime import datetime
+from gevent import joinall, spawn
+from sqlalchemy import BINARY as Binary, Column, Float, ForeignKey, Integer, MetaData, String, Text, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm.session import Session
@@ -16,6 +18,7 @@ from indexer.postprocessor import convert_date
 
 AUTH_TOKEN_SIZE = 64
 ACCOUNT_NAME_LEN = 64
+IDEMPOTENCY_KEY_LEN = 64
 
 
 def make_indexer_ref(cointicker, object_name_path, object_id):
@@ -49,11 +52,13 @@ class Account(Base):
 
     @property
     def private_key(self):
+        from Crypto.Cipher import AES
         cipher = AES.new(unhexlify(config.ENCRYPTION_KEY), AES.MODE_CBC, self.iv)
         return cipher.decrypt(self.encrypted_key)
 
     @private_key.setter
     def private_key(self, value):
+        from Crypto.Cipher import AES
         self.iv = os.urandom(AES.block_size)
         cipher = AES.new(unhexlify(config.ENCRYPTION_KEY), AES.MODE_CBC, self.iv)
         self.encrypted_key = cipher.encrypt(value)
@@ -91,7 +96,11 @@ class AccountAddress(Base):
 
     @property
     def _dbsession(self):
-        return connectionmanager.database_session(coin=Coin.by_ticker(self.coin))
+        # Follows the mode of the session this binding was loaded through, so
+        # freshly imported addresses are read back from the primary
+        session = Session.object_session(self)
+        readonly = session.info.get('readonly', False) if session is not None else False
+        return connectionmanager.database_session(coin=Coin.by_ticker(self.coin), readonly=readonly)
 
     @property
     def address_info(self):
@@ -127,6 +136,29 @@ class AccountAddress(Base):
         ).first()
 
 
+def prefetch_address_info(bindings, readonly=False):
+    # Every coin has its own database, so the addresses of all coins are looked
+    # up concurrently and a view costs as much as its slowest coin, instead of
+    # one session and query per binding
+    bindings_by_coin = {}
+    for binding in bindings:
+        bindings_by_coin.setdefault(binding.coin, []).append(binding)
+
+    def fetch(ticker, coin_bindings):
+        db = connectionmanager.database_session(coin=Coin.by_ticker(ticker), readonly=readonly)
+        try:
+            addresses = { address.id: address for address in db.query(Address).filter(
+                Address.id.in_(list(set([ binding.address_id for binding in coin_bindings ])))
+            ).all() }
+        finally:
+            db.close()
+
+        for binding in coin_bindings:
+            binding._address_info = addresses.get(binding.address_id)
+
+    joinall([ spawn(fetch, ticker, coin_bindings) for ticker, coin_bindings in bindings_by_coin.items() ], raise_error=True)
+
+
 class AutomaticPayment(Base):
     __tablename__ = 'autopay'
 
@@ -216,5 +248,127 @@ class WalletManager(Base):
     accounts = relationship('Account', back_populates='manager', cascade='save-update, merge, delete')
 
 
+class IdempotencyKey(Base):
+    __tablename__ = 'idempotencykey'
+
+    STATUS_PENDING = 'pending'
+    STATUS_BROADCAST = 'broadcast'
+    STATUS_COMPLETED = 'completed'
+
+    id = Column(Integer, primary_key=True)
+    manager_id = Column('manager', Integer, ForeignKey('manager.id'))
+    key = Column(String(IDEMPOTENCY_KEY_LEN))
+    requesthash = Column(Binary(32))
+    status = Column(String(16))
+    txid = Column(Binary(32))
+    response_code = Column('responsecode', Integer)
+    response = Column(Text)
+    created = Column(DateTime)
+
+
+class SendJob(Base):
+    __tablename__ = 'sendjob'
+
+    STATUS_QUEUED = 'queued'
+    STATUS_PROCESSING = 'processing'
+    STATUS_SIGNED = 'signed'
+    STATUS_BROADCAST = 'broadcast'
+    STATUS_SEEN = 'seen'
+    STATUS_FAILED = 'failed'
+
+    id = Column(Integer, primary_key=True)
+    manager_id = Column('manager', Integer, ForeignKey('manager.id'))
+    account_id = Column('account', Integer, ForeignKey('account.id'))
+    request = Column(Text)
+    status = Column(String(16))
+    txid = Column(Binary(32))
+    signedtx = Column(Text)
+    result = Column(Text)
+    error = Column(Text)
+    created = Column(DateTime)
+    updated = Column(DateTime)
+
+    manager = relationship('WalletManager')
+    account = relationship('Account')
+
+    def set_status(self, status):
+        self.status = status
+        self.updated = datetime.now()
+
+    def _as_dict(self):
+        txid = hexlify(self.txid) if self.txid is not None else None
+        coin = Coin.by_ticker(json.loads(self.request)['coin']) if self.txid is not None else None
+        return {
+            'id': self.id,
+            'status': self.status,
+            'user': self.account.user,
+            'result': json.loads(self.result) if self.result is not None else None,
+            'error': self.error,
+            'transaction': {
+                'txid': txid,
+                'href': make_tx_ref(coin, txid)
+            } if txid is not None else None,
+            'created': convert_date(self.created),
+            'updated': convert_date(self.updated)
+        }
+
+
+class Webhook(Base):
+    __tablename__ = 'webhook'
+
+    id = Column(Integer, primary_key=True)
+    manager_id = Column('manager', Integer, ForeignKey('manager.id'), unique=True)
+    url = Column(String(255))
+    secret = Column(String(64))
+    created = Column(DateTime)
 
+    manager = relationship('WalletManager')
 
+    def _as_dict(self):
+        return {
+            'url': self.url,
+            'created': convert_date(self.created)
+        }
+
+
+class PendingDeposit(Base):
+    __tablename__ = 'pendingdeposit'
+
+    id = Column(Integer, primary_key=True)
+    coin = Column(String(5))
+    txout_id = Column('txout', Integer)
+    tx_id = Column('tx', Integer)
+    txid = Column(Binary(32))
+    vout = Column(Integer)
+    amount = Column(Float(asdecimal=True))
+    address = Column(String(64))
+    manager_id = Column('manager', Integer, ForeignKey('manager.id'))
+    user = Column(String(ACCOUNT_NAME_LEN))
+    seen = Column(DateTime)
+
+
+class WebhookEvent(Base):
+    __tablename__ = 'webhookevent'
+
+    id = Column(Integer, primary_key=True)
+    manager_id = Column('manager', Integer, ForeignKey('manager.id'))
+    event = Column(Text)
+    created = Column(DateTime)
+
+
+class DepositCursor(Base):
+    __tablename__ = 'depositcursor'
+
+    coin = Column(String(5), primary_key=True)
+    txout_id = Column('txout', Integer)
+
+
+class PendingSpend(Base):
+    __tablename__ = 'pendingspend'
+
+    id = Column(Integer, primary_key=True)
+    coin = Column(String(5))
+    txout_id = Column('txout', Integer)
+    txid = Column(Binary(32))
+    created = Column(DateTime)
+    expires = Column(DateTime)
@@ -0,0 +1,196 @@
+from gevent import monkey; monkey.patch_all()
+
+import json
+
+from binascii import hexlify, unhexlify
+from datetime import datetime, timedelta
+from gevent import sleep
+from gevent.pool import Pool
+
+import config
+from apiobjs import SendRequest
+from coininfo import Coin
+from connections import connectionmanager
+from models import SendJob
+from wallet import Wallet, WalletAccount
+
+from coinsupport.daemon import JSONRPCException
+
+from indexer.logger import log_event
+from indexer.models import Transaction
+
+
+SEND_JOB_WORKERS = getattr(config, 'SEND_JOB_WORKERS', 4)
+JOB_POLL_INTERVAL = 0.5
+JOB_STALE_TIMEOUT = timedelta(minutes=5)
+JOB_RECOVERY_INTERVAL = timedelta(minutes=1)
+
+CLAIMED_STATES = [ SendJob.STATUS_PROCESSING, SendJob.STATUS_SIGNED ]
+
+
+def enqueue_send_job(db, account, request_json):
+    job = SendJob()
+    job.manager_id = account.manager_id
+    job.account_id = account.id
+    job.request = json.dumps(request_json)
+    job.created = datetime.now()
+    job.set_status(SendJob.STATUS_QUEUED)
+    db.add(job)
+    db.commit()
+    return job
+
+
+def claim_next_job(db):
+    while True:
+        db.rollback()
+
+        # Jobs of an account run in order of submission, so accounts that
+        # already have a job being signed or broadcast are skipped
+        busy_accounts = db.query(SendJob.account_id).filter(SendJob.status.in_(CLAIMED_STATES))
+        job_id = db.query(SendJob.id).filter(
+            SendJob.status == SendJob.STATUS_QUEUED,
+            ~SendJob.account_id.in_(busy_accounts)
+        ).order_by(SendJob.id).limit(1).scalar()
+
+        if job_id is None:
+            return None
+
+        claimed = db.query(SendJob).filter(
+            SendJob.id == job_id,
+            SendJob.status == SendJob.STATUS_QUEUED
+        ).update({ SendJob.status: SendJob.STATUS_PROCESSING, SendJob.updated: datetime.now() }, synchronize_session=False)
+        db.commit()
+
+        if claimed == 1:
+            return job_id
+
+
+def requeue_stale_jobs(db, now=None):
+    # Jobs that were claimed but never signed can safely be run again
+    if now is None:
+        now = datetime.now()
+    requeued = db.query(SendJob).filter(
+        SendJob.status == SendJob.STATUS_PROCESSING,
+        SendJob.updated < now - JOB_STALE_TIMEOUT
+    ).update({ SendJob.status: SendJob.STATUS_QUEUED, SendJob.updated: now }, synchronize_session=False)
+    db.commit()
+    return requeued
+
+
+def rebroadcast_signed_job(job):
+    coin = Coin.by_ticker(json.loads(job.request)['coin'])
+
+    coin_db = connectionmanager.database_session(coin=coin)
+    try:
+        if coin_db.query(Transaction.id).filter(Transaction.txid == job.txid).first() is not None:
+            return
+    finally:
+        coin_db.close()
+
+    daemon = connectionmanager.coindaemon(coin)
+    try:
+        daemon.getrawtransaction(hexlify(job.txid))
+        return
+    except JSONRPCException:
+        pass
+
+    daemon.sendrawtransaction(job.signedtx)
+
+
+def recover_signed_jobs(db, now=None):
+    # A signed job may have reached the network before its worker stopped, so
+    # it is never run again or failed: the exact same transaction is broadcast
+    # until it is known to the node or the indexer
+    if now is None:
+        now = datetime.now()
+    jobs = db.query(SendJob).filter(
+        SendJob.status == SendJob.STATUS_SIGNED,
+        SendJob.updated < now - JOB_STALE_TIMEOUT
+    ).all()
+
+    for job in jobs:
+        try:
+            rebroadcast_signed_job(job)
+            job.set_status(SendJob.STATUS_BROADCAST)
+            log_event('Rebroad', 'Tx', hexlify(job.txid), 'job %d' % job.id)
+        except Exception as e:
+            job.error = '%s: %s' % (e.__class__.__name__, e)
+            job.set_status(SendJob.STATUS_SIGNED)
+        db.commit()
+
+    return len(jobs)
+
+
+def recover_stale_jobs(db):
+    requeued = requeue_stale_jobs(db)
+    if requeued > 0:
+        log_event('Requeue', 'Jobs', '%d stale send jobs' % requeued)
+    recovered = recover_signed_jobs(db)
+    if recovered > 0:
+        log_event('Recover', 'Jobs', '%d signed send jobs' % recovered)
+
+
+def process_send_job(job_id):
+    db = connectionmanager.database_session()
+    job = db.query(SendJob).filter(SendJob.id == job_id).first()
+
+    try:
+        wallet = Wallet(job.manager)
+        account = WalletAccount(wallet, job.account)
+        requestobj = SendRequest(json.loads(job.request))
+        sender = account.addresses[requestobj.coin]
+        requestobj.destination.set_context_info(wallet=wallet, coin=sender.coin)
+
+        tx = sender.transaction(requestobj.destination.address, requestobj.amount, spend_unconfirmed=True, priority=requestobj.priority, subsidized=requestobj.low_priority)
+        job.result = json.dumps({ 'destination': dict(requestobj.destination) })
+        job.signedtx = tx.hex
+        job.txid = unhexlify(tx.decode_txid())
+        job.set_status(SendJob.STATUS_SIGNED)
+        db.commit()
+
+        txid = tx.broadcast()
+        job.set_status(SendJob.STATUS_BROADCAST)
+        db.commit()
+        log_event('Broadc.', 'Tx', txid, 'job %d' % job_id)
+
+        tx.wait_until_seen_on_network()
+        job.set_status(SendJob.STATUS_SEEN)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        job.error = '%s: %s' % (e.__class__.__name__, e)
+        # Only jobs that never got signed can fail, signed ones are left for
+        # recover_signed_jobs
+        if job.status == SendJob.STATUS_PROCESSING:
+            job.set_status(SendJob.STATUS_FAILED)
+        db.commit()
+        print('Send job %d failed: %s' % (job_id, e))
+    finally:
+        db.close()
+
+
+def main(workers=SEND_JOB_WORKERS):
+    pool = Pool(workers)
+    db = connectionmanager.database_session()
+
+    lastrecovery = datetime.utcfromtimestamp(0)
+
+    while True:
+        try:
+            if datetime.now() - lastrecovery >= JOB_RECOVERY_INTERVAL:
+                lastrecovery = datetime.now()
+                recover_stale_jobs(db)
+
+            pool.wait_available()
+            job_id = claim_next_job(db)
+            if job_id is None:
+                sleep(JOB_POLL_INTERVAL)
+                continue
+            pool.spawn(process_send_job, job_id)
+        except KeyboardInterrupt:
+            pool.join()
+            return
+
+
+if __name__ == '__main__':
+    main()
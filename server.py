@@ -0,0 +1,157 @@
+from gevent import monkey; monkey.patch_all()
+
+import argparse
+import os
+import signal
+import socket
+import sys
+
+from multiprocessing import cpu_count
+from time import sleep, time
+
+from gevent.pywsgi import WSGIServer
+
+
+START_TIME = time()
+
+import config
+
+
+API_HOST = getattr(config, 'API_HOST', '0.0.0.0')
+API_PORT = getattr(config, 'API_PORT', 8080)
+API_WORKERS = getattr(config, 'API_WORKERS', cpu_count())
+API_METRICS_PORT = getattr(config, 'API_METRICS_PORT', None)
+API_BACKLOG = 1024
+WORKER_RESTART_DELAY = 1
+
+
+def preload():
+    # Everything done here happens once in the master and is shared with all
+    # workers after forking: module imports, coin metadata, address codecs and
+    # the secp256k1 tables used when importing private keys
+    from api import webapp
+    from coininfo import COINS
+    from wallet import PrivateKey
+
+    for coin in COINS:
+        coin.address_codec.decoders
+        coin.get_addresses_for_pubkeyhash(b'\x00' * 20)
+
+    PrivateKey(b'\x01' * 32).hash160()
+    return webapp
+
+
+def warm_up(webapp):
+    # Connections can not be shared across forks, so each worker opens its own
+    # before it starts accepting requests
+    from api import WARM_UP_ENVIRON_KEY
+    from coininfo import COINS
+    from connections import connectionmanager
+    from feeestimator import feeestimator
+
+    for coin in [ None ] + COINS:
+        for readonly in (False, True):
+            try:
+                session = connectionmanager.database_session(coin=coin, readonly=readonly)
+                session.execute('SELECT 1')
+                session.close()
+            except Exception as e:
+                print('Warm-up of %s database failed: %s' % (coin.ticker if coin is not None else 'wallet', e))
+
+    for coin in COINS:
+        try:
+            feeestimator.feerate(coin)
+        except Exception as e:
+            print('Warm-up of %s coin daemon failed: %s' % (coin.ticker, e))
+
+    # Every route requires authentication, the warm-up request is answered
+    # with 401 and is therefore kept out of the request metrics
+    webapp.test_client().get('/accounts/', environ_overrides={ WARM_UP_ENVIRON_KEY: True })
+
+
+def listen(host, port, backlog=API_BACKLOG):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    return listener
+
+
+def run_worker(webapp, listener, preload_time, slot):
+    # Requests that arrive during warm-up wait in the listen backlog
+    from metrics import SERVER_STARTUP_DURATION, serve as serve_metrics
+
+    # Every worker keeps its own metrics, so each one is scraped on a port of
+    # its own instead of the shared API port; a restarted worker takes over
+    # the port of the one it replaces
+    if API_METRICS_PORT is not None:
+        serve_metrics(API_METRICS_PORT + slot)
+
+    start_time = time()
+    warm_up(webapp)
+    warm_up_time = time() - start_time
+
+    SERVER_STARTUP_DURATION.set(preload_time, phase='preload')
+    SERVER_STARTUP_DURATION.set(warm_up_time, phase='warmup')
+    SERVER_STARTUP_DURATION.set(time() - START_TIME, phase='total')
+    print('Worker %d ready after %.2fs (preload %.2fs, warm-up %.2fs)' % (os.getpid(), time() - START_TIME, preload_time, warm_up_time))
+
+    WSGIServer(listener, webapp, log=None).serve_forever()
+
+
+def spawn_worker(webapp, listener, preload_time, slot):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            run_worker(webapp, listener, preload_time, slot)
+        finally:
+            os._exit(1)
+    return pid
+
+
+def main(host=API_HOST, port=API_PORT, workers=API_WORKERS):
+    start_time = time()
+    webapp = preload()
+    preload_time = time() - start_time
+    print('Preloaded in %.2fs, starting %d workers on %s:%d' % (preload_time, workers, host, port))
+
+    listener = listen(host, port)
+    pids = { spawn_worker(webapp, listener, preload_time, slot): slot for slot in range(workers) }
+    stopping = []
+
+    def stop(signum, frame):
+        stopping.append(signum)
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    while len(pids) > 0:
+        try:
+            pid, status = os.waitpid(-1, 0)
+        except OSError:
+            sleep(WORKER_RESTART_DELAY)
+            continue
+        slot = pids.pop(pid, None)
+        if slot is None:
+            continue
+
+        if len(stopping) == 0:
+            print('Worker %d exited with status %d, restarting' % (pid, status))
+            sleep(WORKER_RESTART_DELAY)
+            pids[spawn_worker(webapp, listener, preload_time, slot)] = slot
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the wallet API with preloaded, warmed up gevent workers')
+    parser.add_argument('--host', default=API_HOST)
+    parser.add_argument('--port', type=int, default=API_PORT)
+    parser.add_argument('--workers', type=int, default=API_WORKERS)
+    args = parser.parse_args()
+
+    sys.exit(main(args.host, args.port, args.workers))
@@ -0,0 +1,154 @@
+from binascii import hexlify, unhexlify
+from datetime import datetime, timedelta
+from sqlalchemy.exc import IntegrityError
+
+import config
+from connections import connectionmanager
+from models import PendingSpend
+
+from indexer.models import Transaction, TransactionOutput
+
+
+# Inputs of a signed transaction are reserved until it is broadcast, after
+# which they stay excluded from UTXO selection until the indexer has seen the
+# spend, the transaction left the mempool or the entry expired
+RESERVATION_TTL = timedelta(minutes=2)
+PENDING_SPEND_TTL = timedelta(seconds=getattr(config, 'PENDING_SPEND_TTL', 3600))
+EVICTION_GRACE_PERIOD = timedelta(minutes=1)
+
+
+class InputsAlreadySpentException(Exception):
+    pass
+
+
+def pending_spends(coin, now=None):
+    # Resolved on the primary wallet database: a reservation made a moment ago
+    # must be seen, whichever coin database or replica the utxos come from
+    if now is None:
+        now = datetime.now()
+    db = connectionmanager.database_session()
+    try:
+        return [ txout_id for txout_id, in db.query(PendingSpend.txout_id).filter(
+            PendingSpend.coin == coin.ticker,
+            PendingSpend.expires > now
+        ).all() ]
+    finally:
+        db.close()
+
+
+class SpendReservation(object):
+    def __init__(self, coin, txout_ids):
+        self.coin = coin
+        self.txout_ids = txout_ids
+
+    def _entries(self, db):
+        return db.query(PendingSpend).filter(
+            PendingSpend.coin == self.coin.ticker,
+            PendingSpend.txout_id.in_(self.txout_ids)
+        )
+
+    def broadcast(self, txid):
+        db = connectionmanager.database_session()
+        try:
+            self._entries(db).update({
+                PendingSpend.txid: unhexlify(txid),
+                PendingSpend.expires: datetime.now() + PENDING_SPEND_TTL
+            }, synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+    def release(self):
+        db = connectionmanager.database_session()
+        try:
+            self._entries(db).filter(PendingSpend.txid == None).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+
+def reserve_inputs(coin, txout_ids):
+    db = connectionmanager.database_session()
+    now = datetime.now()
+
+    try:
+        for attempt in range(2):
+            for txout_id in txout_ids:
+                entry = PendingSpend()
+                entry.coin = coin.ticker
+                entry.txout_id = txout_id
+                entry.created = now
+                entry.expires = now + RESERVATION_TTL
+                db.add(entry)
+
+            try:
+                db.commit()
+                return SpendReservation(coin, txout_ids)
+            except IntegrityError:
+                db.rollback()
+
+            # Expired entries are only purged periodically, they must not block a new spend
+            db.query(PendingSpend).filter(
+                PendingSpend.coin == coin.ticker,
+                PendingSpend.txout_id.in_(txout_ids),
+                PendingSpend.expires <= now
+            ).delete(synchronize_session=False)
+            db.commit()
+    finally:
+        db.close()
+
+    raise InputsAlreadySpentException('Inputs are already being spent by another transaction')
+
+
+def purge_pending_spends(coin, coin_db, coindaemon=None):
+    db = connectionmanager.database_session()
+    now = datetime.now()
+
+    try:
+        purged = db.query(PendingSpend).filter(
+            PendingSpend.coin == coin.ticker,
+            PendingSpend.expires <= now
+        ).delete(synchronize_session=False)
+
+        # The indexer has seen the spend, so the outputs are excluded without us
+        indexed = [ entry_id for entry_id, in coin_db.query(
+            PendingSpend.id
+        ).join(
+            TransactionOutput,
+            TransactionOutput.id == PendingSpend.txout_id
+        ).filter(
+            PendingSpend.coin == coin.ticker,
+            TransactionOutput.spenders.any()
+        ).all() ]
+
+        # An output the node still reports as unspent, counting its mempool, was
+        # provably not spent by our broadcast transaction: it was evicted or
+        # replaced. A transaction that was just mined but not yet indexed spends
+        # its inputs on chain, so those stay reserved until the indexer catches up
+        evicted = []
+        if coindaemon is not None:
+            for entry_id, txid, vout in coin_db.query(
+                PendingSpend.id,
+                Transaction.txid,
+                TransactionOutput.index
+            ).join(
+                TransactionOutput,
+                TransactionOutput.id == PendingSpend.txout_id
+            ).join(
+                TransactionOutput.transaction
+            ).filter(
+                PendingSpend.coin == coin.ticker,
+                PendingSpend.txid != None,
+                PendingSpend.created < now - EVICTION_GRACE_PERIOD,
+                PendingSpend.expires > now
+            ).all():
+                if coindaemon.gettxout(hexlify(txid).decode('ascii'), vout, True) is not None:
+                    evicted.append(entry_id)
+
+        if len(indexed) + len(evicted) > 0:
+            purged += db.query(PendingSpend).filter(PendingSpend.id.in_(list(set(indexed + evicted)))).delete(synchronize_session=False)
+
+        db.commit()
+        return purged
+    finally:
+        db.close()
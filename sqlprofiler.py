@@ -0,0 +1,121 @@
+import json
+import logging
+
+from contextlib import contextmanager
+from hashlib import sha1
+from threading import local
+from time import time
+
+import config
+
+
+SLOW_QUERY_THRESHOLD = getattr(config, 'SQL_SLOW_QUERY_THRESHOLD', 0.5)
+SLOW_QUERY_LOG = getattr(config, 'SQL_SLOW_QUERY_LOG', None)
+REPEATED_QUERY_THRESHOLD = getattr(config, 'SQL_REPEATED_QUERY_THRESHOLD', 10)
+
+
+logger = logging.getLogger('wallet.sql')
+
+if SLOW_QUERY_LOG is not None:
+    _handler = logging.FileHandler(SLOW_QUERY_LOG)
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+
+
+def fingerprint(parameters):
+    if parameters is None:
+        return None
+    return sha1(repr(parameters).encode('utf-8')).hexdigest()[:16]
+
+
+def parameter_types(parameters):
+    if isinstance(parameters, dict):
+        return { name: type(value).__name__ for name, value in parameters.items() }
+    if isinstance(parameters, (list, tuple)):
+        return [ type(value).__name__ for value in parameters ]
+    return type(parameters).__name__
+
+
+class QueryProfile(object):
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.db_time = 0.0
+        self.statements = {}
+        self.start_time = time()
+
+    def record(self, statement, duration):
+        self.queries += 1
+        self.db_time += duration
+        self.statements[statement] = self.statements.get(statement, 0) + 1
+
+    def repeated_statements(self, threshold=REPEATED_QUERY_THRESHOLD):
+        return [ (statement, count) for statement, count in self.statements.items() if count > threshold ]
+
+    def finish(self):
+        for statement, count in self.repeated_statements():
+            logger.warning(json.dumps({
+                'event': 'repeated-query',
+                'context': self.name,
+                'count': count,
+                'statement': statement
+            }))
+
+    def __iter__(self):
+        yield 'context', self.name
+        yield 'queries', self.queries
+        yield 'db_time', self.db_time
+        yield 'wall_time', time() - self.start_time
+
+
+class QueryProfiler(object):
+    def __init__(self, slow_query_threshold=SLOW_QUERY_THRESHOLD):
+        self.slow_query_threshold = slow_query_threshold
+        self.state = local()
+
+    @property
+    def current(self):
+        return getattr(self.state, 'profile', None)
+
+    def start(self, name):
+        self.state.profile = QueryProfile(name)
+        return self.state.profile
+
+    def stop(self):
+        profile = self.current
+        self.state.profile = None
+        if profile is not None:
+            profile.finish()
+        return profile
+
+    @contextmanager
+    def profile(self, name):
+        previous = self.current
+        profile = self.start(name)
+        try:
+            yield profile
+        finally:
+            self.stop()
+            self.state.profile = previous
+
+    def record(self, database, statement, parameters, duration):
+        profile = self.current
+        if profile is not None:
+            profile.record(statement, duration)
+
+        if duration >= self.slow_query_threshold:
+            logger.warning(json.dumps({
+                'event': 'slow-query',
+                'context': profile.name if profile is not None else None,
+                'database': database,
+                'duration': duration,
+                'statement': statement,
+                'parameters': {
+                    'fingerprint': fingerprint(parameters),
+                    'types': parameter_types(parameters)
+                }
+            }))
+
+
+profiler = QueryProfiler()
@@ -1,6 +1,6 @@
-from binascii import unhexlify
+from binascii import hexlify, unhexlify
 from decimal import Decimal
-from struct import pack
+from struct import pack, pack_into
 from time import time, sleep
 
 from coinsupport.daemon import JSONRPCException
@@ -16,6 +16,13 @@ FEERATE_POOLSUBSIDY = Decimal('0.00005')
 
 DUST_LIMIT = Decimal('0.0005')
 
+TXIN_VSIZES = {
+    TXOUT_TYPES.P2PKH:  149,
+    TXOUT_TYPES.P2WPKH: 68
+}
+
+SEGWIT_TXOUT_TYPES = [ TXOUT_TYPES.P2WPKH, TXOUT_TYPES.P2WSH ]
+
 
 class InvalidHashException(Exception):
     pass
@@ -33,6 +40,9 @@ class TransactionBroadcastException(Exception):
 def _op(*vargs):
     return b''.join([ pack('B', op) for op in vargs ])
 
+def varint_size(i):
+    return 1 if i < 0xfd else 3 if i < 0x10000 else 5 if i < 0x100000000 else 9
+
 def encode_varint(i):
     if i < 0xfd:
         return pack('B', i)
@@ -55,25 +65,102 @@ def encode_pushdata(hex):
     return _op(OP_PUSHDATA) + encode_hexblob(hex)
 
 
+def write_varint(buf, offset, i):
+    if i < 0xfd:
+        pack_into('B', buf, offset, i)
+        return offset + 1
+    if i < 0x10000:
+        pack_into('<BH', buf, offset, 0xfd, i)
+        return offset + 3
+    if i < 0x100000000:
+        pack_into('<BI', buf, offset, 0xfe, i)
+        return offset + 5
+    pack_into('<BQ', buf, offset, 0xff, i)
+    return offset + 9
+
+def write_int(buf, offset, i):
+    pack_into('<I', buf, offset, i)
+    return offset + 4
+
+def write_bytes(buf, offset, raw):
+    buf[offset:offset + len(raw)] = raw
+    return offset + len(raw)
+
+
+class Utxo(object):
+    __slots__ = [ 'address', 'raw_txid', 'vout', 'txouttype', 'amount', 'txout_id' ]
+
+    def __init__(self, address, raw_txid, vout, txouttype, amount, txout_id=None):
+        self.address = address
+        self.raw_txid = raw_txid
+        self.vout = vout
+        self.txouttype = txouttype
+        self.amount = amount
+        self.txout_id = txout_id
+
+    @property
+    def txid(self):
+        return hexlify(self.raw_txid)
+
+    @property
+    def segwit(self):
+        return self.txouttype in SEGWIT_TXOUT_TYPES
+
+    @property
+    def txin_vsize(self):
+        return TXIN_VSIZES[self.txouttype]
+
+    def __iter__(self):
+        yield 'txid', self.txid
+        yield 'vout', self.vout
+        yield 'txouttype', self.txouttype
+        yield 'segwit', self.segwit
+        yield 'txin_vsize', self.txin_vsize
+        yield 'amount', self.amount
+        yield 'address', self.address
+
+
 class TransactionInput(object):
     def __init__(self, utxo):
-        self.address = utxo['address']
-        self.amount = utxo['amount']
-        self.txid = utxo['txid']
-        self.raw_txid = unhexlify(utxo['txid'])
-        self.vout = utxo['vout']
-        self.estimated_size = utxo['txin_vsize']
-        self.txout_type = utxo['txouttype']
-        self.need_witness_section = utxo['segwit']
+        self.address = utxo.address
+        self.amount = utxo.amount
+        self.raw_txid = utxo.raw_txid
+        self.vout = utxo.vout
+        self.estimated_size = utxo.txin_vsize
+        self.txout_type = utxo.txouttype
+        self.need_witness_section = utxo.segwit
+        self.txout_id = utxo.txout_id
+        self.witness = None
+        self._raw = self.raw_txid[::-1] + encode_int(self.vout) + encode_varint(0) + encode_int(0xffffffff)
+
+    @property
+    def txid(self):
+        return hexlify(self.raw_txid)
 
     def raw(self):
-        return self.raw_txid[::-1] + encode_int(self.vout) + encode_varint(0) + encode_int(0xffffffff)
+        return self._raw
+
+    def witness_size(self):
+        if self.witness is None:
+            return varint_size(0)
+        return varint_size(len(self.witness)) + sum([ varint_size(len(item)) + len(item) for item in self.witness ])
+
+    def write_witness(self, buf, offset):
+        if self.witness is None:
+            return write_varint(buf, offset, 0)
+        offset = write_varint(buf, offset, len(self.witness))
+        for item in self.witness:
+            offset = write_varint(buf, offset, len(item))
+            offset = write_bytes(buf, offset, item)
+        return offset
 
 
 class TransactionOutput(object):
     def __init__(self, destination_hash, output_type, amount):
         self.set_amount(amount)
         self.script = self.build_output_script(destination_hash, output_type)
+        self._encoded_script = encode_blob(self.script)
+        self.size = 8 + len(self._encoded_script)
 
     def set_amount(self, value):
         self.amount = value
@@ -96,7 +183,11 @@ class TransactionOutput(object):
         raise InvalidHashException('Unsupported transaction ouput type "%s"' % output_type)
 
     def raw(self):
-        return pack('Q', self.satoshis) + encode_blob(self.script)
+        return pack('<Q', self.satoshis) + self._encoded_script
+
+    def write(self, buf, offset):
+        pack_into('<Q', buf, offset, self.satoshis)
+        return write_bytes(buf, offset + 8, self._encoded_script)
 
 
 class UnsignedTransactionBuilder(object):
@@ -109,22 +200,55 @@ class UnsignedTransactionBuilder(object):
         self.feerate = feerate
 
     def estimated_size(self):
-        length = len(self.raw())
+        length = self.serialized_size()
 
-        if len(filter(lambda txin: txin.need_witness_section, self.inputs)) > 0:
+        if any([ txin.need_witness_section for txin in self.inputs ]):
             length += 2     # Witness header flag
 
         length += sum([ txin.estimated_size - len(txin.raw()) for txin in self.inputs ])
 
         return length
 
-    def raw(self):
-        return  encode_int(self.VERSION) + \
-                encode_varint(len(self.inputs)) + \
-                b''.join([ txin.raw() for txin in self.inputs ]) + \
-                encode_varint(len(self.outputs)) + \
-                b''.join([ txout.raw() for txout in self.outputs ]) + \
-                encode_int(0)
+    def has_witness(self):
+        return any([ txin.witness is not None for txin in self.inputs ])
+
+    def serialized_size(self, witness=False):
+        size =  4 + \
+                varint_size(len(self.inputs)) + \
+                sum([ len(txin.raw()) for txin in self.inputs ]) + \
+                varint_size(len(self.outputs)) + \
+                sum([ txout.size for txout in self.outputs ]) + \
+                4
+
+        if witness:
+            size += 2 + sum([ txin.witness_size() for txin in self.inputs ])
+
+        return size
+
+    def raw(self, witness=None):
+        if witness is None:
+            witness = self.has_witness()
+
+        buf = bytearray(self.serialized_size(witness))
+        offset = write_int(buf, 0, self.VERSION)
+
+        if witness:
+            offset = write_bytes(buf, offset, b'\x00\x01')      # Segwit marker and flag
+
+        offset = write_varint(buf, offset, len(self.inputs))
+        for txin in self.inputs:
+            offset = write_bytes(buf, offset, txin.raw())
+
+        offset = write_varint(buf, offset, len(self.outputs))
+        for txout in self.outputs:
+            offset = txout.write(buf, offset)
+
+        if witness:
+            for txin in self.inputs:
+                offset = txin.write_witness(buf, offset)
+
+        write_int(buf, offset, 0)
+        return buf
 
     def required_keys(self):
         return list(set([ txin.address for txin in self.inputs ]))
@@ -150,26 +274,27 @@ class UnsignedTransactionBuilder(object):
             raise NotEnoughCoinsException('Not enough funds to fund return output (current: %f, dust limit: %f)' % (return_amount, DUST_LIMIT))
 
         if not self.fee_is_sane():
-            raise FeeCalculationError()
+            raise FeeCalculationError('Unable to match the required fee (current: %f, required: %f)' % (self.current_fee(), self.required_fee()))
 
     def fund_transaction(self, utxos, return_address):
-        # Step 1: Check if the payout target is within reach (assumes no dust inputs)
-        for utxo in utxos:
-            self.add(TransactionInput(utxo))
+        utxos.sort(key=lambda utxo: utxo.amount)
+        self.fund_transaction_ordered(utxos, return_address)
 
-        if not self.funded():
-            raise NotEnoughCoinsException('Need at least %f for outputs and fees, got only %f in funds' % (self.total_out() + self.required_fee(), self.total_in()))
-
-        # Step 2: Start adding transactions until we hit the target, lowest inputs first
-
-        self.inputs = []
-        utxos.sort(cmp=lambda x, y: 1 if x['amount'] > y['amount'] else -1)
+    def fund_transaction_ordered(self, utxos, return_address):
+        # Step 1: Start adding inputs until we hit the target, lowest inputs first.
+        # utxos may be a lazy iterator ordered by amount, it is not consumed
+        # any further once the transaction is funded
 
         for utxo in utxos:
             self.add(TransactionInput(utxo))
             if self.funded():
                 break
 
+        # Step 2: Check if the payout target was within reach (assumes no dust inputs)
+
+        if not self.funded():
+            raise NotEnoughCoinsException('Need at least %f for outputs and fees, got only %f in funds' % (self.total_out() + self.required_fee(), self.total_in()))
+
         # Step 3: Remove unecessary inputs
 
         self.inputs.reverse()
@@ -215,8 +340,33 @@ class UnsignedTransactionBuilder(object):
         return curfee >= targetfee and curfee < targetfee * Decimal('1.1')
 
 
+class TransactionQuote(object):
+    def __init__(self, unsigned_tx_info, error=None):
+        self.funded = error is None
+        self.error = error
+        self.inputs = len(unsigned_tx_info.inputs)
+        self.total_in = unsigned_tx_info.total_in()
+        self.total_out = unsigned_tx_info.total_out()
+        self.target_feerate = unsigned_tx_info.feerate
+        self.estimated_size = unsigned_tx_info.estimated_size()
+        self.required = self.total_out + unsigned_tx_info.required_fee()
+        self.fee = unsigned_tx_info.current_fee() if self.funded else unsigned_tx_info.required_fee()
+        self.change = unsigned_tx_info.outputs[-1].amount if self.funded and len(unsigned_tx_info.outputs) > 1 else Decimal(0)
+
+    def __iter__(self):
+        yield 'funded', self.funded
+        yield 'error', { 'type': self.error.__class__.__name__, 'message': str(self.error) } if self.error is not None else None
+        yield 'fee', self.fee
+        yield 'feerate', self.target_feerate
+        yield 'vsize', self.estimated_size
+        yield 'inputs', self.inputs
+        yield 'change', self.change
+        yield 'required', self.required
+        yield 'available', self.total_in
+
+
 class SignedTransaction(object):
-    def __init__(self, unsigned_tx_info, raw_signed_tx, coindaemon=None):
+    def __init__(self, unsigned_tx_info, raw_signed_tx, coindaemon=None, reservation=None):
         self.coin = unsigned_tx_info.coin
         self.inputs = unsigned_tx_info.inputs
         self.outputs = unsigned_tx_info.outputs
@@ -226,20 +376,42 @@ class SignedTransaction(object):
         self.target_feerate = unsigned_tx_info.feerate
         self.estimated_size = unsigned_tx_info.estimated_size()
         self.hex = raw_signed_tx
-        self.raw = unhexlify(raw_signed_tx)
-        self.size = len(self.raw)
+        self.size = len(raw_signed_tx) // 2
         self.actual_feerate = self.fee / self.size * 1000
         self.coindaemon = coindaemon
+        self.reservation = reservation
         self.txid = None
         self._seen = False
         self._db_tx_id = None
 
-    def broadcast(self, coindaemon=None, wait_until_seen_on_network=False):
+    @property
+    def raw(self):
+        return unhexlify(self.hex)
+
+    def decode_txid(self, coindaemon=None):
+        return (coindaemon if coindaemon is not None else self.coindaemon).decoderawtransaction(self.hex)['txid']
+
+    def broadcast(self, coindaemon=None, wait_until_seen_on_network=False, on_broadcast=None):
         try:
             self.txid = (coindaemon if coindaemon is not None else self.coindaemon).sendrawtransaction(self.hex)
         except JSONRPCException as e:
+            if self.reservation is not None:
+                self.reservation.release()
             raise TransactionBroadcastException('Could not broadcast transaction to network: Node responded with "%s"' % e)
 
+        # The transaction is out, whoever needs its txid is told before anything
+        # else can fail
+        if on_broadcast is not None:
+            on_broadcast(self.txid)
+
+        # Without the update the reservation simply expires earlier, that must
+        # not turn a completed payment into an error
+        if self.reservation is not None:
+            try:
+                self.reservation.broadcast(self.txid)
+            except Exception as e:
+                print('Could not record broadcast of %s in spend ledger: %s' % (self.txid, e))
+
         if wait_until_seen_on_network:
             self.wait_until_seen_on_network()
 
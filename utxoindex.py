@@ -0,0 +1,127 @@
+from datetime import datetime, timedelta
+from sqlalchemy import func as sqlfunc
+
+from models import AccountAddress
+from indexer.models import TransactionInput, TransactionOutput
+
+
+INDEX_RESYNC_INTERVAL = timedelta(hours=1)
+
+
+class UtxoCountIndex(object):
+    def __init__(self, coin, resync_interval=INDEX_RESYNC_INTERVAL):
+        self.coin = coin
+        self.resync_interval = resync_interval
+        self.counts = {}
+        self.last_binding_id = 0
+        self.last_txout_id = 0
+        self.last_txin_id = 0
+        self.lastsync = datetime.utcfromtimestamp(0)
+
+    def _highest_ids(self, dbsession):
+        return (
+            dbsession.query(sqlfunc.max(TransactionOutput.id)).scalar() or 0,
+            dbsession.query(sqlfunc.max(TransactionInput.id)).scalar() or 0
+        )
+
+    def _new_bindings(self, dbsession):
+        return dbsession.query(
+            AccountAddress.id,
+            AccountAddress.address_id
+        ).filter(
+            AccountAddress.coin == self.coin.ticker,
+            AccountAddress.id > self.last_binding_id
+        ).order_by(AccountAddress.id).all()
+
+    def _count_unspent(self, dbsession, address_ids, max_txout_id, max_txin_id):
+        if len(address_ids) == 0:
+            return []
+
+        return dbsession.query(
+            TransactionOutput.address_id,
+            sqlfunc.count(TransactionOutput.id)
+        ).join(
+            TransactionOutput.spenders.and_(TransactionInput.id <= max_txin_id),
+            isouter=True
+        ).filter(
+            TransactionOutput.address_id.in_(address_ids),
+            TransactionOutput.id <= max_txout_id,
+            TransactionInput.id == None
+        ).group_by(TransactionOutput.address_id).all()
+
+    def _received(self, dbsession, max_txout_id):
+        return dbsession.query(
+            TransactionOutput.address_id,
+            sqlfunc.count(TransactionOutput.id)
+        ).join(
+            AccountAddress,
+            AccountAddress.address_id == TransactionOutput.address_id
+        ).filter(
+            AccountAddress.coin == self.coin.ticker,
+            AccountAddress.id <= self.last_binding_id,
+            TransactionOutput.id > self.last_txout_id,
+            TransactionOutput.id <= max_txout_id
+        ).group_by(TransactionOutput.address_id).all()
+
+    def _spent(self, dbsession, max_txout_id, max_txin_id):
+        return dbsession.query(
+            TransactionOutput.address_id,
+            sqlfunc.count(sqlfunc.distinct(TransactionOutput.id))
+        ).join(
+            TransactionOutput.spenders
+        ).join(
+            AccountAddress,
+            AccountAddress.address_id == TransactionOutput.address_id
+        ).filter(
+            AccountAddress.coin == self.coin.ticker,
+            AccountAddress.id <= self.last_binding_id,
+            TransactionOutput.id <= max_txout_id,
+            TransactionInput.id > self.last_txin_id,
+            TransactionInput.id <= max_txin_id
+        ).group_by(TransactionOutput.address_id).all()
+
+    def _add_bindings(self, dbsession, bindings, max_txout_id, max_txin_id):
+        address_ids = [ address_id for _, address_id in bindings ]
+        for address_id in address_ids:
+            self.counts[address_id] = 0
+        for address_id, utxos in self._count_unspent(dbsession, address_ids, max_txout_id, max_txin_id):
+            self.counts[address_id] = utxos
+        if len(bindings) > 0:
+            self.last_binding_id = bindings[-1][0]
+
+    def rebuild(self, dbsession):
+        max_txout_id, max_txin_id = self._highest_ids(dbsession)
+
+        self.counts = {}
+        self.last_binding_id = 0
+        self._add_bindings(dbsession, self._new_bindings(dbsession), max_txout_id, max_txin_id)
+
+        self.last_txout_id = max_txout_id
+        self.last_txin_id = max_txin_id
+        self.lastsync = datetime.now()
+
+    def update(self, dbsession):
+        if datetime.now() - self.lastsync >= self.resync_interval:
+            return self.rebuild(dbsession)
+
+        max_txout_id, max_txin_id = self._highest_ids(dbsession)
+
+        for address_id, utxos in self._received(dbsession, max_txout_id):
+            self.counts[address_id] = self.counts.get(address_id, 0) + utxos
+        for address_id, utxos in self._spent(dbsession, max_txout_id, max_txin_id):
+            self.counts[address_id] = max(self.counts.get(address_id, 0) - utxos, 0)
+
+        self._add_bindings(dbsession, self._new_bindings(dbsession), max_txout_id, max_txin_id)
+
+        self.last_txout_id = max_txout_id
+        self.last_txin_id = max_txin_id
+
+    def correct(self, address_id, utxos):
+        self.counts[address_id] = utxos
+
+    def candidates(self, min_utxos):
+        return sorted(
+            [ (address_id, utxos) for address_id, utxos in self.counts.items() if utxos >= min_utxos ],
+            key=lambda candidate: candidate[1],
+            reverse=True
+        )
@@ -1,37 +1,92 @@
-from base64 import b64decode
+import json
+
+from base64 import b64decode, urlsafe_b64decode, urlsafe_b64encode
 from binascii import hexlify, unhexlify
+from datetime import datetime
+from decimal import Decimal
+from gevent import joinall, spawn
 from gevent.lock import BoundedSemaphore as Lock
-from sqlalchemy import create_engine, or_
+from sqlalchemy import create_engine, and_, or_
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.session import Session
 from sqlalchemy.sql import func
 
-from pycoin.ecdsa.secp256k1 import secp256k1_generator
-from pycoin.encoding.bytes32 import from_bytes_32
-from pycoin.key.Key import Key
-
 from coinsupport.addresscodecs import decode_base58_address, decode_privkey
 
-from coininfo import COINS, Coin
+from cache import TimedCache
+from coininfo import COINS, Coin, CoinNotDefinedException
 from connections import connectionmanager
+from feeestimator import feeestimator, PRIORITY_LOW, PRIORITY_NORMAL
 from keyseeder import generate_key
+from metrics import timed_lock
+from spendledger import InputsAlreadySpentException, pending_spends, reserve_inputs
 from models import *
-from transaction import UnsignedTransactionBuilder, SignedTransaction, FEERATE_NETWORK, FEERATE_POOLSUBSIDY, TransactionInput as UnsignedTransactionInput, NotEnoughCoinsException
+from transaction import TXIN_VSIZES, UnsignedTransactionBuilder, SignedTransaction, TransactionQuote, TransactionInput as UnsignedTransactionInput, FeeCalculationError, NotEnoughCoinsException, Utxo
 from indexer import import_address
 from indexer.models import *
+from indexer.postprocessor import convert_date
 
 
 MIN_CONSOLIDATION_UTXOS = 100
 MAX_CONSOLIDATION_UTXOS = 650
 
+UTXO_SNAPSHOT_TTL = 5
+UTXO_SNAPSHOT_CACHE = TimedCache(4096, UTXO_SNAPSHOT_TTL)
+
+UTXO_SELECTION_PAGE_SIZE = 32
+UTXO_SELECTION_MAX_PAGE_SIZE = 2048
+UTXO_STREAM_BATCH_SIZE = 1000
+
+# Another API worker may reserve the selected inputs first, selection is then
+# repeated without them
+TRANSACTION_RESERVATION_ATTEMPTS = 3
+
+HISTORY_CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+PrivateKeyClass = None
+
+
+def PrivateKey(raw_key):
+    # pycoin is only loaded when a private key is actually needed
+    global PrivateKeyClass
+    from pycoin.encoding.bytes32 import from_bytes_32
+
+    if PrivateKeyClass is None:
+        from pycoin.ecdsa.secp256k1 import secp256k1_generator
+        from pycoin.key.Key import Key
+        PrivateKeyClass = Key.make_subclass(None, secp256k1_generator)
+    return PrivateKeyClass(from_bytes_32(raw_key))
+
 
-TXIN_VSIZES = {
-    TXOUT_TYPES.P2PKH:  149,
-    TXOUT_TYPES.P2WPKH: 68
-}
+def encode_history_cursor(entry):
+    return urlsafe_b64encode(json.dumps([ entry.time.strftime(HISTORY_CURSOR_TIME_FORMAT), entry.coin.ticker, entry.tx_id ]).encode('utf-8')).decode('ascii')
 
 
-PrivateKey = lambda raw_key: Key.make_subclass(None, secp256k1_generator)(from_bytes_32(raw_key))
+def decode_history_cursor(cursor):
+    try:
+        time, ticker, tx_id = json.loads(urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return datetime.strptime(time, HISTORY_CURSOR_TIME_FORMAT), Coin.by_ticker(ticker).ticker, int(tx_id)
+    except (TypeError, ValueError, UnicodeError, CoinNotDefinedException):
+        raise ValueError('Invalid cursor')
+
+
+def merge_descending(iterables, key):
+    heads = []
+    for iterator in [ iter(iterable) for iterable in iterables ]:
+        for item in iterator:
+            heads.append([ item, iterator ])
+            break
+
+    while len(heads) > 0:
+        head = max(heads, key=lambda head: key(head[0]))
+        yield head[0]
+
+        for item in head[1]:
+            head[0] = item
+            break
+        else:
+            heads.remove(head)
 
 
 class AccountExistsException(Exception):
@@ -68,7 +123,7 @@ class Wallet(object):
         if type(name) not in (str, unicode) or len(name.encode('utf-8')) > ACCOUNT_NAME_LEN:
             raise InvalidAccountName(name)
 
-        with self.account_create_lock:
+        with timed_lock(self.account_create_lock, 'account_create'):
             db = db_session if db_session is not None else connectionmanager.database_session()
             existing_account = db.query(Account).filter(
                 Account.manager_id == self.manager.id,
@@ -148,20 +203,79 @@ class Wallet(object):
         return WalletAccount(self, account) if account != None else None
 
 
+class TransactionHistoryEntry(object):
+    __slots__ = [ 'coin', 'tx_id', 'txid', 'time', 'confirmed', 'received', 'sent' ]
+
+    def __init__(self, coin, tx_id, txid, time, confirmed):
+        self.coin = coin
+        self.tx_id = tx_id
+        self.txid = txid
+        self.time = time
+        self.confirmed = confirmed
+        self.received = Decimal(0)
+        self.sent = Decimal(0)
+
+    @property
+    def key(self):
+        return self.time, self.coin.ticker, self.tx_id
+
+    def __iter__(self):
+        txid = hexlify(self.txid)
+        yield 'coin', self.coin.ticker
+        yield 'txid', txid
+        yield 'time', convert_date(self.time)
+        yield 'confirmed', self.confirmed
+        yield 'received', self.received
+        yield 'sent', self.sent
+        yield 'amount', self.received - self.sent
+        yield 'href', make_tx_ref(self.coin, txid)
+
+
 class WalletAccount(object):
     def __init__(self, wallet, account):
         self.wallet = wallet
         self.model = account
         self.addresses = {coin.ticker: WalletAddress(self, coin) for coin in COINS}
 
+    def transactions(self, limit, before=None):
+        # Every coin fetches one entry more than requested, so whether there is a
+        # next page is known without another round trip
+        fetches = [ spawn(address.transactions, limit + 1, before=before) for address in self.addresses.values() ]
+        joinall(fetches, raise_error=True)
+
+        merged = merge_descending([ fetch.value for fetch in fetches ], key=lambda entry: entry.key)
+        entries = []
+        for entry in merged:
+            if len(entries) == limit:
+                return entries, encode_history_cursor(entries[-1])
+            entries.append(entry)
+
+        return entries, None
+
+    def close(self):
+        for address in self.addresses.values():
+            address.close()
+
 
 class WalletAddress(object):
     def __init__(self, account, coin):
         self.account = account
         self.coin = coin
         self.db = connectionmanager.database_session(coin=self.coin)
+        self._replica_db = None
         self._addresses = None
 
+    @property
+    def replica_db(self):
+        if self._replica_db is None:
+            self._replica_db = connectionmanager.database_session(coin=self.coin, readonly=True)
+        return self._replica_db
+
+    def close(self):
+        self.db.close()
+        if self._replica_db is not None:
+            self._replica_db.close()
+
     @property
     def address_ids(self):
         if self._addresses is None:
@@ -187,12 +301,29 @@ class WalletAddress(object):
     def daemon(self):
         return connectionmanager.coindaemon(self.coin)
 
-    def query_utxoset(self, colums, include_unconfirmed=False, include_immature=False, max_utxos=None):
-        do_limit_utxos = lambda x: x if max_utxos is None else x.order_by(TransactionOutput.id).limit(max_utxos)
+    def query_utxoset(self, colums, include_unconfirmed=False, include_immature=False, max_utxos=None, min_amount=None, max_amount=None, txout_types=None, unconfirmed_only=False, after_id=None, readonly=False, exclude_pending_spends=False, pending=None):
+        db = self.replica_db if readonly else self.db
+
+        def do_limit_utxos(query):
+            if min_amount is not None:
+                query = query.filter(TransactionOutput.amount >= min_amount)
+            if max_amount is not None:
+                query = query.filter(TransactionOutput.amount <= max_amount)
+            if txout_types is not None:
+                query = query.filter(TransactionOutput.type_id.in_([ TXOUT_TYPES.internal_id(txout_type) for txout_type in txout_types ]))
+            if unconfirmed_only:
+                query = query.filter(Transaction.confirmation == None)
+            if after_id is not None:
+                query = query.filter(TransactionOutput.id > after_id)
+            if exclude_pending_spends:
+                excluded = pending if pending is not None else pending_spends(self.coin)
+                if len(excluded) > 0:
+                    query = query.filter(~TransactionOutput.id.in_(excluded))
+            return query if max_utxos is None else query.order_by(TransactionOutput.id).limit(max_utxos)
 
         if include_unconfirmed and include_immature:
             return do_limit_utxos(
-                self.db.query(*colums).join(
+                db.query(*colums).join(
                     Address
                 ).join(
                     TransactionOutput.transaction
@@ -209,7 +340,7 @@ class WalletAddress(object):
 
         if include_unconfirmed:
             return do_limit_utxos(
-                self.db.query(*colums).join(
+                db.query(*colums).join(
                     Address
                 ).join(
                     TransactionOutput.transaction
@@ -235,7 +366,7 @@ class WalletAddress(object):
             )
 
         return do_limit_utxos(
-            self.db.query(*colums).join(
+            db.query(*colums).join(
                 Address
             ).join(
                 TransactionOutput.transaction
@@ -261,16 +392,18 @@ class WalletAddress(object):
         )
 
 
-    def balance(self, include_unconfirmed=False, include_immature=False):
+    def balance(self, include_unconfirmed=False, include_immature=False, exclude_pending_spends=False, readonly=True):
         return self.query_utxoset(
             (
                 func.sum(TransactionOutput.amount),
             ),
             include_unconfirmed=include_unconfirmed,
-            include_immature=include_immature
-        ).first()[0]
+            include_immature=include_immature,
+            readonly=readonly,
+            exclude_pending_spends=exclude_pending_spends
+        ).first()[0] or Decimal(0)
 
-    def walletinfo(self, include_unconfirmed=False, include_immature=False):
+    def walletinfo(self, include_unconfirmed=False, include_immature=False, readonly=True):
         results = self.query_utxoset(
             (
                 func.count(TransactionOutput.id),
@@ -278,50 +411,200 @@ class WalletAddress(object):
                 Address.address
             ),
             include_unconfirmed=include_unconfirmed,
-            include_immature=include_immature
+            include_immature=include_immature,
+            readonly=readonly
         ).group_by(Address.id).all()
 
         return { address: { 'balance': balance, 'utxos': utxos } for utxos, balance, address in results }
 
-    def utxos(self, include_unconfirmed=False, max_utxos=None):
-        return [{
-                'txid':         hexlify(txid),
-                'vout':         int(vout),
-                'txouttype':    TXOUT_TYPES.resolve(txtype),
-                'segwit':       TXOUT_TYPES.resolve(txtype) in [ TXOUT_TYPES.P2WPKH, TXOUT_TYPES.P2WSH ],
-                'txin_vsize':   TXIN_VSIZES[TXOUT_TYPES.resolve(txtype)],
-                'amount':       amount,
-                'address':      address
-            } for _, address, txid, vout, txtype, amount in self.query_utxoset(
-                (
-                    TransactionOutput.id,
-                    Address.address,
-                    Transaction.txid,
-                    TransactionOutput.index,
-                    TransactionOutput.type_id,
-                    TransactionOutput.amount
-                ),
+    UTXO_COLUMNS = (
+        TransactionOutput.id,
+        Address.address,
+        Transaction.txid,
+        TransactionOutput.index,
+        TransactionOutput.type_id,
+        TransactionOutput.amount
+    )
+
+    @staticmethod
+    def _make_utxos(rows, txouttypes):
+        for utxo_id, address, txid, vout, txtype, amount in rows:
+            if txtype not in txouttypes:
+                txouttypes[txtype] = TXOUT_TYPES.resolve(txtype)
+            yield Utxo(address, txid, int(vout), txouttypes[txtype], amount, utxo_id)
+
+    def utxos(self, include_unconfirmed=False, max_utxos=None, readonly=False):
+        return list(self._make_utxos(
+            self.query_utxoset(
+                self.UTXO_COLUMNS,
                 include_unconfirmed=include_unconfirmed,
-                max_utxos=max_utxos
-            ).all()
-        ]
+                max_utxos=max_utxos,
+                readonly=readonly,
+                exclude_pending_spends=True
+            ).all(),
+            {}
+        ))
+
+    def stream_utxos(self, limit, after_id=None, batch_size=UTXO_STREAM_BATCH_SIZE, **filters):
+        # Yields (id, utxo) ordered by output id, reading the rows through a
+        # server-side cursor instead of buffering the whole page
+        txouttypes = {}
+
+        for utxo_id, address, txid, vout, txtype, amount in self.query_utxoset(
+                self.UTXO_COLUMNS,
+                max_utxos=limit,
+                after_id=after_id,
+                readonly=True,
+                **filters
+            ).yield_per(batch_size):
+            if txtype not in txouttypes:
+                txouttypes[txtype] = TXOUT_TYPES.resolve(txtype)
+            yield utxo_id, Utxo(address, txid, int(vout), txouttypes[txtype], amount, utxo_id)
+
+    def utxos_by_amount(self, include_unconfirmed=False, min_amount=None, page_size=UTXO_SELECTION_PAGE_SIZE):
+        # Lazily yields the unspent outputs ordered by amount (lowest first), fetched
+        # in keyset pages on (amount, id) that grow while the caller keeps consuming
+        txouttypes = {}
+        last = None
+        pending = pending_spends(self.coin)
+
+        while True:
+            query = self.query_utxoset(self.UTXO_COLUMNS, include_unconfirmed=include_unconfirmed, min_amount=min_amount, exclude_pending_spends=True, pending=pending)
+            if last is not None:
+                query = query.filter(or_(
+                    TransactionOutput.amount > last[1],
+                    and_(TransactionOutput.amount == last[1], TransactionOutput.id > last[0])
+                ))
+
+            rows = query.order_by(TransactionOutput.amount, TransactionOutput.id).limit(page_size).all()
+            for utxo in self._make_utxos(rows, txouttypes):
+                yield utxo
+
+            if len(rows) < page_size:
+                return
+            last = (rows[-1][0], rows[-1][-1])
+            page_size = min(page_size * 2, UTXO_SELECTION_MAX_PAGE_SIZE)
+
+    def _history_keyset(self, before):
+        time, ticker, tx_id = before
+        if self.coin.ticker < ticker:
+            return Transaction.firstseen <= time
+        if self.coin.ticker > ticker:
+            return Transaction.firstseen < time
+        return or_(
+            Transaction.firstseen < time,
+            and_(Transaction.firstseen == time, Transaction.id < tx_id)
+        )
+
+    def transactions(self, limit, before=None):
+        if len(self.address_ids) == 0:
+            return []
+
+        db = self.replica_db
+        columns = (Transaction.id, Transaction.txid, Transaction.firstseen, Transaction.confirmation != None)
+        received = db.query(*columns).select_from(
+            TransactionOutput
+        ).join(
+            TransactionOutput.transaction
+        ).filter(
+            TransactionOutput.address_id.in_(self.address_ids)
+        )
+        sent = db.query(*columns).select_from(
+            TransactionOutput
+        ).join(
+            TransactionOutput.spenders
+        ).join(
+            TransactionInput.transaction
+        ).filter(
+            TransactionOutput.address_id.in_(self.address_ids)
+        )
 
-    def transaction(self, destination_address, amount, return_address=None, spend_unconfirmed=False, subsidized=False):
+        candidates = {}
+        for query in (received, sent):
+            if before is not None:
+                query = query.filter(self._history_keyset(before))
+            for tx_id, txid, time, confirmed in query.distinct().order_by(Transaction.firstseen.desc(), Transaction.id.desc()).limit(limit):
+                candidates[tx_id] = TransactionHistoryEntry(self.coin, tx_id, txid, time, bool(confirmed))
+
+        entries = sorted(candidates.values(), key=lambda entry: entry.key, reverse=True)[:limit]
+        if len(entries) == 0:
+            return entries
+        entries_by_id = { entry.tx_id: entry for entry in entries }
+
+        for tx_id, amount in db.query(
+            Transaction.id,
+            func.sum(TransactionOutput.amount)
+        ).select_from(
+            TransactionOutput
+        ).join(
+            TransactionOutput.transaction
+        ).filter(
+            TransactionOutput.address_id.in_(self.address_ids),
+            Transaction.id.in_(entries_by_id.keys())
+        ).group_by(Transaction.id):
+            entries_by_id[tx_id].received = amount
+
+        for tx_id, amount in db.query(
+            Transaction.id,
+            func.sum(TransactionOutput.amount)
+        ).select_from(
+            TransactionOutput
+        ).join(
+            TransactionOutput.spenders
+        ).join(
+            TransactionInput.transaction
+        ).filter(
+            TransactionOutput.address_id.in_(self.address_ids),
+            Transaction.id.in_(entries_by_id.keys())
+        ).group_by(Transaction.id):
+            entries_by_id[tx_id].sent = amount
+
+        return entries
+
+    def feerate(self, priority=PRIORITY_NORMAL, subsidized=False):
+        return feeestimator.feerate(self.coin, priority=priority, subsidized=subsidized)
+
+    def utxo_snapshot(self, include_unconfirmed=False):
+        return UTXO_SNAPSHOT_CACHE.get_or_compute(
+            (self.coin.ticker, self.account.model.id, include_unconfirmed),
+            lambda: self.utxos(include_unconfirmed=include_unconfirmed, readonly=True)
+        )
+
+    def quote(self, destination_address, amount, return_address=None, spend_unconfirmed=False, priority=PRIORITY_NORMAL, subsidized=False):
         if return_address is None:
             return_address = self.preferred_change_address
 
-        tx = UnsignedTransactionBuilder(self.coin, feerate=(FEERATE_NETWORK if not subsidized or not self.coin.allow_tx_subsidy else FEERATE_POOLSUBSIDY))
+        tx = UnsignedTransactionBuilder(self.coin, feerate=self.feerate(priority, subsidized))
         tx.add_output(destination_address, amount)
 
-        with self.account.wallet.tx_create_lock:
-            tx.fund_transaction(self.utxos(include_unconfirmed=spend_unconfirmed), return_address)
-            return self.sign_transaction(tx)
+        try:
+            tx.fund_transaction(list(self.utxo_snapshot(include_unconfirmed=spend_unconfirmed)), return_address)
+        except (NotEnoughCoinsException, FeeCalculationError) as e:
+            return TransactionQuote(tx, error=e)
+        return TransactionQuote(tx)
+
+    def transaction(self, destination_address, amount, return_address=None, spend_unconfirmed=False, priority=PRIORITY_NORMAL, subsidized=False, min_input_amount=None):
+        if return_address is None:
+            return_address = self.preferred_change_address
+
+        feerate = self.feerate(priority, subsidized)
+
+        with timed_lock(self.account.wallet.tx_create_lock, 'tx_create'):
+            for attempt in range(TRANSACTION_RESERVATION_ATTEMPTS):
+                tx = UnsignedTransactionBuilder(self.coin, feerate=feerate)
+                tx.add_output(destination_address, amount)
+                tx.fund_transaction_ordered(self.utxos_by_amount(include_unconfirmed=spend_unconfirmed, min_amount=min_input_amount), return_address)
+                try:
+                    return self.sign_transaction(tx)
+                except InputsAlreadySpentException:
+                    if attempt == TRANSACTION_RESERVATION_ATTEMPTS - 1:
+                        raise
 
     def consolidate(self, destination_address=None, include_unconfirmed=False, subsidized=False, max_utxos=MAX_CONSOLIDATION_UTXOS):
         if destination_address is None:
             destination_address = self.preferred_change_address
 
-        tx = UnsignedTransactionBuilder(self.coin, feerate=(FEERATE_NETWORK if not subsidized or not self.coin.allow_tx_subsidy else FEERATE_POOLSUBSIDY))
+        tx = UnsignedTransactionBuilder(self.coin, feerate=self.feerate(PRIORITY_LOW, subsidized))
 
         for utxo in self.utxos(include_unconfirmed=include_unconfirmed, max_utxos=max_utxos):
             tx.add(UnsignedTransactionInput(utxo))
@@ -331,17 +614,19 @@ class WalletAddress(object):
 
     def process_automatic_payment(self, destination_address, amount, zero_balance_payment=False):
         utxos = self.utxos(include_unconfirmed=True, max_utxos=MAX_CONSOLIDATION_UTXOS)
-        balance = sum([ utxo['amount'] for utxo in utxos ])
+        balance = sum([ utxo.amount for utxo in utxos ])
 
         try:
-            tx = UnsignedTransactionBuilder(self.coin, feerate=(FEERATE_NETWORK if not self.coin.allow_tx_subsidy else FEERATE_POOLSUBSIDY))
+            tx = UnsignedTransactionBuilder(self.coin, feerate=self.feerate(PRIORITY_NORMAL, subsidized=True))
             if zero_balance_payment:
                 if amount == 0.0:
                     for utxo in utxos:
                         tx.add(UnsignedTransactionInput(utxo))
                     tx.add_return_output(destination_address)
                 else:
-                    immature_balance = self.balance(include_unconfirmed=True, include_immature=True)
+                    # Both figures come from the primary and exclude the same pending
+                    # spends, so neither replica lag nor those change the amount kept
+                    immature_balance = self.balance(include_unconfirmed=True, include_immature=True, exclude_pending_spends=True, readonly=False)
                     keep_amount = amount + balance - immature_balance
                     if keep_amount <= 0.0:
                         keep_amount = 0.0
@@ -369,4 +654,6 @@ class WalletAddress(object):
     def sign_transaction(self, transaction):
         daemon = self.daemon()
         encoded_private_key = self.coin.encode_private_key(self.account.model.private_key)
-        return SignedTransaction(transaction, daemon.sign_transaction(hexlify(transaction.raw()), [ encoded_private_key ]), coindaemon=daemon)
+        raw_signed_tx = daemon.sign_transaction(hexlify(transaction.raw()), [ encoded_private_key ])
+        reservation = reserve_inputs(self.coin, [ txin.txout_id for txin in transaction.inputs if txin.txout_id is not None ])
+        return SignedTransaction(transaction, raw_signed_tx, coindaemon=daemon, reservation=reservation)
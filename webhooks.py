@@ -0,0 +1,479 @@
+from gevent import monkey; monkey.patch_all()
+
+import hmac
+import json
+import socket
+
+from binascii import hexlify
+from datetime import datetime, timedelta
+from gevent import sleep
+from gevent.pool import Pool
+from hashlib import sha256
+from httplib import HTTPConnection, HTTPSConnection
+from sqlalchemy import func as sqlfunc
+from struct import unpack
+from time import time
+from urlparse import urlparse
+
+import config
+from coininfo import COINS
+from connections import connectionmanager
+from models import Account, AccountAddress, DepositCursor, PendingDeposit, Webhook, WebhookEvent, make_tx_ref
+
+from indexer.logger import log_event
+from indexer.models import Address, Transaction, TransactionInput, TransactionOutput
+
+
+WEBHOOK_WORKERS = getattr(config, 'WEBHOOK_WORKERS', 8)
+WEBHOOK_TIMEOUT = getattr(config, 'WEBHOOK_TIMEOUT', 10)
+WEBHOOK_ALLOW_PRIVATE_HOSTS = getattr(config, 'WEBHOOK_ALLOW_PRIVATE_HOSTS', False)
+WEBHOOK_POLL_INTERVAL = 1
+
+INDEX_RESYNC_INTERVAL = timedelta(hours=1)
+ENDPOINT_RELOAD_INTERVAL = timedelta(seconds=30)
+TXOUT_SCAN_BATCH_SIZE = 10000
+
+MAX_BATCH_SIZE = 100
+RETRY_BASE_DELAY = 1
+RETRY_MAX_DELAY = 600
+
+EVENT_DEPOSIT_PENDING = 'deposit.pending'
+EVENT_DEPOSIT_CONFIRMED = 'deposit.confirmed'
+
+# Loopback, private, link-local, shared, benchmarking, multicast and reserved ranges
+NON_PUBLIC_IPV4_NETWORKS = [
+    ('0.0.0.0', 8), ('10.0.0.0', 8), ('100.64.0.0', 10), ('127.0.0.0', 8), ('169.254.0.0', 16),
+    ('172.16.0.0', 12), ('192.0.0.0', 24), ('192.168.0.0', 16), ('198.18.0.0', 15), ('224.0.0.0', 3)
+]
+
+
+def _ipv4_is_public(address):
+    value = unpack('!I', socket.inet_aton(address))[0]
+    for network, prefix in NON_PUBLIC_IPV4_NETWORKS:
+        mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+        if value & mask == unpack('!I', socket.inet_aton(network))[0]:
+            return False
+    return True
+
+
+def _ipv6_is_public(address):
+    raw = bytearray(socket.inet_pton(socket.AF_INET6, address.split('%')[0]))
+    if raw[:12] == bytearray(b'\x00' * 10 + b'\xff\xff'):
+        return _ipv4_is_public(socket.inet_ntoa(bytes(raw[12:])))
+    if raw[:15] == bytearray(15) and raw[15] in (0, 1):
+        return False
+    if raw[0] & 0xfe == 0xfc or raw[0] == 0xff or (raw[0] == 0xfe and raw[1] & 0xc0 == 0x80):
+        return False
+    return True
+
+
+def is_public_host(hostname):
+    try:
+        addresses = socket.getaddrinfo(hostname, None)
+    except socket.gaierror:
+        return False
+
+    for family, _, _, _, sockaddr in addresses:
+        if family == socket.AF_INET and not _ipv4_is_public(sockaddr[0]):
+            return False
+        if family == socket.AF_INET6 and not _ipv6_is_public(sockaddr[0]):
+            return False
+    return len(addresses) > 0
+
+
+def valid_webhook_url(url):
+    # Webhooks are posted from inside the network, so unless configured
+    # otherwise they may only point at hosts that resolve to public addresses
+    try:
+        target = urlparse(url)
+    except ValueError:
+        return False
+    if target.scheme not in ('http', 'https') or not target.hostname:
+        return False
+    return WEBHOOK_ALLOW_PRIVATE_HOSTS or is_public_host(target.hostname)
+
+
+class AddressIndex(object):
+    def __init__(self, coin, resync_interval=INDEX_RESYNC_INTERVAL):
+        self.coin = coin
+        self.resync_interval = resync_interval
+        self.accounts = {}
+        self.last_binding_id = 0
+        self.lastsync = datetime.utcfromtimestamp(0)
+
+    def update(self, db, now=None):
+        if now is None:
+            now = datetime.now()
+
+        # Bindings are only ever added while accounts exist, a periodic rebuild
+        # drops the ones of deleted accounts
+        if now - self.lastsync >= self.resync_interval:
+            self.accounts = {}
+            self.last_binding_id = 0
+            self.lastsync = now
+
+        for binding_id, address_id, manager_id, account_id, user in db.query(
+            AccountAddress.id,
+            AccountAddress.address_id,
+            Account.manager_id,
+            Account.id,
+            Account.user
+        ).join(
+            AccountAddress.account
+        ).filter(
+            AccountAddress.coin == self.coin.ticker,
+            AccountAddress.id > self.last_binding_id
+        ).order_by(AccountAddress.id):
+            self.accounts[address_id] = (manager_id, account_id, user)
+            self.last_binding_id = binding_id
+
+    def get(self, address_id):
+        return self.accounts.get(address_id)
+
+
+class Deposit(object):
+    __slots__ = [ 'coin', 'txout_id', 'tx_id', 'txid', 'vout', 'amount', 'address', 'manager_id', 'user', 'seen' ]
+
+    def __init__(self, coin, txout_id, tx_id, txid, vout, amount, address, manager_id, user, seen):
+        self.coin = coin
+        self.txout_id = txout_id
+        self.tx_id = tx_id
+        self.txid = txid
+        self.vout = vout
+        self.amount = amount
+        self.address = address
+        self.manager_id = manager_id
+        self.user = user
+        self.seen = seen
+
+    def event(self, event_type):
+        txid = hexlify(self.txid)
+        return {
+            'id': '%s:%d:%s' % (self.coin.ticker, self.txout_id, event_type),
+            'type': event_type,
+            'coin': self.coin.ticker,
+            'user': self.user,
+            'address': self.address,
+            'txid': txid,
+            'vout': self.vout,
+            'amount': float(self.amount),
+            'href': make_tx_ref(self.coin, txid)
+        }
+
+    def dbobject(self):
+        info = PendingDeposit()
+        info.coin = self.coin.ticker
+        info.txout_id = self.txout_id
+        info.tx_id = self.tx_id
+        info.txid = self.txid
+        info.vout = self.vout
+        info.amount = self.amount
+        info.address = self.address
+        info.manager_id = self.manager_id
+        info.user = self.user
+        info.seen = self.seen
+        return info
+
+    @classmethod
+    def from_dbobject(cls, coin, info):
+        return cls(coin, info.txout_id, info.tx_id, info.txid, info.vout, info.amount, info.address, info.manager_id, info.user, info.seen)
+
+
+class DepositWatcher(object):
+    # The scan position and the unconfirmed deposits are kept in the wallet
+    # database, so a restart neither skips deposits nor their confirmation
+    def __init__(self, coin):
+        self.coin = coin
+        self.index = AddressIndex(coin)
+        self.last_txout_id = None
+        self.pending = {}
+
+    def _new_outputs(self, coin_db):
+        return coin_db.query(
+            TransactionOutput.id,
+            TransactionOutput.address_id
+        ).filter(
+            TransactionOutput.id > self.last_txout_id
+        ).order_by(TransactionOutput.id).limit(TXOUT_SCAN_BATCH_SIZE).all()
+
+    def _deposits(self, coin_db, txout_ids, now):
+        rows = coin_db.query(
+            TransactionOutput.id,
+            TransactionOutput.address_id,
+            TransactionOutput.index,
+            TransactionOutput.amount,
+            Transaction.id,
+            Transaction.txid,
+            Transaction.confirmation != None,
+            Address.address
+        ).join(
+            TransactionOutput.transaction
+        ).join(
+            Address,
+            Address.id == TransactionOutput.address_id
+        ).filter(
+            TransactionOutput.id.in_(txout_ids)
+        ).all()
+
+        # Change of our own sends goes back to the sending account, that is not a deposit
+        spending_accounts = set()
+        for tx_id, address_id in coin_db.query(
+            Transaction.id,
+            TransactionOutput.address_id
+        ).select_from(
+            TransactionOutput
+        ).join(
+            TransactionOutput.spenders
+        ).join(
+            TransactionInput.transaction
+        ).filter(
+            Transaction.id.in_(list(set([ row[4] for row in rows ])))
+        ).distinct():
+            binding = self.index.get(address_id)
+            if binding is not None:
+                spending_accounts.add((tx_id, binding[1]))
+
+        deposits = []
+        for txout_id, address_id, vout, amount, tx_id, txid, confirmed, address in rows:
+            manager_id, account_id, user = self.index.get(address_id)
+            if (tx_id, account_id) in spending_accounts:
+                continue
+            deposits.append((Deposit(self.coin, txout_id, tx_id, txid, vout, amount, address, manager_id, user, now), bool(confirmed)))
+        return deposits
+
+    def _transaction_states(self, coin_db):
+        if len(self.pending) == 0:
+            return {}
+        return { tx_id: (bool(confirmed), bool(doublespent)) for tx_id, confirmed, doublespent in coin_db.query(
+            Transaction.id,
+            Transaction.confirmation != None,
+            Transaction.doublespends_id != None
+        ).filter(
+            Transaction.id.in_(list(set([ deposit.tx_id for deposit in self.pending.values() ])))
+        ).all() }
+
+    def _load(self, coin_db, wallet_db):
+        cursor = wallet_db.query(DepositCursor).filter(DepositCursor.coin == self.coin.ticker).first()
+        if cursor is None:
+            # Only a watcher that never ran for this coin starts at the chain tip
+            cursor = DepositCursor()
+            cursor.coin = self.coin.ticker
+            cursor.txout_id = coin_db.query(sqlfunc.max(TransactionOutput.id)).scalar() or 0
+            wallet_db.add(cursor)
+            wallet_db.commit()
+
+        self.last_txout_id = cursor.txout_id
+        self.pending = { info.txout_id: Deposit.from_dbobject(self.coin, info) for info in wallet_db.query(PendingDeposit).filter(PendingDeposit.coin == self.coin.ticker).all() }
+
+    def poll(self, coin_db, wallet_db, outbox, now=None):
+        if self.last_txout_id is None:
+            self._load(coin_db, wallet_db)
+
+        try:
+            return self._poll(coin_db, wallet_db, outbox, now)
+        except Exception:
+            # Start over from what was stored, the events of this poll are
+            # produced again by the next one
+            wallet_db.rollback()
+            self.last_txout_id = None
+            raise
+
+    def _poll(self, coin_db, wallet_db, outbox, now=None):
+        if now is None:
+            now = datetime.now()
+
+        self.index.update(wallet_db, now=now)
+        events = []
+        settled = []
+
+        # Deposits that got mined since the last poll, either while we were
+        # scanning the mempool or in a block that is only now being indexed.
+        # They are tracked until then, however long it takes, unless their
+        # transaction got double spent or dropped from the index
+        states = self._transaction_states(coin_db)
+        for txout_id, deposit in list(self.pending.items()):
+            confirmed, doublespent = states.get(deposit.tx_id, (False, True))
+            if confirmed:
+                events.append((deposit.manager_id, deposit.event(EVENT_DEPOSIT_CONFIRMED)))
+            elif doublespent:
+                log_event('Drop', 'Dep', hexlify(deposit.txid), 'manager %d' % deposit.manager_id)
+            else:
+                continue
+            settled.append(txout_id)
+            del self.pending[txout_id]
+
+        outputs = self._new_outputs(coin_db)
+        txout_ids = [ txout_id for txout_id, address_id in outputs if self.index.get(address_id) is not None ]
+
+        new_deposits = self._deposits(coin_db, txout_ids, now) if len(txout_ids) > 0 else []
+        for deposit, confirmed in new_deposits:
+            if confirmed:
+                events.append((deposit.manager_id, deposit.event(EVENT_DEPOSIT_CONFIRMED)))
+            else:
+                events.append((deposit.manager_id, deposit.event(EVENT_DEPOSIT_PENDING)))
+                self.pending[deposit.txout_id] = deposit
+                wallet_db.add(deposit.dbobject())
+
+        if len(settled) > 0:
+            wallet_db.query(PendingDeposit).filter(
+                PendingDeposit.coin == self.coin.ticker,
+                PendingDeposit.txout_id.in_(settled)
+            ).delete(synchronize_session=False)
+        if len(outputs) > 0:
+            self.last_txout_id = outputs[-1][0]
+            wallet_db.query(DepositCursor).filter(DepositCursor.coin == self.coin.ticker).update({ DepositCursor.txout_id: self.last_txout_id }, synchronize_session=False)
+
+        # The events are stored in the same transaction that moves the cursor
+        # past them, so they are either delivered eventually or produced again
+        for manager_id, event in events:
+            outbox.enqueue(wallet_db, manager_id, event)
+        wallet_db.commit()
+
+        return events
+
+
+def sign_payload(secret, timestamp, body):
+    return hmac.new(secret.encode('ascii'), ('%d.' % timestamp).encode('ascii') + body, sha256).hexdigest()
+
+
+def post_events(url, secret, events, timeout=WEBHOOK_TIMEOUT):
+    body = json.dumps({ 'events': events }).encode('utf-8')
+    timestamp = int(time())
+    target = urlparse(url)
+    path = (target.path or '/') + ('?' + target.query if target.query else '')
+
+    connection = (HTTPSConnection if target.scheme == 'https' else HTTPConnection)(target.netloc, timeout=timeout)
+    try:
+        connection.request('POST', path, body, {
+            'Content-Type': 'application/json',
+            'X-Wallet-Timestamp': str(timestamp),
+            'X-Wallet-Signature': 'sha256=%s' % sign_payload(secret, timestamp, body)
+        })
+        response = connection.getresponse()
+        response.read()
+        return 200 <= response.status < 300
+    finally:
+        connection.close()
+
+
+class ManagerQueue(object):
+    def __init__(self):
+        self.failures = 0
+        self.nextattempt = 0
+        self.busy = False
+
+    def ready(self, now):
+        return not self.busy and now >= self.nextattempt
+
+    def backoff(self, now):
+        self.failures += 1
+        self.nextattempt = now + min(RETRY_BASE_DELAY * 2 ** (self.failures - 1), RETRY_MAX_DELAY)
+
+
+class WebhookDispatcher(object):
+    def __init__(self, workers=WEBHOOK_WORKERS):
+        self.pool = Pool(workers)
+        self.endpoints = {}
+        self.queues = {}
+        self.lastreload = datetime.utcfromtimestamp(0)
+
+    def reload_endpoints(self, db, now=None):
+        if now is None:
+            now = datetime.now()
+        if now - self.lastreload < ENDPOINT_RELOAD_INTERVAL:
+            return
+        self.lastreload = now
+        self.endpoints = { manager_id: (url, secret) for manager_id, url, secret in db.query(Webhook.manager_id, Webhook.url, Webhook.secret).all() }
+
+    def enqueue(self, db, manager_id, event):
+        # Events wait in the database until the manager's endpoint accepted
+        # them, however long it is down and across restarts
+        if manager_id not in self.endpoints:
+            return
+
+        info = WebhookEvent()
+        info.manager_id = manager_id
+        info.event = json.dumps(event)
+        info.created = datetime.now()
+        db.add(info)
+
+    def deliver(self, manager_id, queue):
+        db = connectionmanager.database_session()
+        try:
+            if manager_id not in self.endpoints:
+                return
+
+            rows = db.query(WebhookEvent.id, WebhookEvent.event).filter(
+                WebhookEvent.manager_id == manager_id
+            ).order_by(WebhookEvent.id).limit(MAX_BATCH_SIZE).all()
+            if len(rows) == 0:
+                return
+            events = [ json.loads(event) for _, event in rows ]
+
+            url, secret = self.endpoints[manager_id]
+            try:
+                # Checked again on delivery, a host may resolve differently by now
+                if not valid_webhook_url(url):
+                    raise ValueError('%s does not resolve to a public address' % url)
+                delivered = post_events(url, secret, events)
+            except Exception as e:
+                print('Webhook delivery to manager %d failed: %s' % (manager_id, e))
+                delivered = False
+
+            if delivered:
+                db.query(WebhookEvent).filter(
+                    WebhookEvent.id.in_([ event_id for event_id, _ in rows ])
+                ).delete(synchronize_session=False)
+                db.commit()
+                queue.failures = 0
+                queue.nextattempt = 0
+                log_event('Notify', 'Hook', 'manager %d' % manager_id, '%d events' % len(events))
+            else:
+                queue.backoff(time())
+        finally:
+            queue.busy = False
+            db.close()
+
+    def flush(self, db):
+        now = time()
+        for manager_id, in db.query(WebhookEvent.manager_id).distinct().all():
+            if manager_id not in self.endpoints:
+                continue
+            queue = self.queues.setdefault(manager_id, ManagerQueue())
+            if queue.ready(now):
+                queue.busy = True
+                self.pool.spawn(self.deliver, manager_id, queue)
+
+
+def main():
+    watchers = [ DepositWatcher(coin) for coin in COINS ]
+    dispatcher = WebhookDispatcher()
+
+    while True:
+        try:
+            # Bindings are read from the primary so deposits to fresh addresses
+            # are never missed, the chain is scanned on a replica
+            wallet_db = connectionmanager.database_session()
+            try:
+                dispatcher.reload_endpoints(wallet_db)
+                for watcher in watchers:
+                    coin_db = connectionmanager.database_session(coin=watcher.coin, readonly=True)
+                    try:
+                        watcher.poll(coin_db, wallet_db, dispatcher)
+                    finally:
+                        coin_db.close()
+                dispatcher.flush(wallet_db)
+            finally:
+                wallet_db.close()
+
+            sleep(WEBHOOK_POLL_INTERVAL)
+        except KeyboardInterrupt:
+            dispatcher.pool.join()
+            return
+        except Exception as e:
+            print('Webhook cycle failed: %s' % e)
+            sleep(WEBHOOK_POLL_INTERVAL)
+
+
+if __name__ == '__main__':
+    main()